@@ -1,8 +1,10 @@
 from google import genai
+import re
 import asyncio
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import os
+import numpy as np
 
 load_dotenv()    
 
@@ -38,6 +40,40 @@ Only output a single number between 0 and 5.
         return 0.0
 
 
+async def get_magnitudes_for_queries(prompts: list[str]) -> list:
+    """
+    Score several memories in one LLM call, same scale and criteria as
+    get_magnitude_for_query. Returns one magnitude per prompt, in order; None where the
+    answer had no usable score. Raises if the call itself fails.
+    """
+    numbered = "\n".join(f'[{i}] "{p}"' for i, p in enumerate(prompts, 1))
+    prompt_text = f"""
+You are an expert assistant evaluating how important or urgent each of the given user prompts is.
+
+Rate the importance of each prompt on a scale from 0 (not important) to 5 (very important), using your own reasoning:
+
+Focus on the user's point of view, not external facts.
+
+Messages that are highly personal, emotionally significant, or reveal things the user would typically share only with someone close should score higher.
+
+Messages that are informative about the user — such as their preferences, goals, values, or memories — also warrant a higher score.
+
+General, casual, or non-personal messages should score lower.
+
+Prompts:
+{numbered}
+
+Output one line per prompt, in order, as "[number] score" with a single number between 0 and 5, and nothing else.
+"""
+    response = await asyncio.to_thread(client.models.generate_content, model="gemini-2.5-flash", contents=prompt_text)
+    scores = [None] * len(prompts)
+    for match in re.finditer(r"\[(\d+)\]\s*([0-9]+(?:\.[0-9]+)?)", response.text or ""):
+        i = int(match.group(1)) - 1
+        if 0 <= i < len(prompts):
+            scores[i] = round(max(0, min(5, float(match.group(2)))), 2)
+    return scores
+
+
 
 #Recency Function
 def get_recency_score(timestamp_input) -> int:
@@ -82,3 +118,11 @@ def get_rfm_score(recency_timestamp: str, frequency: int, magnitude: float) -> f
     rfm_score = recency_score * 0.3 + frequency * 0.2 + magnitude * 0.5
     return round(rfm_score, 2)
 
+
+def get_rfm_scores(last_used_ts, frequency, magnitude, now_ts) -> np.ndarray:
+    """
+    Vectorized get_rfm_score over arrays, with recency from epoch seconds.
+    """
+    days_ago = np.floor((now_ts - np.asarray(last_used_ts, dtype=np.float64)) / 86400)
+    recency = np.select([days_ago <= 1, days_ago <= 3, days_ago <= 7, days_ago <= 14], [5, 4, 3, 2], 1)
+    return np.round(recency * 0.3 + np.asarray(frequency) * 0.2 + np.asarray(magnitude) * 0.5, 2)
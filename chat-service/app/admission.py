@@ -0,0 +1,105 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+from . import metrics
+
+load_dotenv()
+
+# Concurrent chat requests per user, and in total. The global cap should match how many
+# Gemini calls we can have in flight without hitting rate limits or queueing upstream.
+ADMISSION_PER_USER_LIMIT = int(os.getenv("ADMISSION_PER_USER_LIMIT", "2"))
+ADMISSION_GLOBAL_LIMIT = int(os.getenv("ADMISSION_GLOBAL_LIMIT", "16"))
+# Requests allowed to wait for a global slot, and for how long. Keep the timeout well
+# inside the latency SLO so admitted requests still finish in budget.
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_QUEUE_TIMEOUT_SEC = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SEC", "2.0"))
+# Shed load when the memory-task backlog grows past this many messages (0 disables)
+ADMISSION_BACKLOG_MAX = int(os.getenv("ADMISSION_BACKLOG_MAX", "500"))
+ADMISSION_RETRY_AFTER_SEC = int(os.getenv("ADMISSION_RETRY_AFTER_SEC", "2"))
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Per-user in-flight limit, global concurrency cap with a bounded wait queue, and
+    backlog-aware load shedding in front of the chat endpoints.
+    """
+
+    def __init__(self, per_user_limit=ADMISSION_PER_USER_LIMIT, global_limit=ADMISSION_GLOBAL_LIMIT,
+                 max_queue=ADMISSION_MAX_QUEUE, queue_timeout=ADMISSION_QUEUE_TIMEOUT_SEC,
+                 backlog_max=ADMISSION_BACKLOG_MAX, backlog_fn=None):
+        self.per_user_limit = per_user_limit
+        self.global_limit = global_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.backlog_max = backlog_max
+        # Async callable returning the current number of queued memory tasks
+        self.backlog_fn = backlog_fn
+        self._slots = asyncio.Semaphore(global_limit)
+        self._in_flight = {}
+        self._active = 0
+        self._waiting = 0
+
+    def _reject(self, reason, retry_after):
+        metrics.incr("admission_rejected_total", reason=reason)
+        raise AdmissionRejected(reason, retry_after)
+
+    async def _check_backlog(self):
+        if not self.backlog_max or self.backlog_fn is None:
+            return
+        backlog = await self.backlog_fn()
+        metrics.set_gauge("admission_memory_backlog", backlog)
+        if backlog > self.backlog_max:
+            self._reject("backlog", ADMISSION_RETRY_AFTER_SEC * 3)
+
+    def _update_gauges(self):
+        metrics.set_gauge("admission_in_flight", self._active)
+        metrics.set_gauge("admission_waiting", self._waiting)
+
+    @asynccontextmanager
+    async def admit(self, user_id):
+        # Checked and counted before the first await, so concurrent requests from one user see each other
+        if self._in_flight.get(user_id, 0) >= self.per_user_limit:
+            self._reject("user_limit", 1)
+        self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+        try:
+            await self._check_backlog()
+            queued = self._active >= self.global_limit
+            if queued and self._waiting >= self.max_queue:
+                self._reject("queue_full", ADMISSION_RETRY_AFTER_SEC)
+            if queued:
+                metrics.incr("admission_queued_total")
+                self._waiting += 1
+                self._update_gauges()
+            wait_start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._reject("queue_timeout", ADMISSION_RETRY_AFTER_SEC)
+            finally:
+                if queued:
+                    self._waiting -= 1
+            metrics.observe("admission_queue_wait_seconds", time.perf_counter() - wait_start)
+            metrics.incr("admission_admitted_total")
+
+            self._active += 1
+            self._update_gauges()
+            try:
+                yield
+            finally:
+                self._active -= 1
+                self._slots.release()
+                self._update_gauges()
+        finally:
+            self._in_flight[user_id] -= 1
+            if not self._in_flight[user_id]:
+                del self._in_flight[user_id]
@@ -0,0 +1,133 @@
+import sys
+import time
+import uuid
+import argparse
+import numpy as np
+from redis.commands.search.query import Query
+from redis.commands.search.index_definition import IndexDefinition, IndexType
+
+from .redis_class import RedisManager
+from .indexes import memory_schema, _wait_indexed, EMBEDDING_DIM
+from .records import embedding_field
+
+# Recall@k against brute force and query latency of the memory index for several HNSW
+# parameter sets and data scales. Loads synthetic memories (a few topic clusters per
+# user) into a throwaway index, runs the production query shape (user-filtered KNN) and
+# cleans up. --dims repeats each scale at other embedding sizes, for the index latency
+# and size side of EMBEDDING_DIM; synthetic vectors say nothing about how much a smaller
+# model output loses, which migrate_embeddings.py --compare measures on real memories. Usage:
+#   python -m app.bench_index --scales 10x200,100x200,100x2000 --m 8,16,32 --ef-construction 100,200 --ef-runtime 10,20,50,100
+#   python -m app.bench_index --scales 100x2000 --m 16 --ef-construction 200 --dims 768,256
+
+
+def synthetic_user_vectors(rng, n, dim=EMBEDDING_DIM, topics=8):
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, topics, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def brute_force_top_k(vectors, query, k):
+    # Cosine distance on unit vectors
+    distances = 1.0 - vectors @ query
+    return set(np.argsort(distances)[:k].tolist())
+
+
+def load(client, prefix, data, dim=EMBEDDING_DIM, batch=500):
+    field = embedding_field(dim)
+    pipe = client.pipeline(transaction=False)
+    n = 0
+    for user_id, vectors in data.items():
+        for i, vec in enumerate(vectors):
+            pipe.hset(f"{prefix}{user_id}:{i}", mapping={"user_id": user_id, field: vec.tobytes()})
+            n += 1
+            if n % batch == 0:
+                pipe.execute()
+    pipe.execute()
+
+
+def run_queries(client, index, queries, k, ef_runtime):
+    latencies, recalls = [], []
+    for user_id, query_vec, truth in queries:
+        q = (
+            Query(f"@user_id:{{{user_id}}}=>[KNN {k} @embedding $vec EF_RUNTIME $ef AS score]")
+            .return_fields("score").sort_by("score").paging(0, k).dialect(2)
+        )
+        start = time.perf_counter()
+        res = client.ft(index).search(q, query_params={"vec": query_vec.tobytes(), "ef": ef_runtime})
+        latencies.append(time.perf_counter() - start)
+        found = {int(doc.id.rsplit(":", 1)[1]) for doc in res.docs}
+        recalls.append(len(found & truth) / len(truth))
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return float(np.mean(recalls)), p(0.5), p(0.95)
+
+
+def index_size_mb(client, index):
+    # Vector index memory as FT.INFO reports it (field name differs across RediSearch versions)
+    info = client.ft(index).info()
+    for field in ("vector_index_sz_mb", "total_index_memory_sz_mb"):
+        if field in info:
+            return float(info[field])
+    return float("nan")
+
+
+def bench_scale(client, users, per_user, ms, efcs, efrs, k, n_queries, seed, dim=EMBEDDING_DIM):
+    rng = np.random.default_rng(seed)
+    data = {f"u{u}": synthetic_user_vectors(rng, per_user, dim) for u in range(users)}
+    queries = []
+    for _ in range(n_queries):
+        user_id = f"u{rng.integers(users)}"
+        vectors = data[user_id]
+        query = vectors[rng.integers(per_user)] + 0.3 * rng.standard_normal(dim).astype(np.float32)
+        query /= np.linalg.norm(query)
+        queries.append((user_id, query.astype(np.float32), brute_force_top_k(vectors, query, k)))
+
+    print(f"\n{users} users x {per_user} memories = {users * per_user} {dim}-d vectors, recall@{k} over {n_queries} queries")
+    print(f"{'M':>4}{'EF_C':>6}{'build s':>9}{'index MB':>10}{'EF_R':>6}{'recall':>9}{'p50 ms':>9}{'p95 ms':>9}")
+    for m in ms:
+        for efc in efcs:
+            run = uuid.uuid4().hex[:8]
+            prefix, index = f"bench:{run}:", f"bench_idx_{run}"
+            client.ft(index).create_index(
+                memory_schema(m=m, ef_construction=efc, dim=dim),
+                definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH),
+            )
+            try:
+                start = time.perf_counter()
+                load(client, prefix, data, dim)
+                _wait_indexed(client, index)
+                build = time.perf_counter() - start
+                size = index_size_mb(client, index)
+                for efr in efrs:
+                    recall, p50, p95 = run_queries(client, index, queries, k, efr)
+                    print(f"{m:>4}{efc:>6}{build:>9.1f}{size:>10.1f}{efr:>6}{recall:>9.3f}{p50:>9.2f}{p95:>9.2f}")
+            finally:
+                client.ft(index).dropindex(delete_documents=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory index recall/latency benchmark")
+    parser.add_argument("--scales", default="10x200,100x200,100x2000", help="users x memories per user, comma separated")
+    parser.add_argument("--m", default="8,16,32")
+    parser.add_argument("--ef-construction", default="100,200")
+    parser.add_argument("--ef-runtime", default="10,20,50,100")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dims", default=str(EMBEDDING_DIM), help="embedding sizes, comma separated")
+    args = parser.parse_args()
+
+    ints = lambda s: [int(x) for x in s.split(",") if x]
+    primaries = RedisManager().primaries()
+    if len(primaries) > 1:
+        sys.exit("Run against a single Redis node; cluster primaries index only their own slots")
+    client = primaries[0]
+    for scale in args.scales.split(","):
+        users, per_user = (int(x) for x in scale.split("x"))
+        for dim in ints(args.dims):
+            bench_scale(client, users, per_user, ints(args.m), ints(args.ef_construction), ints(args.ef_runtime),
+                        args.k, args.queries, args.seed, dim)
+
+
+if __name__ == "__main__":
+    main()
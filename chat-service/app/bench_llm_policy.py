@@ -0,0 +1,103 @@
+import sys
+import random
+import asyncio
+from types import SimpleNamespace
+
+from .llm_policy import LLMPolicy, LLMDeadlineExceeded
+
+# Replays chat completions against a fake client with injected heavy-tailed latency and
+# compares end-to-end latency without the policy, with deadline + fallback, and with
+# hedging on top. No API key needed. Usage:
+#   python -m app.bench_llm_policy [requests] [concurrency]
+
+PRIMARY_MEDIAN_SEC = 1.0
+FALLBACK_MEDIAN_SEC = 0.5
+TAIL_PROBABILITY = 0.08  # share of primary calls that stall
+TAIL_SEC = (6.0, 15.0)
+FAILURE_PROBABILITY = 0.01
+
+
+class FakeModels:
+    def __init__(self, rng, time_scale):
+        self.rng = rng
+        self.time_scale = time_scale
+
+    def latency(self, model):
+        if model.endswith("lite"):
+            return self.rng.lognormvariate(0, 0.3) * FALLBACK_MEDIAN_SEC
+        if self.rng.random() < TAIL_PROBABILITY:
+            return self.rng.uniform(*TAIL_SEC)
+        return self.rng.lognormvariate(0, 0.35) * PRIMARY_MEDIAN_SEC
+
+    async def generate_content(self, model, contents):
+        await asyncio.sleep(self.latency(model) * self.time_scale)
+        if self.rng.random() < FAILURE_PROBABILITY:
+            raise RuntimeError("injected provider error")
+        return SimpleNamespace(text=f"reply from {model}", usage_metadata=None)
+
+
+class FakeClient:
+    def __init__(self, seed=0, time_scale=0.05):
+        self.aio = SimpleNamespace(models=FakeModels(random.Random(seed), time_scale))
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(name, call, n, concurrency, time_scale):
+    sem = asyncio.Semaphore(concurrency)
+    latencies, served, failures = [], {}, 0
+    loop = asyncio.get_running_loop()
+
+    async def one():
+        nonlocal failures
+        async with sem:
+            start = loop.time()
+            try:
+                path = await call()
+            except (LLMDeadlineExceeded, RuntimeError):
+                failures += 1
+                path = "failed"
+            latencies.append((loop.time() - start) / time_scale)
+            served[path] = served.get(path, 0) + 1
+
+    await asyncio.gather(*(one() for _ in range(n)))
+    print(f"{name:<18}{percentile(latencies, .5):>8.2f}{percentile(latencies, .95):>8.2f}"
+          f"{percentile(latencies, .99):>8.2f}   {dict(sorted(served.items()))}")
+
+
+async def main(n, concurrency):
+    time_scale = 0.05  # simulated seconds -> wall seconds
+    scaled = lambda sec: sec * time_scale
+    print(f"{n} requests, concurrency {concurrency} (latencies in simulated seconds)\n")
+    print(f"{'policy':<18}{'p50':>8}{'p95':>8}{'p99':>8}   served by")
+
+    client = FakeClient(seed=1, time_scale=time_scale)
+
+    async def direct():
+        await client.aio.models.generate_content(model="gemini-2.5-flash", contents="hi")
+        return "primary"
+    await run("none", direct, n, concurrency, time_scale)
+
+    variants = (
+        ("deadline+fallback", dict(hedge=False)),
+        ("+hedge", dict(hedge=True)),
+    )
+    for name, kwargs in variants:
+        policy = LLMPolicy(FakeClient(seed=1, time_scale=time_scale), fallback_reserve=scaled(4), **kwargs)
+        # Warm the p95 estimate the way a running service would have
+        for _ in range(50):
+            policy.latency.record(scaled(FakeModels(random.Random(), 1).latency("gemini-2.5-flash")))
+
+        async def call(policy=policy):
+            _, path = await policy.generate("rfm-semantic", "hi", deadline=scaled(12))
+            return path
+        await run(name, call, n, concurrency, time_scale)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    asyncio.run(main(n, concurrency))
@@ -0,0 +1,72 @@
+import sys
+import time
+import uuid
+import tempfile
+import asyncio
+from datetime import datetime, timezone
+
+from .redis_class import RedisManager
+from .persistence import SupabaseStore, PostgresStore, SnapshotStore, DATABASE_URL
+from .session_snapshot import SnapshotDir
+from .serialization import filter_valid_memories
+from .bench_serialization import synthetic_memories
+
+# Logout (Redis -> DB) and login (DB -> Redis) time per backend for a synthetic user.
+# The "+snap" rows log in from a local session snapshot (needs the session_sync_state table).
+# Needs Redis plus Supabase and/or DATABASE_URL. Usage:
+#   python -m app.bench_persistence [n_memories] [n_chats]
+
+
+def synthetic_chats(user_id, n):
+    now = datetime.now(timezone.utc).isoformat()
+    return [{
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "user_message": f"Synthetic user message {i}",
+        "bot_response": f"Synthetic bot response {i}, a little longer than the question.",
+        "timestamp": now,
+    } for i in range(n)]
+
+
+async def bench_store(name, store, redis_manager, n_memories, n_chats):
+    user_id = f"bench_{uuid.uuid4().hex[:12]}"
+    memories = [dict(m, user_id=user_id) for m in synthetic_memories(n_memories)]
+    for m in memories:
+        m.pop("__redis_key__")
+    redis_manager.load_user_data(user_id, memories, synthetic_chats(user_id, n_chats))
+
+    try:
+        start = time.perf_counter()
+        raw_memories = filter_valid_memories(redis_manager.get_user_memories(user_id))
+        raw_chats = redis_manager.get_user_chats(user_id)
+        await store.save_user(user_id, raw_memories, raw_chats)
+        logout_time = time.perf_counter() - start
+        redis_manager.clear_user_data(user_id)
+
+        start = time.perf_counter()
+        loaded = await store.load_user(redis_manager, user_id)
+        login_time = time.perf_counter() - start
+        print(f"{name:<10}{logout_time:>12.3f}s{login_time:>12.3f}s   loaded {loaded[0]} memories, {loaded[1]} chats")
+    finally:
+        redis_manager.clear_user_data(user_id)
+        await store.delete_user(user_id)
+
+
+async def main(n_memories, n_chats):
+    redis_manager = RedisManager()
+    print(f"{n_memories} memories, {n_chats} chats\n")
+    print(f"{'backend':<10}{'logout':>13}{'login':>13}")
+    snapshots = SnapshotDir(tempfile.mkdtemp(prefix="bench_snap_"))
+    await bench_store("supabase", SupabaseStore(), redis_manager, n_memories, n_chats)
+    await bench_store("+snap", SnapshotStore(SupabaseStore(), snapshots), redis_manager, n_memories, n_chats)
+    if DATABASE_URL:
+        await bench_store("postgres", PostgresStore(), redis_manager, n_memories, n_chats)
+        await bench_store("+snap", SnapshotStore(PostgresStore(), snapshots), redis_manager, n_memories, n_chats)
+    else:
+        print("postgres  skipped (DATABASE_URL not set)")
+
+
+if __name__ == "__main__":
+    n_memories = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_chats = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    asyncio.run(main(n_memories, n_chats))
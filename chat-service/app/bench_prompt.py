@@ -0,0 +1,64 @@
+import sys
+import time
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from .chatbot import client, format_history_block
+from .memory_functions import fetch_last_m_messages, get_conversation_context
+from .redis_class import RedisManager
+
+# Compares the legacy 10-turn history against rolling summary + recent turns for a
+# logged-in user. Usage: python -m app.bench_prompt <user_id> [runs]
+
+PROMPT_TEMPLATE = """You are an engaging, friendly conversational assistant.
+
+Recent Chat:
+{history_block}
+
+Current User Input:
+{user_input}
+
+Respond to the user now.
+"""
+
+
+def time_generation(prompt, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        client.models.generate_content(model="gemini-2.5-flash", contents=prompt)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+async def main(user_id, runs):
+    redis_manager = RedisManager()
+    user_input = "What should I do this weekend?"
+
+    legacy_recent = await fetch_last_m_messages(redis_manager.for_user(user_id), user_id, m=10)
+    legacy_prompt = PROMPT_TEMPLATE.format(history_block=format_history_block("", legacy_recent), user_input=user_input)
+
+    summary, m = get_conversation_context(redis_manager, user_id)
+    recent = await fetch_last_m_messages(redis_manager.for_user(user_id), user_id, m=m)
+    summary_prompt = PROMPT_TEMPLATE.format(history_block=format_history_block(summary, recent), user_input=user_input)
+
+    results = {}
+    for name, prompt in (("legacy (10 turns)", legacy_prompt), (f"summary + {m} turns", summary_prompt)):
+        tokens = client.models.count_tokens(model="gemini-2.5-flash", contents=prompt).total_tokens
+        results[name] = (tokens, time_generation(prompt, runs))
+
+    print(f"{'context':<22}{'prompt tokens':>15}{'p50 latency (s)':>18}")
+    for name, (tokens, latency) in results.items():
+        print(f"{name:<22}{tokens:>15}{latency:>18.3f}")
+    (legacy_tokens, legacy_latency), (new_tokens, new_latency) = results.values()
+    print(f"Token reduction: {1 - new_tokens / legacy_tokens:.1%}, latency reduction: {1 - new_latency / legacy_latency:.1%}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m app.bench_prompt <user_id> [runs]")
+        sys.exit(1)
+    asyncio.run(main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 5))
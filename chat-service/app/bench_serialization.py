@@ -0,0 +1,141 @@
+import sys
+import json
+import tracemalloc
+import time
+import uuid
+import numpy as np
+from datetime import datetime, timezone
+
+from .serialization import filter_valid_memories, serialize_memory
+from .embedding_codec import from_pgvector_text
+from .records import MemoryBatch, EMB_DIM, EMB_FIELD, REQUIRED_MEMORY_FIELDS
+from .redis_class import HGETALL_CHUNK_SIZE
+
+# Logout/login embedding throughput per 10k memories, legacy per-float path on decoded
+# dicts vs typed records and the codec. Both start from HGETALL-shaped replies.
+# Usage: python -m app.bench_serialization [n_memories]
+
+
+def synthetic_memories(n):
+    now = datetime.now(timezone.utc).isoformat()
+    matrix = np.random.default_rng(0).standard_normal((n, EMB_DIM)).astype(np.float32)
+    return [{
+        "id": str(uuid.uuid4()),
+        "user_id": "bench_user",
+        "memory_text": f"Synthetic memory number {i} about the user's hobbies.",
+        "embedding": matrix[i].tobytes(),
+        "magnitude": "3.0",
+        "last_used": now,
+        "frequency": "2",
+        "rfm_score": "2.9",
+        "created_at": now,
+        "__redis_key__": f"memories:bench_user:{i}",
+    } for i in range(n)]
+
+
+def as_redis_hashes(memories):
+    # What a pipeline of HGETALLs returns: fresh bytes field names and values
+    keys = [m["__redis_key__"].encode() for m in memories]
+    hashes = [{
+        (EMB_FIELD if k == "embedding" else k).encode(): (bytes(bytearray(v)) if isinstance(v, bytes) else str(v).encode())
+        for k, v in m.items() if k != "__redis_key__"
+    } for m in memories]
+    return keys, hashes
+
+
+def chunked_replies(memories, chunk=HGETALL_CHUNK_SIZE):
+    # Replies arriving one pipeline chunk at a time, as get_user_memories reads them
+    for i in range(0, len(memories), chunk):
+        yield from as_redis_hashes(memories[i:i + chunk])[1]
+
+
+def legacy_decode(keys, hashes):
+    # The former get_user_memories: one dict of str values per hash
+    out = []
+    for key, mem in zip(keys, hashes):
+        decoded = {k.decode(): (v if k == EMB_FIELD.encode() else v.decode()) for k, v in mem.items()}
+        decoded["embedding"] = decoded.pop(EMB_FIELD)
+        decoded["__redis_key__"] = key.decode()
+        out.append(decoded)
+    return out
+
+
+def legacy_is_valid(mem):
+    for field in REQUIRED_MEMORY_FIELDS:
+        if field not in mem or mem[field] is None or (isinstance(mem[field], str) and not mem[field].strip()):
+            return False
+    emb = mem["embedding"]
+    if not isinstance(emb, np.ndarray) or emb.size != EMB_DIM:
+        return False
+    try:
+        float(mem["magnitude"])
+        int(mem["frequency"])
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def legacy_logout(keys, hashes):
+    out = []
+    for raw in legacy_decode(keys, hashes):
+        mem = dict(raw, embedding=np.frombuffer(raw["embedding"], dtype=np.float32))
+        if legacy_is_valid(mem):
+            out.append({k: (v.tolist() if k == "embedding" else v) for k, v in mem.items() if k != "__redis_key__"})
+    return json.dumps(out)
+
+
+def codec_logout(keys, hashes):
+    batch = filter_valid_memories(MemoryBatch.from_redis(keys, hashes))
+    return json.dumps([serialize_memory(mem) for mem in batch])
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def peak_allocated(fn):
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return peak
+
+
+def main(n):
+    memories = synthetic_memories(n)
+    keys, hashes = as_redis_hashes(memories)
+    scale = 10_000 / n
+    print(f"{n} memories x {EMB_DIM}d, times scaled to 10k memories\n")
+
+    _, t = timed(lambda: [legacy_is_valid(dict(m, embedding=np.frombuffer(m["embedding"], dtype=np.float32)))
+                          for m in legacy_decode(keys, hashes)])
+    _, t_bulk = timed(lambda: filter_valid_memories(MemoryBatch.from_redis(keys, hashes)))
+    # The bulk check also rejects NaN/inf embeddings, which the legacy check let through
+    print(f"{'decode+validate':<26}{'legacy':>10}{t * scale:>9.3f}s   {'records':>7}{t_bulk * scale:>9.3f}s")
+
+    legacy_payload, t = timed(legacy_logout, keys, hashes)
+    codec_payload, t_codec = timed(codec_logout, keys, hashes)
+    print(f"{'decode+serialize+json':<26}{'legacy':>10}{t * scale:>9.3f}s   {'codec':>6}{t_codec * scale:>9.3f}s")
+    # Reading a session back, raw replies included: all replies at once into dicts, vs
+    # chunked replies copied into the batch matrix as they arrive
+    legacy_peak = peak_allocated(lambda: legacy_decode(keys, as_redis_hashes(memories)[1]))
+    records_peak = peak_allocated(lambda: MemoryBatch.from_redis(keys, chunked_replies(memories)))
+    print(f"{'read peak memory':<26}{'legacy':>10}{legacy_peak * scale / 2**20:>8.1f}MB   {'records':>7}{records_peak * scale / 2**20:>8.1f}MB")
+    print(f"{'upsert payload size':<26}{'legacy':>10}{len(legacy_payload) / 2**20:>8.1f}MB   {'codec':>6}{len(codec_payload) / 2**20:>8.1f}MB")
+
+    rows = json.loads(codec_payload)
+    legacy_rows = json.loads(legacy_payload)
+    legacy_texts = [json.dumps(r["embedding"]) for r in legacy_rows]
+    _, t = timed(lambda: [np.array(json.loads(text), dtype=np.float32).tobytes() for text in legacy_texts])
+    _, t_codec = timed(lambda: [from_pgvector_text(r["embedding"]) for r in rows])
+    print(f"{'login decode':<26}{'legacy':>10}{t * scale:>9.3f}s   {'codec':>6}{t_codec * scale:>9.3f}s")
+
+    roundtrip = from_pgvector_text(rows[0]["embedding"])
+    print(f"\nLossless round-trip: {roundtrip == memories[0]['embedding']}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
@@ -0,0 +1,76 @@
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+
+from .transport import LocalTransport
+
+# Throughput of the in-process task transport. Publishes N chat turns from C concurrent
+# senders, then awaits drain(), so every run ends with all turns handled by both
+# consumers and the timings always cover the same work. Handlers are simulated with a
+# fixed delay by default (no Redis or API key needed); --real runs the workers' own
+# handlers against Redis and Gemini. Usage:
+#   python -m app.bench_transport [--turns 2000] [--senders 20] [--handler-ms 5] [--real]
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def simulated_handlers(delay_sec):
+    async def handle(redis_manager, body, headers):
+        await asyncio.sleep(delay_sec)
+    return {"message_log": handle, "memory_task": handle}
+
+
+async def run(name, turns, senders, log_path, handlers, redis_manager=None):
+    transport = LocalTransport(redis_manager, log_path=log_path, handlers=handlers)
+    await transport.start()
+    sem = asyncio.Semaphore(senders)
+    publish_latencies = []
+
+    async def send(i):
+        async with sem:
+            start = time.perf_counter()
+            await transport.publish(f"bench_user_{i % senders}", f"message {i}", f"reply {i}")
+            publish_latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(turns)))
+    published = time.perf_counter() - start
+    await transport.drain()
+    total = time.perf_counter() - start
+    await transport.close()
+    log_bytes = os.path.getsize(log_path) if log_path else 0
+    print(f"{name:<10}{published:>12.2f}{total:>10.2f}{turns / total:>10.0f}"
+          f"{percentile(publish_latencies, 0.5) * 1000:>9.2f}{percentile(publish_latencies, 0.95) * 1000:>9.2f}"
+          f"{log_bytes / 2**20:>9.1f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="In-process task transport benchmark")
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--senders", type=int, default=20)
+    parser.add_argument("--handler-ms", type=float, default=5.0, help="simulated handler time")
+    parser.add_argument("--real", action="store_true", help="use the workers' handlers (needs Redis and Gemini)")
+    args = parser.parse_args()
+
+    redis_manager = handlers = None
+    if args.real:
+        from .redis_class import RedisManager
+        redis_manager = RedisManager()
+    else:
+        handlers = simulated_handlers(args.handler_ms / 1000)
+
+    print(f"{args.turns} turns from {args.senders} senders, "
+          + ("real handlers" if args.real else f"{args.handler_ms:g} ms simulated handlers"))
+    print(f"{'':<10}{'publish s':>12}{'drain s':>10}{'turns/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'log MB':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        await run("no log", args.turns, args.senders, "", handlers, redis_manager)
+        await run("log", args.turns, args.senders, os.path.join(tmp, "task_log.jsonl"), handlers, redis_manager)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
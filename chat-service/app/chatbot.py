@@ -3,42 +3,59 @@ import os
 import time
 import asyncio
 
-from .memory_functions import fetch_last_m_messages, get_semantically_similar_memories, get_highest_rfm_memories, get_embedding, time_ago_human
+from .llm_policy import LLMPolicy
+from .prompt_cache import PromptCache
+from .memory_functions import fetch_last_m_messages, get_semantically_similar_memories, get_highest_rfm_memories, get_embedding, time_ago_human, get_conversation_context, get_hybrid_memories
 
 client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+llm_policy = LLMPolicy(client)
+prompt_cache = PromptCache(client)
 
-from datetime import datetime, timezone
+# "hybrid": one fused similarity/RFM/recency ranking; "legacy": separate KNN and RFM searches
+RFM_SEMANTIC_RETRIEVAL = os.getenv("RFM_SEMANTIC_RETRIEVAL", "hybrid")
 
+# Stable part of each mode's prompt. It goes first, followed by the user's top memories
+# (prompt_cache.py), so it can be served from Gemini's context cache.
+SEMANTIC_INSTRUCTIONS = """You are an engaging, friendly, and attentive conversational assistant. Your goal is to provide helpful, specific, and context-aware responses that feel natural and human.
 
-async def get_bot_response_from_memory(redis_manager, user_id: str, user_input: str) -> dict:
-    embedding_time = time.perf_counter()
-    input_embedding = await get_embedding(user_input)
-    embedding_elapsed = time.perf_counter() - embedding_time
-    fetch_start = time.perf_counter()
-    # 1. Fetch recent chat history
-    recent_task = fetch_last_m_messages(redis_manager.client, user_id, m=10)
-    # 2. Retrieve top-5 semantically similar memories
-    semantic_task =  get_semantically_similar_memories(redis_manager.client, user_id, input_embedding, cutoff= 0)
-    
-    recent, semantic = await asyncio.gather(recent_task, semantic_task)
-    fetch_elapsed = time.perf_counter() - fetch_start
+**Your personality:** Curious, empathetic, and adaptive. Match the user's tone and energy. Use humor or encouragement when appropriate.
 
-    semantic_block = "\n\n".join(
-    f"{mem['text']}| Similarity score:{mem['sim']} | Temporal relevance: added {time_ago_human(mem['created_at'])}, last retrieved {time_ago_human(mem['last_used'])}"
-    for mem in semantic
-)
+**Your tools:**
+- Semantically relevant memories: Use these to recall user preferences, experiences, or facts.
+- What you know about the user: Background on who they are; draw on it when it is relevant.
+- Recent chat history: Maintain conversational flow and continuity.
 
-    # 3. Construct the LLM prompt
-    history_block = "\n\n".join(
-        [f"Timestamp: {r['timestamp']}\nUser: {r['user_message']}\nBot: {r['bot_response']}" for r in recent]
-    )
-    prompt = f"""
-You are an engaging, friendly, and attentive conversational assistant. Your goal is to provide helpful, specific, and context-aware responses that feel natural and human.
+**Instructions:**
+- Reference relevant memories if helpful to personalize your response.
+- Build on the ongoing conversation, referencing previous messages like you are in a conversation.
+- If you’re unsure, ask a clarifying question or offer a thoughtful suggestion.
+- Avoid generic or repetitive answers from recent chat, only build on it; be as specific and vivid as possible.
+- Respond in a warm, conversational tone. Do not mention that you are an AI."""
+
+RFM_INSTRUCTIONS = """You are an engaging, helpful assistant with a strong memory for what matters most to the user. Your responses should be context-aware, specific, and feel genuinely conversational.
+
+**Your personality:** Friendly, supportive, and attentive to details the user cares about.
+
+**Your tools:**
+- High-RFM memories: Use these to understand what is most important and frequently discussed by the user.
+- What you know about the user: Background on who they are; draw on it when it is relevant.
+- Recent chat history: Reference previous exchanges to maintain continuity.
+
+**Instructions:**
+- Use high-RFM memories to ground your response in the user's top interests, needs, or concerns.
+- Reference recent chat to maintain flow and context.
+- Be specific, avoid generic statements, and personalize your reply.
+- If appropriate, ask a thoughtful follow-up question or offer a relevant suggestion.
+- Maintain a warm, conversational tone. Do not mention that you are an AI."""
+
+COMBINED_INSTRUCTIONS = """You are an engaging, friendly, and attentive conversational assistant. Your goal is to provide helpful, specific, and context-aware responses that feel natural and human.
 
 **Your personality:** Curious, empathetic, and adaptive. Match the user's tone and energy. Use humor or encouragement when appropriate.
 
 **Your tools:**
 - Semantically relevant memories: Use these to recall user preferences, experiences, or facts.
+- High-RFM memories: Use these to understand what matters most to the user.
+- What you know about the user: Background on who they are; draw on it when it is relevant.
 - Recent chat history: Maintain conversational flow and continuity.
 
 **Instructions:**
@@ -46,9 +63,52 @@ You are an engaging, friendly, and attentive conversational assistant. Your goal
 - Build on the ongoing conversation, referencing previous messages like you are in a conversation.
 - If you’re unsure, ask a clarifying question or offer a thoughtful suggestion.
 - Avoid generic or repetitive answers from recent chat, only build on it; be as specific and vivid as possible.
-- Respond in a warm, conversational tone. Do not mention that you are an AI.
+- Respond in a warm, conversational tone. Do not mention that you are an AI. Sound like youre speaking in a natural conversation."""
+
+
+def format_history_block(summary: str, recent: list) -> str:
+    # Older turns arrive pre-folded in the rolling summary; only the tail is sent verbatim
+    turns = "\n\n".join(
+        [f"Timestamp: {r['timestamp']}\nUser: {r['user_message']}\nBot: {r['bot_response']}" for r in recent]
+    )
+    if not summary:
+        return turns
+    return f"Earlier in this conversation: {summary}\n\n{turns}"
 
-**Context:**
+
+def prompt_token_count(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "prompt_token_count", None)
+
+
+def cached_token_count(response):
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, "cached_content_token_count", None)
+
+
+async def get_bot_response_from_memory(redis_manager, user_id: str, user_input: str) -> dict:
+    embedding_time = time.perf_counter()
+    input_embedding = await get_embedding(user_input)
+    embedding_elapsed = time.perf_counter() - embedding_time
+    fetch_start = time.perf_counter()
+    # 1. Fetch recent chat history
+    summary, m = get_conversation_context(redis_manager, user_id)
+    recent_task = fetch_last_m_messages(redis_manager.for_user(user_id), user_id, m=m)
+    # 2. Retrieve top-5 semantically similar memories
+    semantic_task =  get_semantically_similar_memories(redis_manager.for_user(user_id), user_id, input_embedding, cutoff= 0, mode="semantic")
+    prefix_task = prompt_cache.prefix(redis_manager.for_user(user_id), user_id, "semantic", SEMANTIC_INSTRUCTIONS)
+    
+    recent, semantic, prefix = await asyncio.gather(recent_task, semantic_task, prefix_task)
+    fetch_elapsed = time.perf_counter() - fetch_start
+
+    semantic_block = "\n\n".join(
+    f"{mem.text}| Similarity score:{mem.sim} | Temporal relevance: added {time_ago_human(mem.created_at)}, last retrieved {time_ago_human(mem.last_used)}"
+    for mem in semantic
+)
+
+    # 3. Construct the LLM prompt
+    history_block = format_history_block(summary, recent)
+    prompt = f"""**Context:**
 Recent Chat:
 {history_block}
 
@@ -63,55 +123,36 @@ Respond to the user now.
     
     response_start = time.perf_counter()
     # 4. Generate the response
-    response = client.models.generate_content(
-    model="gemini-2.5-flash",
-    contents=prompt
-)
+    response, served_by = await llm_policy.generate("semantic", prompt, prefix=prefix)
 
     response_elapsed = time.perf_counter() - response_start
-    return {'response':response.text.strip(), 'fetch_time':fetch_elapsed, 'response_time': response_elapsed,'embeddings_time':embedding_elapsed, 'memories_retrieved':{'semantic': semantic_block}}
+    return {'response':response.text.strip(), 'fetch_time':fetch_elapsed, 'response_time': response_elapsed,'embeddings_time':embedding_elapsed, 'prompt_tokens': prompt_token_count(response), 'cached_tokens': cached_token_count(response), 'served_by': served_by, 'memories_retrieved':{'semantic': semantic_block}}
 
 
 async def get_bot_response_rfm(redis_manager, user_id: str, user_input: str) -> dict:
     fetch_start = time.perf_counter()
     # 1. Fetch recent chat history
-    recent_task = fetch_last_m_messages(redis_manager.client, user_id, m=10)
+    summary, m = get_conversation_context(redis_manager, user_id)
+    recent_task = fetch_last_m_messages(redis_manager.for_user(user_id), user_id, m=m)
 
     # 2. Fetch top 3 highest RFM score memories
-    rfm_task = get_highest_rfm_memories(redis_manager.client, user_id)
+    rfm_task = get_highest_rfm_memories(redis_manager.for_user(user_id), user_id, mode="rfm")
+    prefix_task = prompt_cache.prefix(redis_manager.for_user(user_id), user_id, "rfm", RFM_INSTRUCTIONS)
     
-    recent, rfm_memories = await asyncio.gather(recent_task, rfm_task)
+    recent, rfm_memories, prefix = await asyncio.gather(recent_task, rfm_task, prefix_task)
     fetch_elapsed = time.perf_counter() - fetch_start
 
     rfm_block = (
-        "\n\n".join(f"{mem['text']} | RFM score:{mem['rfm_score']} "
+        "\n\n".join(f"{mem.text} | RFM score:{mem.rfm_score} "
     for mem in rfm_memories)
         if rfm_memories else "No high-RFM memories available."
     )
 
     # 3. Construct the LLM prompt
-    history_block = "\n\n".join(
-        [f"Timestamp: {r['timestamp']}\nUser: {r['user_message']}\nBot: {r['bot_response']}" for r in recent]
-    )
+    history_block = format_history_block(summary, recent)
 
     # Create RFM-aware prompt
-    prompt = f"""
-You are an engaging, helpful assistant with a strong memory for what matters most to the user. Your responses should be context-aware, specific, and feel genuinely conversational.
-
-**Your personality:** Friendly, supportive, and attentive to details the user cares about.
-
-**Your tools:**
-- High-RFM memories: Use these to understand what is most important and frequently discussed by the user.
-- Recent chat history: Reference previous exchanges to maintain continuity.
-
-**Instructions:**
-- Use high-RFM memories to ground your response in the user's top interests, needs, or concerns.
-- Reference recent chat to maintain flow and context.
-- Be specific, avoid generic statements, and personalize your reply.
-- If appropriate, ask a thoughtful follow-up question or offer a relevant suggestion.
-- Maintain a warm, conversational tone. Do not mention that you are an AI.
-
-**Context:**
+    prompt = f"""**Context:**
 Recent Chat:
 {history_block}
 
@@ -126,12 +167,9 @@ Respond to the user now.
 
     response_start = time.perf_counter()
     # 4. Generate the response
-    response = client.models.generate_content(
-    model="gemini-2.5-flash",
-    contents=prompt
-)
+    response, served_by = await llm_policy.generate("rfm", prompt, prefix=prefix)
     response_elapsed = time.perf_counter() - response_start
-    return {'response':response.text.strip(), 'fetch_time':fetch_elapsed, 'response_time': response_elapsed, 'memories_retrieved':{'rfm': rfm_block}}
+    return {'response':response.text.strip(), 'fetch_time':fetch_elapsed, 'response_time': response_elapsed, 'prompt_tokens': prompt_token_count(response), 'cached_tokens': cached_token_count(response), 'served_by': served_by, 'memories_retrieved':{'rfm': rfm_block}}
 
 
 
@@ -141,58 +179,56 @@ async def get_bot_response_combined(redis_manager, user_id: str, user_input: str
     embedding_elapsed = time.perf_counter() - embedding_time
     fetch_start = time.perf_counter()
     # 1. Fetch recent chat history
-    recent_task = fetch_last_m_messages(redis_manager.client, user_id, m=10)
-    # 2. Fetch top RFM memories
-    rfm_task = get_highest_rfm_memories(redis_manager.client, user_id)
-
-    # 3. Fetch top semantic memories based on current user input
-    semantic_task = get_semantically_similar_memories(redis_manager.client, user_id, input_embedding, cutoff = 0.4)
-    
-    recent, rfm, semantic = await asyncio.gather(recent_task, rfm_task, semantic_task)
+    summary, m = get_conversation_context(redis_manager, user_id)
+    recent_task = fetch_last_m_messages(redis_manager.for_user(user_id), user_id, m=m)
+    prefix_task = prompt_cache.prefix(redis_manager.for_user(user_id), user_id, "rfm-semantic", COMBINED_INSTRUCTIONS)
+    if RFM_SEMANTIC_RETRIEVAL == "hybrid":
+        # 2. One fused ranking over a single KNN candidate set
+        hybrid_task = get_hybrid_memories(redis_manager.for_user(user_id), user_id, input_embedding)
+        recent, hybrid, prefix = await asyncio.gather(recent_task, hybrid_task, prefix_task)
+        fetch_elapsed = time.perf_counter() - fetch_start
+
+        hybrid_block = "\n\n".join(
+            f"{mem.text} | Similarity score:{mem.sim} | RFM score:{mem.rfm_score} | Temporal relevance: added {time_ago_human(mem.created_at)}, last retrieved {time_ago_human(mem.last_used)}"
+            for mem in hybrid
+        ) if hybrid else "No relevant memories available."
+        memories_section = f"Relevant Memories (ranked by similarity, importance and recency):\n{hybrid_block}"
+        memories_retrieved = {'hybrid': hybrid_block}
+    else:
+        # 2. Fetch top RFM memories
+        rfm_task = get_highest_rfm_memories(redis_manager.for_user(user_id), user_id, mode="rfm-semantic")
+
+        # 3. Fetch top semantic memories based on current user input
+        semantic_task = get_semantically_similar_memories(redis_manager.for_user(user_id), user_id, input_embedding, cutoff = 0.4, mode="rfm-semantic")
+
+        recent, rfm, semantic, prefix = await asyncio.gather(recent_task, rfm_task, semantic_task, prefix_task)
+
+        fetch_elapsed = time.perf_counter() - fetch_start
+        # === Format memory blocks ===
+        rfm_block = (
+            "\n\n".join(f"{mem.text} | RFM score:{mem.rfm_score} " for mem in rfm)
+            if rfm else "No high-RFM memories available."
+        )
+
+        semantic_block = "\n\n".join(
+            f"{mem.text}| Similarity score:{mem.sim} | Temporal relevance: added {time_ago_human(mem.created_at)}, last retrieved {time_ago_human(mem.last_used)}"
+            for mem in semantic
+        )
+        memories_section = f"""Semantically Relevant Memories:
+{semantic_block}
 
-    fetch_elapsed = time.perf_counter() - fetch_start
-    # === Format memory blocks ===
-    rfm_block = (
-        "\n\n".join(f"{mem['text']} | RFM score:{mem['rfm_score']} "
-    for mem in rfm)
-        if rfm else "No high-RFM memories available."
-    )
-    
-    semantic_block = "\n\n".join(
-    f"{mem['text']}| Similarity score:{mem['sim']} | Temporal relevance: added {time_ago_human(mem['created_at'])}, last retrieved {time_ago_human(mem['last_used'])}"
-    for mem in semantic
-)
+Important Memories (ranked by Recency, Frequency, Magnitude score):
+{rfm_block}"""
+        memories_retrieved = {'semantic': semantic_block, 'rfm': rfm_block}
 
-    history_block = "\n\n".join(
-        [f"Timestamp: {r['timestamp']}\nUser: {r['user_message']}\nBot: {r['bot_response']}" for r in recent]
-    )
+    history_block = format_history_block(summary, recent)
 
     # Create comprehensive prompt
-    prompt = f"""You are an engaging, friendly, and attentive conversational assistant. Your goal is to provide helpful, specific, and context-aware responses that feel natural and human.
-
-**Your personality:** Curious, empathetic, and adaptive. Match the user's tone and energy. Use humor or encouragement when appropriate.
-
-**Your tools:**
-- Semantically relevant memories: Use these to recall user preferences, experiences, or facts.
-- High-RFM memories: Use these to understand what matters most to the user.
-- Recent chat history: Maintain conversational flow and continuity.
-
-**Instructions:**
-- Reference relevant memories if helpful to personalize your response.
-- Build on the ongoing conversation, referencing previous messages like you are in a conversation.
-- If you’re unsure, ask a clarifying question or offer a thoughtful suggestion.
-- Avoid generic or repetitive answers from recent chat, only build on it; be as specific and vivid as possible.
-- Respond in a warm, conversational tone. Do not mention that you are an AI. Sound like youre speaking in a natural conversation.
-
-**Context:**
+    prompt = f"""**Context:**
 Recent Chat:
 {history_block}
 
-Semantically Relevant Memories:
-{semantic_block}
-
-Important Memories (ranked by Recency, Frequency, Magnitude score):
-{rfm_block}
+{memories_section}
 
 Current User Input:
 {user_input}
@@ -202,12 +238,9 @@ Respond to the user now.
 
     response_start = time.perf_counter()
     # 4. Generate response using Gemini
-    response = client.models.generate_content(
-    model="gemini-2.5-flash",
-    contents=prompt
-)
+    response, served_by = await llm_policy.generate("rfm-semantic", prompt, prefix=prefix)
     response_elapsed = time.perf_counter() - response_start
 
-    return {'response':response.text.strip(), 'fetch_time': fetch_elapsed,'embedding_time':embedding_elapsed, 'response_time':response_elapsed, 'memories_retrieved':{'semantic':semantic_block, 'rfm': rfm_block}}
+    return {'response':response.text.strip(), 'fetch_time': fetch_elapsed,'embedding_time':embedding_elapsed, 'response_time':response_elapsed, 'prompt_tokens': prompt_token_count(response), 'cached_tokens': cached_token_count(response), 'served_by': served_by, 'memories_retrieved': memories_retrieved}
 
     
@@ -0,0 +1,71 @@
+import os
+import time
+import asyncio
+from dotenv import load_dotenv
+
+from . import metrics
+
+load_dotenv()
+
+# A batch is sent when it reaches EMBED_BATCH_MAX texts or when its first text has
+# waited EMBED_BATCH_WAIT_MS, whichever comes first.
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "32"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 100)
+WAIT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding requests from concurrent coroutines and sends them as one
+    multi-content embed call, then fans the vectors back out to each caller.
+
+    `embed_fn` is a blocking callable taking a list of texts and returning one vector
+    per text, in order; it runs in a worker thread.
+    """
+
+    def __init__(self, embed_fn, max_batch=EMBED_BATCH_MAX, max_wait_ms=EMBED_BATCH_WAIT_MS):
+        self.embed_fn = embed_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending = []
+        self._timer = None
+
+    async def embed(self, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((text, fut, time.perf_counter()))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        sent_at = time.perf_counter()
+        metrics.observe("embedding_batch_size", len(batch), buckets=BATCH_SIZE_BUCKETS)
+        for _, _, enqueued_at in batch:
+            metrics.observe("embedding_batch_added_latency_seconds", sent_at - enqueued_at, buckets=WAIT_BUCKETS)
+
+        try:
+            vectors = await asyncio.to_thread(self.embed_fn, [text for text, _, _ in batch])
+            if len(vectors) != len(batch):
+                raise RuntimeError(f"Embedding batch returned {len(vectors)} vectors for {len(batch)} texts")
+        except Exception as e:
+            for _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for (_, fut, _), vector in zip(batch, vectors):
+            if not fut.done():
+                fut.set_result(vector)
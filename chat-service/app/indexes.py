@@ -0,0 +1,218 @@
+import os
+import time
+from dotenv import load_dotenv
+from redis.exceptions import ResponseError
+from redis.commands.search.field import TagField, TextField, NumericField, VectorField
+from redis.commands.search.index_definition import IndexDefinition, IndexType
+
+from .redis_class import epoch_seconds
+from .records import EMB_DIM, EMB_NATIVE_DIM, embedding_field
+
+load_dotenv()
+
+# RediSearch indexes are owned by the service. Queries use the stable names below, which are
+# aliases for versioned physical indexes (e.g. memories_idx -> memories_idx_v2). On startup a
+# missing version is created and backfilled; once it has finished indexing, the alias is moved
+# to it and the old index is dropped (documents are kept).
+# In cluster mode every primary holds its own copy, indexing only its local keys.
+
+MEMORY_INDEX = "memories_idx"
+CHAT_INDEX = "chats_idx"
+INDEX_VERSION = 2
+
+EMBEDDING_DIM = EMB_DIM
+MEMORY_HNSW_M = int(os.getenv("MEMORY_HNSW_M", "16"))
+MEMORY_HNSW_EF_CONSTRUCTION = int(os.getenv("MEMORY_HNSW_EF_CONSTRUCTION", "200"))
+# Candidate list size per KNN query; higher is better recall but slower. Sent per query.
+MEMORY_EF_RUNTIME = int(os.getenv("MEMORY_EF_RUNTIME", "10"))
+INDEXING_TIMEOUT_SEC = 300
+
+
+def memory_schema(m=MEMORY_HNSW_M, ef_construction=MEMORY_HNSW_EF_CONSTRUCTION, dim=EMBEDDING_DIM):
+    return (
+        TagField("user_id", separator=","),
+        TextField("memory_text", weight=1),
+        # Queried as @embedding whichever hash field holds this size
+        VectorField(embedding_field(dim), "HNSW", {
+            "TYPE": "FLOAT32", "DIM": dim, "DISTANCE_METRIC": "COSINE",
+            "M": m, "EF_CONSTRUCTION": ef_construction, "EF_RUNTIME": MEMORY_EF_RUNTIME,
+        }, as_name="embedding"),
+        NumericField("rfm_score", sortable=True),
+        NumericField("magnitude"),
+        NumericField("frequency"),
+        NumericField("created_ts", sortable=True),
+        NumericField("last_used_ts", sortable=True),
+    )
+
+
+def chat_schema():
+    return (
+        TextField("user_message", weight=1),
+        TextField("bot_response", weight=1),
+        TagField("user_id", separator=","),
+        NumericField("timestamp_ts", sortable=True),
+    )
+
+
+# alias -> (key prefix, schema, {epoch field: ISO field} to backfill)
+INDEXES = {
+    MEMORY_INDEX: ("memories:", memory_schema, {"created_ts": "created_at", "last_used_ts": "last_used"}),
+    CHAT_INDEX: ("chat:", chat_schema, {"timestamp_ts": "timestamp"}),
+}
+
+
+def physical_name(alias, version=INDEX_VERSION, dim=EMBEDDING_DIM):
+    # A memory index of a non-native embedding size is a separate index, e.g. memories_idx_v2_d256
+    if alias == MEMORY_INDEX and dim != EMB_NATIVE_DIM:
+        return f"{alias}_v{version}_d{dim}"
+    return f"{alias}_v{version}"
+
+
+def _index_info(client, name):
+    try:
+        return client.ft(name).info()
+    except ResponseError:
+        return None
+
+
+def _info_value(info, field):
+    value = info.get(field) if info else None
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _wait_indexed(client, name, timeout=INDEXING_TIMEOUT_SEC):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = _index_info(client, name)
+        if info and str(_info_value(info, "indexing")) in ("0", "0.0", "None"):
+            return True
+        time.sleep(0.5)
+    return False
+
+
+def backfill_epoch_fields(client, prefix, fields, batch=500):
+    """
+    Add NUMERIC epoch copies of ISO timestamp fields to existing hashes under `prefix`.
+    """
+    epoch_fields, iso_fields = list(fields), list(fields.values())
+    updated = 0
+    keys = []
+
+    def flush():
+        nonlocal updated
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, *iso_fields)
+        values = pipe.execute()
+        pipe = client.pipeline(transaction=False)
+        for key, isos in zip(keys, values):
+            mapping = {}
+            for epoch_field, iso in zip(epoch_fields, isos):
+                ts = epoch_seconds(iso.decode() if iso else None)
+                if ts is not None:
+                    mapping[epoch_field] = ts
+            if mapping:
+                pipe.hset(key, mapping=mapping)
+                updated += 1
+        pipe.execute()
+        keys.clear()
+
+    for key in client.scan_iter(match=f"{prefix}*", count=1000, _type="HASH"):
+        keys.append(key)
+        if len(keys) >= batch:
+            flush()
+    if keys:
+        flush()
+    return updated
+
+
+def truncate_embeddings(client, prefix, dim, source_dim=EMB_NATIVE_DIM, batch=500):
+    """
+    Fill the `dim`-sized embedding field of hashes under `prefix` that lack it, from the
+    leading dimensions of their `source_dim` embedding. Returns the number of hashes filled.
+    """
+    target, source = embedding_field(dim), embedding_field(source_dim)
+    if dim == source_dim:
+        return 0
+    filled = 0
+    keys = []
+
+    def flush():
+        nonlocal filled
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hexists(key, target)
+            pipe.hget(key, source)
+        replies = pipe.execute()
+        pipe = client.pipeline(transaction=False)
+        for key, exists, emb in zip(keys, replies[::2], replies[1::2]):
+            if not exists and emb and len(emb) >= dim * 4:
+                pipe.hset(key, target, emb[:dim * 4])
+                filled += 1
+        pipe.execute()
+        keys.clear()
+
+    for key in client.scan_iter(match=f"{prefix}*", count=1000, _type="HASH"):
+        keys.append(key)
+        if len(keys) >= batch:
+            flush()
+    if keys:
+        flush()
+    return filled
+
+
+def migrate_index(client, alias, prefix, schema, epoch_fields, target=None):
+    """
+    Make `alias` point at the current versioned index. Returns True if one was created.
+    """
+    target = target or physical_name(alias)
+    if _info_value(_index_info(client, alias), "index_name") == target:
+        return False
+
+    created = False
+    if _index_info(client, target) is None:
+        backfilled = backfill_epoch_fields(client, prefix, epoch_fields)
+        try:
+            client.ft(target).create_index(schema(), definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH))
+            created = True
+            print(f"[Indexes] Created {target} ({backfilled} hashes backfilled), indexing...")
+        except ResponseError as e:
+            # Another process starting at the same time got there first
+            print(f"[Indexes] Create {target}: {e}")
+    if not _wait_indexed(client, target):
+        print(f"[Indexes] {target} still indexing after {INDEXING_TIMEOUT_SEC}s; switching anyway")
+
+    try:
+        previous = _info_value(_index_info(client, alias), "index_name")
+        if previous == target:
+            return created
+        if previous == alias:
+            # Pre-versioning physical index with the alias's name: it has to go before the alias exists
+            client.ft(alias).dropindex(delete_documents=False)
+            client.ft(target).aliasadd(alias)
+        elif previous is None:
+            client.ft(target).aliasadd(alias)
+        else:
+            client.ft(target).aliasupdate(alias)
+            client.ft(previous).dropindex(delete_documents=False)
+        print(f"[Indexes] {alias} -> {target}" + (f" (was {previous})" if previous else ""))
+    except ResponseError as e:
+        print(f"[Indexes] Alias {alias} -> {target}: {e}")
+    return created
+
+
+def ensure_indexes(redis_manager):
+    """
+    Create or migrate every index on every primary. Returns the number of indexes created.
+    """
+    created = 0
+    for client in redis_manager.primaries():
+        for alias, (prefix, schema, epoch_fields) in INDEXES.items():
+            if alias == MEMORY_INDEX and _info_value(_index_info(client, alias), "index_name") != physical_name(alias):
+                # Switching embedding size: memories written since migrate_embeddings.py ran
+                # (or all of them, if it was not run) are truncated before the cutover
+                filled = truncate_embeddings(client, prefix, EMBEDDING_DIM)
+                if filled:
+                    print(f"[Indexes] Truncated {filled} embeddings to {EMBEDDING_DIM} dimensions")
+            created += migrate_index(client, alias, prefix, schema, epoch_fields)
+    return created
@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+from collections import deque
+from dotenv import load_dotenv
+from google.genai import types, errors
+
+from . import metrics
+from . import tracing
+
+load_dotenv()
+
+# Chat completions run under a per-mode deadline (LLM_DEADLINE_SEC, overridable per mode
+# as LLM_DEADLINE_<MODE>_SEC, e.g. LLM_DEADLINE_RFM_SEMANTIC_SEC). A second, hedged request
+# to the primary model starts once the first has run for the primary's observed p95, and
+# the fallback model takes over when only LLM_FALLBACK_RESERVE_SEC of the deadline is left.
+LLM_PRIMARY_MODEL = os.getenv("LLM_PRIMARY_MODEL", "gemini-2.5-flash")
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "gemini-2.5-flash-lite")
+LLM_DEADLINE_SEC = float(os.getenv("LLM_DEADLINE_SEC", "12"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_DEFAULT_DELAY_SEC = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_SEC", "4"))
+LLM_FALLBACK_RESERVE_SEC = float(os.getenv("LLM_FALLBACK_RESERVE_SEC", "4"))
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+LLM_LATENCY_BUCKETS = (0.5, 1, 2, 3, 5, 8, 12, 20, 30)
+
+
+def record_token_usage(response, mode):
+    # cached_content_token_count covers explicit caches and Gemini's implicit prefix caching
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    metrics.incr("llm_prompt_tokens_total", usage.prompt_token_count or 0, mode=mode)
+    metrics.incr("llm_cached_tokens_total", usage.cached_content_token_count or 0, mode=mode)
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    def __init__(self, mode, deadline):
+        super().__init__(f"LLM deadline of {deadline:.1f}s exceeded for mode {mode}")
+        self.mode = mode
+        self.deadline = deadline
+
+
+def mode_deadline(mode):
+    return float(os.getenv(f"LLM_DEADLINE_{mode.upper().replace('-', '_')}_SEC", LLM_DEADLINE_SEC))
+
+
+class LatencyTracker:
+    """
+    Sliding window of recent successful call latencies for one model.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def quantile(self, q, default):
+        if len(self.samples) < LATENCY_MIN_SAMPLES:
+            return default
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LLMPolicy:
+    """
+    Runs one generate_content call within a deadline. Up to three attempts race:
+    "primary", "hedge" (same model, started at the primary's p95) and "fallback"
+    (cheaper model, started near the deadline or once every other attempt failed).
+    The first success wins and the rest are cancelled.
+
+    `client` only needs `client.aio.models.generate_content(model=..., contents=...)`,
+    so a fake client can stand in for benchmarks.
+
+    With a `prefix` (prompt_cache.PromptPrefix), attempts on the prefix's model send only
+    `contents` against its cached content; other attempts get the prefix text inline.
+    """
+
+    def __init__(self, client, primary=LLM_PRIMARY_MODEL, fallback=LLM_FALLBACK_MODEL,
+                 hedge=LLM_HEDGE, fallback_reserve=LLM_FALLBACK_RESERVE_SEC):
+        self.client = client
+        self.primary = primary
+        self.fallback = fallback
+        self.hedge = hedge
+        self.fallback_reserve = fallback_reserve
+        self.latency = LatencyTracker()
+
+    def hedge_delay(self):
+        return self.latency.quantile(0.95, LLM_HEDGE_DEFAULT_DELAY_SEC)
+
+    async def _call(self, model, contents, prefix=None):
+        start = time.perf_counter()
+        if prefix is not None and prefix.cached() and model == prefix.model:
+            try:
+                response = await self.client.aio.models.generate_content(
+                    model=model, contents=contents, config=types.GenerateContentConfig(cached_content=prefix.cache_name)
+                )
+            except errors.ClientError:
+                # Expired or deleted under us; the next turn rebuilds it
+                prefix.failed = True
+                raise
+        else:
+            if prefix is not None:
+                contents = f"{prefix.text}\n\n{contents}"
+            response = await self.client.aio.models.generate_content(model=model, contents=contents)
+        return response, time.perf_counter() - start
+
+    async def generate(self, mode, contents, deadline=None, prefix=None):
+        """
+        Returns (response, served_by).
+        """
+        with tracing.span("llm.generate", mode=mode) as attrs:
+            response, served_by = await self._generate(mode, contents, deadline, prefix)
+            attrs["served_by"] = served_by
+        return response, served_by
+
+    async def _generate(self, mode, contents, deadline, prefix=None):
+        deadline = mode_deadline(mode) if deadline is None else deadline
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        hedge_at = start + self.hedge_delay() if self.hedge else None
+        fallback_at = start + max(0.0, deadline - self.fallback_reserve) if self.fallback else None
+        end = start + deadline
+
+        running = {asyncio.ensure_future(self._call(self.primary, contents, prefix)): "primary"}
+        started = {"primary"}
+        last_error = None
+        try:
+            while True:
+                now = loop.time()
+                if hedge_at is not None and now >= hedge_at and "hedge" not in started:
+                    if "fallback" not in started and (fallback_at is None or now < fallback_at):
+                        running[asyncio.ensure_future(self._call(self.primary, contents, prefix))] = "hedge"
+                        started.add("hedge")
+                        metrics.incr("llm_hedge_started_total", mode=mode)
+                if fallback_at is not None and "fallback" not in started and (now >= fallback_at or not running):
+                    running[asyncio.ensure_future(self._call(self.fallback, contents, prefix))] = "fallback"
+                    started.add("fallback")
+                if not running:
+                    raise last_error
+
+                wake = [end]
+                if hedge_at is not None and "hedge" not in started and "fallback" not in started:
+                    wake.append(hedge_at)
+                if fallback_at is not None and "fallback" not in started:
+                    wake.append(fallback_at)
+                timeout = min(wake) - loop.time()
+                if loop.time() >= end:
+                    metrics.incr("llm_deadline_exceeded_total", mode=mode)
+                    raise LLMDeadlineExceeded(mode, deadline)
+
+                done, _ = await asyncio.wait(running, timeout=max(0.0, timeout), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path = running.pop(task)
+                    try:
+                        response, elapsed = task.result()
+                    except Exception as e:
+                        last_error = e
+                        metrics.incr("llm_attempt_failed_total", mode=mode, path=path)
+                        print(f"[LLMPolicy] {path} attempt failed for {mode}: {e}")
+                        continue
+                    if path != "fallback":
+                        self.latency.record(elapsed)
+                    metrics.incr("llm_served_total", mode=mode, path=path)
+                    record_token_usage(response, mode)
+                    metrics.observe("llm_request_seconds", loop.time() - start, buckets=LLM_LATENCY_BUCKETS, mode=mode)
+                    return response, path
+        finally:
+            for task in running:
+                task.cancel()
@@ -0,0 +1,62 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# Spawns a local Redis Cluster of redis-stack nodes (RediSearch loaded) for testing the
+# cluster storage mode. Usage:
+#   python -m app.local_cluster --nodes 3 --base-port 7000
+# then run the services with the printed REDIS_CLUSTER / REDIS_CLUSTER_NODES settings.
+
+
+def start_node(server, port, workdir, module=None):
+    node_dir = os.path.join(workdir, str(port))
+    os.makedirs(node_dir, exist_ok=True)
+    cmd = [
+        server, "--port", str(port), "--cluster-enabled", "yes",
+        "--cluster-config-file", f"nodes-{port}.conf", "--cluster-node-timeout", "5000",
+        "--appendonly", "no", "--save", "", "--dir", node_dir,
+    ]
+    if module:
+        cmd += ["--loadmodule", module]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spawn a local multi-node Redis Cluster")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--base-port", type=int, default=7000)
+    parser.add_argument("--server", default="redis-stack-server",
+                        help="redis-stack-server, or redis-server together with --module")
+    parser.add_argument("--module", help="Path to the RediSearch module when using plain redis-server")
+    args = parser.parse_args()
+
+    if shutil.which(args.server) is None:
+        raise SystemExit(f"{args.server} not found on PATH")
+
+    workdir = tempfile.mkdtemp(prefix="redis-cluster-")
+    ports = [args.base_port + i for i in range(args.nodes)]
+    procs = [start_node(args.server, port, workdir, args.module) for port in ports]
+    try:
+        time.sleep(1.5)
+        subprocess.run(
+            ["redis-cli", "--cluster", "create", *[f"127.0.0.1:{p}" for p in ports],
+             "--cluster-replicas", "0", "--cluster-yes"],
+            check=True,
+        )
+        nodes = ",".join(f"127.0.0.1:{p}" for p in ports)
+        print(f"\nCluster ready ({workdir}). Use:\n  REDIS_CLUSTER=1 REDIS_CLUSTER_NODES={nodes}\nCtrl+C to stop.")
+        for proc in procs:
+            proc.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
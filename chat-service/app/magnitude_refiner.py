@@ -0,0 +1,197 @@
+import os
+import time
+import asyncio
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+from . import metrics
+from .RFM_functions import get_magnitudes_for_queries, get_rfm_score
+from .redis_class import magnitude_pending_key, bump_memory_version
+
+load_dotenv()
+
+# New, merged and overridden memories are written straight away with a provisional
+# magnitude and marked pending. The refiner scores pending memories in batches, one LLM
+# call for up to MAGNITUDE_BATCH_MAX of them, and patches magnitude and rfm_score.
+MAGNITUDE_DEFERRED = os.getenv("MAGNITUDE_DEFERRED", "1") == "1"
+MAGNITUDE_PROVISIONAL = float(os.getenv("MAGNITUDE_PROVISIONAL", "2.5"))  # middle of the 0-5 scale
+MAGNITUDE_BATCH_MAX = int(os.getenv("MAGNITUDE_BATCH_MAX", "16"))
+MAGNITUDE_BATCH_WAIT_SEC = float(os.getenv("MAGNITUDE_BATCH_WAIT_SEC", "2"))
+MAGNITUDE_RETRY_SEC = 30
+# Memories pending for longer than this were lost by some worker (crash, restart) and
+# are picked up by whichever refiner scans next
+MAGNITUDE_RECOVER_SEC = 300
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32)
+PENDING_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 300)
+
+# Patch a memory only if it still exists with the text that was scored. A plain HSET
+# after logout deleted the hash would recreate it with just these two fields.
+PATCH_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'memory_text') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'magnitude', ARGV[2], 'rfm_score', ARGV[3])
+return 1
+"""
+
+
+class MagnitudeRefiner:
+    """
+    Background scorer for memories stored with MAGNITUDE_PROVISIONAL. Every pending
+    memory key is also in its user's sorted set magnitude_pending:{<user_id>}, scored by
+    when it was written, so work lost with a process is found again by `recover`. A patch
+    is only applied if the memory still holds the scored text; a newer text for the same
+    key is queued on its own.
+    """
+
+    def __init__(self, batch_max=MAGNITUDE_BATCH_MAX, wait_sec=MAGNITUDE_BATCH_WAIT_SEC):
+        self.batch_max = max(1, batch_max)
+        self.wait = wait_sec
+        self.redis_manager = None
+        self._queue = None
+        self._tasks = []
+
+    @property
+    def running(self):
+        return bool(self._tasks)
+
+    def start(self, redis_manager):
+        if self.running or not MAGNITUDE_DEFERRED:
+            return
+        self.redis_manager = redis_manager
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._recover_loop())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, user_id, key, text):
+        self._queue.put_nowait((user_id, key, text, time.time()))
+
+    async def _next_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.wait
+        while len(batch) < self.batch_max:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self.refine(batch)
+            except Exception as e:
+                # Still pending in Redis; retried here, or by recovery after a restart
+                print(f"[MagnitudeRefiner] Scoring {len(batch)} memories failed: {e}")
+                metrics.incr("magnitude_refine_failed_total", len(batch))
+                asyncio.get_running_loop().call_later(MAGNITUDE_RETRY_SEC, self._requeue, batch)
+
+    def _requeue(self, batch):
+        for item in batch:
+            self._queue.put_nowait(item)
+
+    async def refine(self, batch, redis_manager=None):
+        redis_manager = redis_manager or self.redis_manager
+        metrics.observe("magnitude_batch_size", len(batch), buckets=BATCH_SIZE_BUCKETS)
+        scores = await get_magnitudes_for_queries([text for _, _, text, _ in batch])
+        now = time.time()
+        patched = 0
+        for (user_id, key, text, submitted_at), magnitude in zip(batch, scores):
+            if magnitude is None:
+                metrics.incr("magnitude_refine_unscored_total")
+                magnitude = MAGNITUDE_PROVISIONAL
+            patched += self._patch(redis_manager, user_id, key, text, magnitude)
+            metrics.observe("magnitude_pending_seconds", now - submitted_at, buckets=PENDING_BUCKETS)
+        metrics.incr("magnitude_refined_total", patched)
+        print(f"[MagnitudeRefiner] Scored {len(batch)} memories in one call, patched {patched}")
+        return patched
+
+    def _patch(self, redis_manager, user_id, key, text, magnitude):
+        client = redis_manager.for_user(user_id)
+        current_text, frequency, last_used = client.hmget(key, "memory_text", "frequency", "last_used")
+        if current_text is not None and current_text.decode() != text:
+            return 0  # rewritten meanwhile; the new text has its own entry
+        patched = 0
+        if current_text is not None:
+            last_used = last_used.decode() if last_used else datetime.now(timezone.utc).isoformat()
+            rfm = get_rfm_score(last_used, int(frequency or 1), magnitude)
+            # Re-checked atomically: the memory may be rewritten or deleted since the HMGET
+            patched = client.eval(PATCH_SCRIPT, 1, key, text, magnitude, rfm)
+        pipe = client.pipeline(transaction=False)
+        if patched:
+            bump_memory_version(pipe, user_id, "stats")
+        pipe.zrem(magnitude_pending_key(user_id), key)
+        pipe.execute()
+        return int(patched)
+
+    async def settle_user(self, redis_manager, user_id):
+        """
+        Score all of a user's pending memories now. Logout awaits this before saving, so
+        provisional magnitudes are not persisted and no pending entry is dropped with the
+        session. Returns the number of memories patched.
+        """
+        client = redis_manager.for_user(user_id)
+        keys = [k.decode() for k in client.zrange(magnitude_pending_key(user_id), 0, -1)]
+        if not keys:
+            return 0
+        now = time.time()
+        texts = client.pipeline(transaction=False)
+        for key in keys:
+            texts.hget(key, "memory_text")
+        batch = []
+        for key, text in zip(keys, texts.execute()):
+            if text is None:
+                client.zrem(magnitude_pending_key(user_id), key)
+            else:
+                batch.append((user_id, key, text.decode(), now))
+        patched = 0
+        for i in range(0, len(batch), self.batch_max):
+            patched += await self.refine(batch[i:i + self.batch_max], redis_manager)
+        return patched
+
+    def find_stale(self, older_than=MAGNITUDE_RECOVER_SEC):
+        """
+        (user_id, key, text) of memories marked pending for more than `older_than` seconds.
+        Their entries are re-stamped, so other refiners scanning meanwhile leave them alone.
+        """
+        found = []
+        cutoff = time.time() - older_than
+        for client in self.redis_manager.primaries():
+            for pending in client.scan_iter(match="magnitude_pending:*", count=1000):
+                pending = pending.decode()
+                user_id = pending[pending.index("{") + 1:pending.index("}")]
+                user_client = self.redis_manager.for_user(user_id)
+                for key in user_client.zrangebyscore(pending, "-inf", cutoff):
+                    key = key.decode()
+                    text = user_client.hget(key, "memory_text")
+                    if text is None:
+                        user_client.zrem(pending, key)
+                        continue
+                    user_client.zadd(pending, {key: time.time()})
+                    found.append((user_id, key, text.decode()))
+        return found
+
+    async def _recover_loop(self):
+        while True:
+            try:
+                stale = await asyncio.to_thread(self.find_stale)
+                for user_id, key, text in stale:
+                    self.submit(user_id, key, text)
+                if stale:
+                    print(f"[MagnitudeRefiner] Recovered {len(stale)} pending memories")
+            except Exception as e:
+                print(f"[MagnitudeRefiner] Recovery failed: {e}")
+            await asyncio.sleep(MAGNITUDE_RECOVER_SEC)
+
+
+refiner = MagnitudeRefiner()
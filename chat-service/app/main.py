@@ -1,21 +1,96 @@
 from dotenv import load_dotenv
 load_dotenv() 
 
-import os, json, pika
-from fastapi import FastAPI
+import os, time, asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from google import genai
-from .chatbot import get_bot_response_from_memory, get_bot_response_rfm, get_bot_response_combined
+from .chatbot import get_bot_response_from_memory, get_bot_response_rfm, get_bot_response_combined, prompt_cache
 from .redis_class import RedisManager
-from supabase import create_client
-from .serialization import is_valid_memory, serialize_memory, serialize_chat
+from .serialization import filter_valid_memories
+from .persistence import get_store
+from .indexes import ensure_indexes
+from contextlib import asynccontextmanager
+from .admission import AdmissionController, AdmissionRejected
+from .llm_policy import LLMDeadlineExceeded
+from .singleflight import SingleFlight, flight_key
+from .transport import get_transport
+from . import metrics
+from . import tracing
+from .profiler import profiler
+from .magnitude_refiner import refiner as magnitude_refiner
 
 redis_manager = RedisManager()
 client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
-rabbit_params = pika.URLParameters(os.getenv("RABBITMQ_URL"))
-supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
-app = FastAPI()
+transport = get_transport(redis_manager)
+store = get_store()
+tracing.configure("chat-api")
+
+
+INDEX_RETRY_SEC = 10
+# Set once ensure_indexes has finished; GET /ready answers 503 until then
+indexes_ready = asyncio.Event()
+
+
+async def prepare_indexes():
+    # In a thread: a migration waits for the new index to finish indexing, and its Redis
+    # calls are blocking, so the event loop keeps serving meanwhile
+    while True:
+        try:
+            created = await asyncio.to_thread(ensure_indexes, redis_manager)
+            break
+        except Exception as e:
+            print(f"[API] Index setup failed, retrying in {INDEX_RETRY_SEC}s: {e}")
+            await asyncio.sleep(INDEX_RETRY_SEC)
+    if created:
+        print(f"[API] Created {created} missing search indexes")
+    indexes_ready.set()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    indexes_task = asyncio.create_task(prepare_indexes())
+    await transport.start()
+    yield
+    indexes_task.cancel()
+    await transport.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+BACKLOG_POLL_SEC = 5
+_backlog_cache = {"value": 0, "checked_at": 0.0}
+
+
+async def memory_task_backlog():
+    # Total messages waiting in memory task queues, refreshed at most every BACKLOG_POLL_SEC
+    now = time.monotonic()
+    if now - _backlog_cache["checked_at"] >= BACKLOG_POLL_SEC:
+        _backlog_cache["checked_at"] = now
+        try:
+            _backlog_cache["value"] = await transport.memory_backlog()
+        except Exception as e:
+            print(f"[Admission] Backlog check failed: {e}")
+    return _backlog_cache["value"]
+
+
+admission = AdmissionController(backlog_fn=memory_task_backlog)
+chat_flights = SingleFlight("chat")
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"error": "Too many requests", "reason": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(LLMDeadlineExceeded)
+async def llm_deadline_handler(request: Request, exc: LLMDeadlineExceeded):
+    return JSONResponse(status_code=504, content={"error": "Response timed out", "mode": exc.mode})
 
 class LoginRequest(BaseModel):
     user_id: str
@@ -26,61 +101,48 @@ class Message(BaseModel):
 
   
 
-async def publish_to_both_queues(user_id: str, user_input: str, bot_reply: str):
-    conn = pika.BlockingConnection(rabbit_params)
-    ch = conn.channel()
-    # Ensure both queues exist
-    memory_queue = f"memory_tasks_user_{user_id}"
-    message_queue = f"message_logs_user_{user_id}"
-
-    ch.queue_declare(queue=memory_queue, durable=True)
-    ch.queue_declare(queue=message_queue, durable=True)
-    task = {
-        "user_id": user_id,
-        "user_message": user_input,
-        "bot_response": bot_reply
-    }
-    
+async def publish_to_both_queues(user_id: str, user_input: str, bot_reply: str, received_at: float = None):
+    # One publish; the transport hands it to both the message-log and memory-task consumers.
+    # The headers carry the trace and the time the chat arrived, for memory freshness lag.
+    headers = {"traceparent": tracing.current_traceparent(), "x-chat-received-at": received_at or time.time()}
+    return await transport.publish(user_id, user_input, bot_reply, headers=headers)
 
-    # Publish to message_logs
-    ch.basic_publish(
-        exchange="",
-        routing_key=message_queue,
-        body=json.dumps(task),
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    # Publish to memory_tasks
-    ch.basic_publish(
-        exchange="",
-        routing_key=memory_queue,
-        body=json.dumps(task),
-        properties=pika.BasicProperties(delivery_mode=2)
-    )
-    conn.close()
+
+async def run_chat(mode: str, responder, msg: Message):
+    """
+    Admit, answer and publish one chat turn. Identical concurrent requests (same user,
+    mode and input, e.g. double-submits or client retries) share one run and one publish.
+    """
+    async def pipeline():
+        received_at = time.time()
+        with tracing.span(f"chat.{mode}", user_id=msg.user_id):
+            async with admission.admit(msg.user_id):
+                start = time.perf_counter()
+                with profiler.profile("chat", mode=mode, user_id=msg.user_id):
+                    response = await responder(redis_manager, msg.user_id, msg.user_input)
+                    with tracing.span("queue.publish"):
+                        await publish_to_both_queues(msg.user_id, msg.user_input, response['response'], received_at)
+                metrics.observe("chat_request_seconds", time.perf_counter() - start, mode=mode)
+        return response
+
+    return await chat_flights.do(flight_key(msg.user_id, mode, msg.user_input), pipeline)
 
 
 @app.post("/chat-semantic")
 async def chat(msg: Message):
     # Generate the bot response
-    response = await get_bot_response_from_memory(redis_manager, msg.user_id, msg.user_input)
-    await publish_to_both_queues(msg.user_id, msg.user_input, response['response'])
-    return response
+    return await run_chat("semantic", get_bot_response_from_memory, msg)
 
 @app.post("/chat-rfm")
 async def chat_rfm_endpoint(msg: Message):
     """Endpoint using only RFM-ranked memories"""
-    response = await get_bot_response_rfm(redis_manager, msg.user_id, msg.user_input)
-    await publish_to_both_queues(msg.user_id, msg.user_input, response['response'])
-    return response
+    return await run_chat("rfm", get_bot_response_rfm, msg)
 
 
 @app.post("/chat-rfm-semantic")
 async def chat_combined_endpoint(msg: Message):
     """Endpoint combining RFM and semantic memories"""
-   
-    response = await get_bot_response_combined(redis_manager, user_id= msg.user_id, user_input= msg.user_input)
-    await publish_to_both_queues(msg.user_id, msg.user_input, response['response'])
-    return response
+    return await run_chat("rfm-semantic", get_bot_response_combined, msg)
 
 
 @app.post("/login")
@@ -88,12 +150,9 @@ async def login(request: LoginRequest):
     user_id = request.user_id
     if not user_id:
         return {"error": "User ID required"}
-    # Fetch from Supabase
-    memories = supabase.table("persona_category").select("*").eq("user_id", user_id).execute().data
-    chats = supabase.table("chat_message_logs").select("*").eq("user_id", user_id).execute().data
-    # Load into Redis
-    redis_manager.load_user_data(user_id, memories, chats)
-    return {"status": "logged_in", "memories_loaded": len(memories), "chats_loaded": len(chats)}
+    # Stream from Supabase/Postgres into Redis
+    memories_loaded, chats_loaded = await store.load_user(redis_manager, user_id)
+    return {"status": "logged_in", "memories_loaded": memories_loaded, "chats_loaded": chats_loaded}
 
 
 @app.post("/logout")
@@ -102,46 +161,61 @@ async def logout(request: LoginRequest):
     if not user_id:
         return {"error": "User ID required"}
 
-    # Fetch all data from Redis
-    raw_memories = redis_manager.get_user_memories(user_id)
-    raw_chats = redis_manager.get_user_chats(user_id)
-
-    # Filter and serialize valid memories
-    serialized_memories = []
-    for raw in raw_memories:
-        if is_valid_memory(raw):
-            mem = serialize_memory(raw)
-            serialized_memories.append(mem)
-    
-    #Serializing chats
-    serialized_chats = []
-    for raw in raw_chats:
-        chat = serialize_chat(raw)
-        serialized_chats.append(chat)        
-
-     # Batch size (adjust as needed)
-    BATCH_SIZE = 100
-
-    # Bulk upsert to Supabase/Postgres in batches
-    def batch_upsert(table_name, data):
-        for i in range(0, len(data), BATCH_SIZE):
-            batch = data[i:i+BATCH_SIZE]
-            supabase.table(table_name).upsert(batch).execute()
-
-    if serialized_memories:
-        batch_upsert("persona_category", serialized_memories)
-    if serialized_chats:
-        batch_upsert("chat_message_logs", serialized_chats)
+    # Memories still waiting for a magnitude are scored first, or they would be saved with
+    # the provisional one for good
+    try:
+        await magnitude_refiner.settle_user(redis_manager, user_id)
+    except Exception as e:
+        metrics.incr("magnitude_logout_unscored_total")
+        print(f"[Logout] {user_id}: scoring pending magnitudes failed, saving provisional ones: {e}")
+
+    # Fetch all data from Redis as typed records
+    memories = redis_manager.get_user_memories(user_id)
+    chats = redis_manager.get_user_chats(user_id)
+
+    # Filter valid memories; the store serializes for its own wire format
+    valid_memories = filter_valid_memories(memories)
+    if memories.skipped or len(valid_memories) < len(memories):
+        print(f"[Logout] {user_id}: {memories.skipped + len(memories) - len(valid_memories)} malformed memories not synced")
+
+    # Bulk upsert to Supabase/Postgres
+    await store.save_user(user_id, valid_memories, chats)
     
-    # Clear Redis
+    # Clear Redis and the session's cached prompt prefixes
     redis_manager.clear_user_data(user_id)
+    await prompt_cache.end_session(user_id)
     return {
         "status": "logged_out",
-        "memories_synced": len(serialized_memories),
-        "chats_synced": len(serialized_chats)
+        "memories_synced": len(valid_memories),
+        "chats_synced": len(chats)
     }
 
 
+@app.get("/debug/profiles")
+async def list_profiles():
+    # Recent slow/sampled request profiles (PROFILE_ENABLED=1), newest first
+    if not profiler.enabled:
+        return JSONResponse(status_code=404, content={"error": "Profiling disabled"})
+    return {"profiles": profiler.list_recent()}
+
+
+@app.get("/debug/profiles/{profile_id}")
+async def get_profile(profile_id: str):
+    # Collapsed stacks, e.g. for `flamegraph.pl` or speedscope
+    profile = profiler.get(profile_id) if profiler.enabled else None
+    if profile is None:
+        return JSONResponse(status_code=404, content={"error": "Profile not found"})
+    return PlainTextResponse(profile["collapsed"] + "\n")
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    Prometheus-format counters and histograms for this API process.
+    """
+    return PlainTextResponse(metrics.render_prometheus())
+
+
 @app.get("/")
 async def root():
     """
@@ -149,3 +223,14 @@ async def root():
     """
     return {"status": "chat service running"}
 
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness check: 200 once the search indexes are set up, 503 while they are still
+    being created or migrated.
+    """
+    if not indexes_ready.is_set():
+        return JSONResponse(status_code=503, content={"status": "preparing indexes"})
+    return {"status": "ready"}
+
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter
+import numpy as np
+from dotenv import load_dotenv
+
+from .redis_class import RedisManager, memory_lock_key, epoch_seconds, bump_memory_version
+from .RFM_functions import get_rfm_scores
+from .persistence import get_store
+from .worker_group import user_lock
+
+load_dotenv()
+
+# Memory compaction for users with a live session in Redis. Near-duplicate memories are
+# folded into their strongest copy, then the lowest-RFM, least recently used memories
+# beyond the per-user cap are retired: removed from Redis and from persona_category, and
+# copied to persona_category_archive first unless MEMORY_COMPACTION_MODE=drop.
+MEMORY_CAP_PER_USER = int(os.getenv("MEMORY_CAP_PER_USER", "500"))  # 0 disables the cap
+MEMORY_COMPACTION_MODE = os.getenv("MEMORY_COMPACTION_MODE", "archive")  # "archive" or "drop"
+MEMORY_COMPACT_DEDUP = os.getenv("MEMORY_COMPACT_DEDUP", "1") == "1"
+# Cosine distance at or below which two memories are the same fact (matches the memory
+# worker's fast-path duplicate threshold), and up to which they are reported as
+# candidates for LLM consolidation.
+MEMORY_COMPACT_DUPLICATE_DISTANCE = float(os.getenv("MEMORY_COMPACT_DUPLICATE_DISTANCE", "0.05"))
+MEMORY_COMPACT_CONSOLIDATE_DISTANCE = float(os.getenv("MEMORY_COMPACT_CONSOLIDATE_DISTANCE", "0.15"))
+COMPACTION_INTERVAL_SEC = int(os.getenv("COMPACTION_INTERVAL_SEC", "3600"))
+SIMILARITY_BLOCK_ROWS = 1024
+
+
+def near_duplicate_pairs(matrix, max_distance, block=SIMILARITY_BLOCK_ROWS):
+    """
+    Every pair (i < j) of rows within `max_distance` cosine distance, as arrays i, j and
+    distance. Similarities come from X @ X.T over unit rows, one block of rows at a time.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    unit = matrix / np.where(norms == 0, 1, norms)
+    min_sim = 1.0 - max_distance
+    found_i, found_j, found_d = [], [], []
+    for start in range(0, len(unit), block):
+        sims = unit[start:start + block] @ unit.T
+        rows, cols = np.nonzero(sims >= min_sim)
+        keep = cols > rows + start
+        rows, cols = rows[keep], cols[keep]
+        found_i.append(rows + start)
+        found_j.append(cols)
+        found_d.append(1.0 - sims[rows, cols])
+    if not found_i:
+        return np.empty(0, int), np.empty(0, int), np.empty(0, np.float32)
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_d)
+
+
+def connected_groups(n, pairs_i, pairs_j):
+    # Union-find over the pairs; groups of two or more, members in index order
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(pairs_i.tolist(), pairs_j.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    groups = {}
+    for x in range(n):
+        groups.setdefault(find(x), []).append(x)
+    return [g for g in groups.values() if len(g) > 1]
+
+
+def plan_compaction(batch, cap=MEMORY_CAP_PER_USER, dedup=MEMORY_COMPACT_DEDUP, now_ts=None,
+                    duplicate_distance=MEMORY_COMPACT_DUPLICATE_DISTANCE,
+                    consolidate_distance=MEMORY_COMPACT_CONSOLIDATE_DISTANCE):
+    """
+    Decide what to do with a user's MemoryBatch without touching Redis. Returns a dict:
+      folds:      [(survivor, [duplicates], frequency, last_used)] near-duplicates to fold
+      evicted:    indexes retired by the cap, lowest RFM and oldest last use first
+      candidates: [[indexes]] similar but distinct memories worth an LLM consolidation
+    """
+    now_ts = now_ts or time.time()
+    n = len(batch)
+    records = batch.records
+    last_used = np.array([epoch_seconds(m.last_used) or 0.0 for m in records], dtype=np.float64)
+    last_used_iso = [m.last_used for m in records]
+    frequency = np.array([m.frequency for m in records], dtype=np.int64)
+    magnitude = np.array([m.magnitude for m in records], dtype=np.float64)
+    rfm = get_rfm_scores(last_used, frequency, magnitude, now_ts)
+    alive = np.ones(n, dtype=bool)
+
+    folds, groups = [], []
+    if dedup and n > 1:
+        pairs_i, pairs_j, dist = near_duplicate_pairs(batch.matrix, max(duplicate_distance, consolidate_distance))
+        dup = dist <= duplicate_distance
+        for group in connected_groups(n, pairs_i[dup], pairs_j[dup]):
+            # Keep the strongest copy; it inherits the others' retrievals
+            survivor = max(group, key=lambda x: (rfm[x], last_used[x]))
+            duplicates = [x for x in group if x != survivor]
+            newest = max(group, key=lambda x: last_used[x])
+            frequency[survivor] = frequency[group].sum()
+            last_used[survivor], last_used_iso[survivor] = last_used[newest], last_used_iso[newest]
+            alive[duplicates] = False
+            folds.append((survivor, duplicates, int(frequency[survivor]), last_used_iso[survivor]))
+        if folds:
+            rfm = get_rfm_scores(last_used, frequency, magnitude, now_ts)
+        groups = connected_groups(n, pairs_i, pairs_j)
+
+    evicted = []
+    if cap and alive.sum() > cap:
+        order = np.lexsort((last_used, rfm))  # by RFM, then by last use
+        order = order[alive[order]]
+        evicted = order[:len(order) - cap].tolist()
+        alive[evicted] = False
+
+    candidates = [[x for x in g if alive[x]] for g in groups]
+    return {
+        "folds": folds,
+        "evicted": evicted,
+        "candidates": [g for g in candidates if len(g) > 1],
+        "rfm": rfm,
+    }
+
+
+def memory_usage(client, keys):
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    return sum(v or 0 for v in pipe.execute()) if keys else 0
+
+
+async def compact_user(redis_manager, store, user_id, cap=MEMORY_CAP_PER_USER, dedup=MEMORY_COMPACT_DEDUP,
+                       archive=MEMORY_COMPACTION_MODE != "drop", dry_run=False):
+    """
+    Compact one user's memories and return a report with before/after sizes.
+    Holds the user's memory lock, so memory workers do not write meanwhile.
+    """
+    client = redis_manager.for_user(user_id)
+    async with user_lock(client, memory_lock_key(user_id)):
+        batch = redis_manager.get_user_memories(user_id)
+        records = batch.records
+        plan = plan_compaction(batch, cap=cap, dedup=dedup)
+        retired = [records[x] for _, duplicates, _, _ in plan["folds"] for x in duplicates]
+        retired += [records[x] for x in plan["evicted"]]
+        before_bytes = memory_usage(client, [m.redis_key for m in records])
+        retired_bytes = memory_usage(client, [m.redis_key for m in retired])
+
+        if retired and not dry_run:
+            # Durable store first: if it fails, Redis is untouched and the next run retries
+            await store.retire_memories(user_id, retired, archive=archive)
+            pipe = client.pipeline(transaction=False)
+            for survivor, _, frequency, last_used in plan["folds"]:
+                mapping = {"frequency": frequency, "last_used": last_used, "rfm_score": float(plan["rfm"][survivor])}
+                ts = epoch_seconds(last_used)
+                if ts is not None:
+                    mapping["last_used_ts"] = ts
+                pipe.hset(records[survivor].redis_key, mapping=mapping)
+            pipe.delete(*[m.redis_key for m in retired])
+            bump_memory_version(pipe, user_id)
+            pipe.execute()
+
+    return {
+        "user_id": user_id,
+        "before": len(records) + batch.skipped,
+        "after": len(records) + batch.skipped - len(retired),
+        "before_bytes": before_bytes,
+        "after_bytes": before_bytes - retired_bytes,
+        "folded": len(retired) - len(plan["evicted"]),
+        "evicted": len(plan["evicted"]),
+        "candidates": [[{"id": records[x].id, "text": records[x].memory_text} for x in g] for g in plan["candidates"]],
+        "dry_run": dry_run,
+    }
+
+
+def active_users(redis_manager):
+    # user_id -> number of memory hashes, for every user with a live session
+    counts = Counter()
+    for client in redis_manager.primaries():
+        for key in client.scan_iter(match="memories:*", count=1000, _type="HASH"):
+            key = key.decode()
+            counts[key[key.index("{") + 1:key.index("}")]] += 1
+    return counts
+
+
+def _mb(n):
+    return f"{n / 2**20:.1f}MB"
+
+
+async def run_once(redis_manager, store, users=None, everyone=False, dry_run=False, candidates_out=None):
+    """
+    Compact the given users, or every active user over the cap (all of them with `everyone`).
+    """
+    if users is None:
+        counts = active_users(redis_manager)
+        users = [u for u, n in counts.items() if everyone or not MEMORY_CAP_PER_USER or n > MEMORY_CAP_PER_USER]
+    totals = Counter()
+    for user_id in users:
+        try:
+            report = await compact_user(redis_manager, store, user_id, dry_run=dry_run)
+        except Exception as e:
+            print(f"[Compaction] {user_id}: failed: {e}")
+            continue
+        for field in ("before", "after", "before_bytes", "after_bytes", "folded", "evicted"):
+            totals[field] += report[field]
+        totals["candidates"] += len(report["candidates"])
+        print(f"[Compaction] {user_id}: {report['before']} -> {report['after']} memories "
+              f"({_mb(report['before_bytes'])} -> {_mb(report['after_bytes'])}), {report['folded']} duplicates folded, "
+              f"{report['evicted']} over cap, {len(report['candidates'])} consolidation candidates"
+              + (" [dry run]" if dry_run else ""))
+        if candidates_out and report["candidates"]:
+            with open(candidates_out, "a") as f:
+                for group in report["candidates"]:
+                    f.write(json.dumps({"user_id": user_id, "memories": group}) + "\n")
+    print(f"[Compaction] {len(users)} users: {totals['before']} -> {totals['after']} memories "
+          f"({_mb(totals['before_bytes'])} -> {_mb(totals['after_bytes'])}), {totals['folded']} folded, "
+          f"{totals['evicted']} over cap, {totals['candidates']} consolidation candidates")
+    return totals
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Retire duplicate and low-RFM memories beyond the per-user cap")
+    parser.add_argument("--user", action="append", help="compact only this user (repeatable)")
+    parser.add_argument("--all", action="store_true", help="compact every active user, not only those over the cap")
+    parser.add_argument("--once", action="store_true", help="run one pass and exit")
+    parser.add_argument("--dry-run", action="store_true", help="report without changing anything")
+    parser.add_argument("--candidates", help="append consolidation candidates to this JSONL file")
+    args = parser.parse_args()
+
+    redis_manager = RedisManager()
+    store = get_store()
+    while True:
+        await run_once(redis_manager, store, users=args.user, everyone=args.all, dry_run=args.dry_run,
+                       candidates_out=args.candidates)
+        if args.once or args.user:
+            return
+        await asyncio.sleep(COMPACTION_INTERVAL_SEC)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
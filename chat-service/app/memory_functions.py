@@ -2,6 +2,7 @@ import os
 import json
 import asyncio
 import numpy as np
+from dataclasses import replace
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from google import genai
@@ -12,12 +13,53 @@ from redis.commands.search.query import Query
 import uuid
 
 from .RFM_functions import get_magnitude_for_query, get_recency_score, get_rfm_score
+from . import metrics
+from . import tracing
+from .singleflight import SingleFlight, flight_key
+from .embedding_batcher import EmbeddingBatcher
+from .redis_class import summary_lock_key, epoch_seconds, bump_memory_version, memory_key, magnitude_pending_key
+from .magnitude_refiner import refiner as magnitude_refiner, MAGNITUDE_PROVISIONAL
+from .indexes import MEMORY_INDEX, CHAT_INDEX, MEMORY_EF_RUNTIME
+from .records import MemoryHit, EMB_DIM, EMB_NATIVE_DIM
+from .retrieval_cache import retrieval_cache, embedding_digest
 
 # Load env variables
 load_dotenv()
 client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
 
+# Rolling summary: raw turns kept verbatim in the prompt, and how many extra turns
+# may accumulate before the message worker folds them into the summary.
+SUMMARY_RECENT_TURNS = int(os.getenv("SUMMARY_RECENT_TURNS", "3"))
+SUMMARY_FOLD_BATCH = int(os.getenv("SUMMARY_FOLD_BATCH", "2"))
+SUMMARY_MAX_HISTORY = 10
+
+# LLM-free memory decisions: cosine distance of the nearest neighbour at or below
+# which a candidate is a duplicate (override), and at or above which it is new (add).
+MEMORY_FAST_PATHS = os.getenv("MEMORY_FAST_PATHS", "1") == "1"
+MEMORY_FAST_ADD_DISTANCE = float(os.getenv("MEMORY_FAST_ADD_DISTANCE", "0.45"))
+MEMORY_FAST_DUPLICATE_DISTANCE = float(os.getenv("MEMORY_FAST_DUPLICATE_DISTANCE", "0.05"))
+# Shadow mode still asks the LLM so its answer can be logged next to the fast path's
+MEMORY_FAST_PATH_SHADOW = os.getenv("MEMORY_FAST_PATH_SHADOW", "0") == "1"
+MEMORY_DECISION_LOG = os.getenv("MEMORY_DECISION_LOG", "")
+
+# Hybrid retrieval for /chat-rfm-semantic: KNN candidate pool size, results kept, and
+# the weights of similarity, normalised RFM score and last-used recency in the fused score.
+HYBRID_TOP_K = int(os.getenv("HYBRID_TOP_K", "5"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+HYBRID_W_SIM = float(os.getenv("HYBRID_W_SIM", "0.6"))
+HYBRID_W_RFM = float(os.getenv("HYBRID_W_RFM", "0.25"))
+HYBRID_W_RECENCY = float(os.getenv("HYBRID_W_RECENCY", "0.15"))
+HYBRID_RECENCY_HALF_LIFE_H = float(os.getenv("HYBRID_RECENCY_HALF_LIFE_H", "72"))
+
+# Chat ids are uuid5(CHAT_ID_NAMESPACE, broker message id)
+CHAT_ID_NAMESPACE = uuid.UUID("5d0c5b8e-3f7a-4c1e-9a57-2b1f0e6c9d41")
+
+# Identical concurrent embedding / memory LLM calls in one process collapse into one
+embedding_flights = SingleFlight("embedding")
+extraction_flights = SingleFlight("extraction")
+memory_update_flights = SingleFlight("memory_update")
+
 def time_ago_human(past_time_str, now=None):
     now = now or datetime.now(timezone.utc)
     past_time = datetime.fromisoformat(past_time_str.replace('Z', '+00:00'))
@@ -47,8 +89,8 @@ async def fetch_last_m_messages(redis_client, user_id, m=5):
     """
     # Corrected query string: use actual variable interpolation
     query_str = f"@user_id:{{{user_id}}}"
-    query = Query(query_str).sort_by("timestamp", asc=False).paging(0, m)
-    res = redis_client.ft("chats_idx").search(query)
+    query = Query(query_str).sort_by("timestamp_ts", asc=False).paging(0, m)
+    res = redis_client.ft(CHAT_INDEX).search(query)
     
     now = datetime.now(timezone.utc)
     messages = []
@@ -59,6 +101,59 @@ async def fetch_last_m_messages(redis_client, user_id, m=5):
     return messages
 
 
+def get_conversation_context(redis_manager, user_id):
+    """
+    Return the user's rolling summary and how many raw turns the prompt still needs
+    so that no exchange falls between the summary and the recent chat window.
+    """
+    summary, pending = redis_manager.get_summary_context(user_id)
+    m = min(max(SUMMARY_RECENT_TURNS, pending), SUMMARY_MAX_HISTORY)
+    return summary, m
+
+
+async def update_rolling_summary(redis_manager, user_id: str) -> bool:
+    """
+    Fold turns that scrolled out of the raw window into the rolling summary.
+    Only the existing summary and the new turns are sent to the LLM.
+    """
+    _, pending = redis_manager.get_summary_context(user_id)
+    if pending < SUMMARY_RECENT_TURNS + SUMMARY_FOLD_BATCH:
+        return False
+
+    # One folder per user at a time; a skipped fold is retried on the next logged turn
+    lock_key = summary_lock_key(user_id)
+    if not redis_manager.for_user(user_id).set(lock_key, 1, nx=True, ex=60):
+        return False
+    try:
+        summary, pending = redis_manager.get_summary_context(user_id)
+        fold_n = pending - SUMMARY_RECENT_TURNS
+        if fold_n <= 0:
+            return False
+        turns = redis_manager.get_summary_turns(user_id, fold_n)
+        turns_block = "\n\n".join(f"User: {t['user_message']}\nBot: {t['bot_response']}" for t in turns)
+        prompt = f"""
+You maintain a running summary of a conversation between a user and a chatbot.
+
+CURRENT SUMMARY:
+{summary or "(empty)"}
+
+NEW EXCHANGES (oldest first):
+{turns_block}
+
+Update the summary to include the new exchanges. Keep topics, facts, open questions and
+the user's tone; drop greetings and filler. Write at most 6 short sentences, third person.
+
+UPDATED SUMMARY:
+"""
+        result = await asyncio.to_thread(
+            client.models.generate_content, model="gemini-2.5-flash", contents=prompt
+        )
+        redis_manager.set_summary(user_id, result.text.strip(), fold_n)
+        return True
+    finally:
+        redis_manager.for_user(user_id).delete(lock_key)
+
+
 async def summarize_user_memories(user_id: str) -> str:
     """
     Summarize existing user memories into a concise overview.
@@ -88,12 +183,23 @@ async def get_embedding(text: str) -> list[float]:
     """
     Generate a vector embedding for the given text.
     """
+    return await embedding_flights.do(flight_key(text), lambda: embedding_batcher.embed(text))
+
+
+def embed_batch(texts: list[str], dim: int = EMB_DIM) -> list[list[float]]:
+    # One embed call for a whole batch; vectors come back in input order
     embed_res = client.models.embed_content(
         model="text-embedding-004",
-        contents=text,
-        config=types.EmbedContentConfig(task_type="RETRIEVAL_DOCUMENT")
+        contents=texts,
+        config=types.EmbedContentConfig(
+            task_type="RETRIEVAL_DOCUMENT",
+            output_dimensionality=dim if dim != EMB_NATIVE_DIM else None,
+        )
     )
-    return embed_res.embeddings[0].values if embed_res.embeddings else []
+    return [e.values for e in (embed_res.embeddings or [])]
+
+
+embedding_batcher = EmbeddingBatcher(embed_batch)
 
 def cosine_similarity(a: list[float], b: list[float]) -> float:
     """
@@ -105,7 +211,7 @@ def cosine_similarity(a: list[float], b: list[float]) -> float:
     return float(np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
 
 async def get_semantically_similar_memories(
-    redis_client, user_id, input_embedding, k=3, bump_metadata=True, cutoff = 0.7
+    redis_client, user_id, input_embedding, k=3, bump_metadata=True, cutoff = 0.7, ef_runtime=None, mode="default"
 ):
     """
     Retrieve top-k semantically similar memories for a user from Redis.
@@ -117,20 +223,36 @@ async def get_semantically_similar_memories(
         k (int): How many results to return
         bump_metadata (bool): Increment frequency/set last_used if True
         cutoff (float or None): Skip results with distance > cutoff (if set)
+        ef_runtime (int or None): HNSW candidate list size for this query (default MEMORY_EF_RUNTIME)
+        mode (str): Caller label for the retrieval cache hit ratio
     Returns:
-        List of dicts: Each with id, text, sim, created_at, last_used
+        List of MemoryHit with id, text, sim, created_at, last_used
     """
     # Ensure correct embedding dtype and shape
     vec = np.array(input_embedding, dtype=np.float32)
-    if vec.shape[0] != 768:
-        raise ValueError(f"Embedding must be length 768, got {vec.shape}")
+    if vec.shape[0] != EMB_DIM:
+        raise ValueError(f"Embedding must be length {EMB_DIM}, got {vec.shape}")
+
+    # Which memories match depends only on their content; without a bump the returned
+    # last_used does too, so those lookups also key on the stats version
+    version = retrieval_cache.version(redis_client, user_id)
+    if version is not None:
+        cache_key = ("knn", user_id, version[0] if bump_metadata else version, embedding_digest(vec), k, cutoff, ef_runtime)
+        cached = retrieval_cache.get(cache_key, "knn", mode)
+        if cached is not None:
+            if not bump_metadata:
+                return list(cached)
+            now_iso = datetime.now(timezone.utc).isoformat()
+            results = [replace(r, last_used=now_iso) for r in cached]
+            bump_access_stats(redis_client, user_id, [r.id for r in results], now_iso)
+            return results
 
     # Build RediSearch KNN query with user filter
-    query_str = f"@user_id:{{{user_id}}}=>[KNN {k} @embedding $vec as score]"
-    params = {"vec": vec.tobytes()}
+    query_str = f"@user_id:{{{user_id}}}=>[KNN {k} @embedding $vec EF_RUNTIME $ef as score]"
+    params = {"vec": vec.tobytes(), "ef": ef_runtime or MEMORY_EF_RUNTIME}
     query = (
         Query(query_str)
-        .return_fields("id", "memory_text", "score", "created_at", "last_used")
+        .return_fields("id", "memory_text", "score", "created_at", "last_used", "frequency", "magnitude")
         .sort_by("score", asc=True)
         .paging(0, k)
         .dialect(2)
@@ -138,52 +260,157 @@ async def get_semantically_similar_memories(
 
     # Execute the search (in a thread for async compatibility)
     res = await asyncio.to_thread(
-        redis_client.ft("memories_idx").search, query, query_params=params
+        redis_client.ft(MEMORY_INDEX).search, query, query_params=params
     )
     now_iso = datetime.now(timezone.utc).isoformat()
     results = []
+    known_stats = {}
     for doc in res.docs:
         sim_score = float(doc.score)
         if cutoff is not None and sim_score > cutoff:
             continue
-        key = f"memories:{user_id}:{doc.id}"
-        if bump_metadata:
-            redis_client.hincrby(key, "frequency", 1)
-            redis_client.hset(key, "last_used", now_iso)
-            try:
-                freq = int(redis_client.hget(key, "frequency"))
-            except:
-                freq = 5    
-            try:
-                magnitude = float(redis_client.hget(key, "magnitude"))
-            except (TypeError, ValueError):
-                magnitude = 1.0
-            recency_timestamp = now_iso
-            rfm_score = get_rfm_score(recency_timestamp, freq, magnitude)
-            redis_client.hset(key, "rfm_score", rfm_score)
-
-
-        results.append({
-            "id": getattr(doc, "id", None),
-            "text": getattr(doc, "memory_text", None),
-            "sim": sim_score,
-            "created_at": getattr(doc, "created_at", None),
-            "last_used": now_iso if bump_metadata else getattr(doc, "last_used", None)
+        known_stats[doc.id] = (getattr(doc, "frequency", None), getattr(doc, "magnitude", None))
+        results.append(MemoryHit(
+            id=doc.id,
+            text=getattr(doc, "memory_text", None),
+            sim=sim_score,
+            created_at=getattr(doc, "created_at", None),
+            last_used=now_iso if bump_metadata else getattr(doc, "last_used", None),
+        ))
+    if version is not None:
+        retrieval_cache.put(cache_key, tuple(results))
+    if bump_metadata:
+        bump_access_stats(redis_client, user_id, [r.id for r in results], now_iso, known_stats)
+    return results
+
+
+def bump_access_stats(redis_client, user_id, keys, now_iso, known_stats=None):
+    """
+    Record a retrieval for each memory key: frequency+1, last_used=now and a fresh RFM score,
+    then bump the user's stats version. `known_stats` maps key -> (frequency, magnitude)
+    when the caller already has them.
+    """
+    if not keys:
+        return
+    if known_stats is None:
+        pipe = redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, "frequency", "magnitude")
+        known_stats = {}
+        for key, (freq, magnitude) in zip(keys, pipe.execute()):
+            known_stats[key] = (freq, magnitude)
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        freq, magnitude = known_stats.get(key, (None, None))
+        try:
+            freq = int(freq) + 1
+        except (TypeError, ValueError):
+            freq = 5
+        try:
+            magnitude = float(magnitude)
+        except (TypeError, ValueError):
+            magnitude = 1.0
+        pipe.hincrby(key, "frequency", 1)
+        pipe.hset(key, mapping={
+            "last_used": now_iso, "last_used_ts": epoch_seconds(now_iso), "rfm_score": get_rfm_score(now_iso, freq, magnitude),
         })
+    bump_memory_version(pipe, user_id, "stats")
+    pipe.execute()
+
+
+async def get_hybrid_memories(
+    redis_client, user_id, input_embedding, k=HYBRID_TOP_K, candidates=HYBRID_CANDIDATES,
+    weights=None, bump_metadata=True, ef_runtime=None
+):
+    """
+    Single fused ranking of similarity, RFM and recency for /chat-rfm-semantic.
+    One KNN query fetches a candidate pool with its RFM fields, which is reranked in NumPy,
+    so a memory can only appear once and the separate RFM search is not needed.
+
+    Returns:
+        List of MemoryHit with id, text, sim, rfm_score, score, created_at, last_used
+    """
+    w_sim, w_rfm, w_recency = weights or (HYBRID_W_SIM, HYBRID_W_RFM, HYBRID_W_RECENCY)
+    vec = np.array(input_embedding, dtype=np.float32)
+    if vec.shape[0] != EMB_DIM:
+        raise ValueError(f"Embedding must be length {EMB_DIM}, got {vec.shape}")
+
+    query_str = f"@user_id:{{{user_id}}}=>[KNN {candidates} @embedding $vec EF_RUNTIME $ef as score]"
+    query = (
+        Query(query_str)
+        .return_fields("memory_text", "score", "rfm_score", "frequency", "magnitude", "created_at", "last_used", "last_used_ts")
+        .sort_by("score", asc=True)
+        .paging(0, candidates)
+        .dialect(2)
+    )
+    res = await asyncio.to_thread(
+        redis_client.ft(MEMORY_INDEX).search, query,
+        query_params={"vec": vec.tobytes(), "ef": max(ef_runtime or MEMORY_EF_RUNTIME, candidates)}
+    )
+    docs = res.docs
+    if not docs:
+        return []
+
+    now = datetime.now(timezone.utc)
+    dist = np.fromiter((float(d.score) for d in docs), dtype=np.float32, count=len(docs))
+    rfm = np.fromiter((_to_float(getattr(d, "rfm_score", None)) for d in docs), dtype=np.float32, count=len(docs))
+    # Age from the NUMERIC epoch copy; a memory without one counts as never used
+    last_ts = np.fromiter((_to_float(getattr(d, "last_used_ts", None), np.nan) for d in docs), dtype=np.float64, count=len(docs))
+    age_h = np.where(np.isnan(last_ts), 1e6, np.maximum(now.timestamp() - last_ts, 0.0) / 3600).astype(np.float32)
+
+    sim = np.clip(1.0 - dist, 0.0, 1.0)
+    rfm_norm = rfm / rfm.max() if rfm.max() > 0 else rfm
+    recency = np.exp2(-age_h / HYBRID_RECENCY_HALF_LIFE_H)
+    fused = w_sim * sim + w_rfm * rfm_norm + w_recency * recency
+    order = np.argsort(-fused)[:k]
+
+    now_iso = now.isoformat()
+    results = []
+    for i in order:
+        doc = docs[i]
+        results.append(MemoryHit(
+            id=doc.id,
+            text=getattr(doc, "memory_text", None),
+            sim=float(doc.score),
+            rfm_score=float(rfm[i]),
+            score=round(float(fused[i]), 4),
+            created_at=getattr(doc, "created_at", None),
+            last_used=now_iso if bump_metadata else getattr(doc, "last_used", None),
+        ))
+    if bump_metadata:
+        bump_access_stats(
+            redis_client, user_id, [r.id for r in results], now_iso,
+            known_stats={docs[i].id: (getattr(docs[i], "frequency", None), getattr(docs[i], "magnitude", None)) for i in order},
+        )
     return results
 
 
-async def get_highest_rfm_memories(redis_client, user_id, k=3):
+def _to_float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+async def get_highest_rfm_memories(redis_client, user_id, k=3, mode="default"):
+    # RFM scores move with access stats, so the cached ranking keys on both versions
+    version = retrieval_cache.version(redis_client, user_id)
+    if version is not None:
+        cache_key = ("rfm", user_id, version, k)
+        cached = retrieval_cache.get(cache_key, "rfm", mode)
+        if cached is not None:
+            return list(cached)
+
     query = f"@user_id:{{{user_id}}}"
     query = Query(query).sort_by("rfm_score", asc=False).paging(0, k)
-    res = redis_client.ft("memories_idx").search(query)
-    results = []
-    for doc in res.docs:
-        results.append({
-            "id": doc.id,
-            "text": doc.memory_text,
-            "rfm_score": float(doc.rfm_score) if hasattr(doc, 'rfm_score') else None
-        })
+    res = redis_client.ft(MEMORY_INDEX).search(query)
+    results = [
+        MemoryHit(id=doc.id, text=doc.memory_text, rfm_score=_to_float(getattr(doc, "rfm_score", None), None))
+        for doc in res.docs
+    ]
+    if version is not None:
+        retrieval_cache.put(cache_key, tuple(results))
     return results
 
 
@@ -196,7 +423,13 @@ async def generate_candidate_memories(
     """
     Extract new memories from recent conversation if they contain novel insights.
     """
-    
+    return await extraction_flights.do(
+        flight_key(user_id, user_msg, bot_resp),
+        lambda: _extract_candidate_memories(user_msg, bot_resp),
+    )
+
+
+async def _extract_candidate_memories(user_msg: str, bot_resp: str) -> list[str]:
     prompt = f"""
 You are a **Memory Extraction Engine**.
 
@@ -226,24 +459,97 @@ OUTPUT:
         return []
     return [line.strip("- ").strip() for line in text.split("\n") if line.strip()]
 
+async def generate_candidate_memories_batch(user_id: str, turns: list) -> list[str]:
+    """
+    Extract memories from several consecutive exchanges of one user in a single LLM
+    call. `turns` is a list of (user_msg, bot_resp), oldest first.
+    """
+    metrics.incr("extraction_turns_total", len(turns))
+    metrics.incr("extraction_llm_calls_total")
+    metrics.incr("extraction_calls_saved_total", len(turns) - 1)
+    with tracing.span("memory.extraction", turns=len(turns)) as attrs:
+        if len(turns) == 1:
+            candidates = await generate_candidate_memories(user_id, *turns[0])
+        else:
+            candidates = await extraction_flights.do(
+                flight_key(user_id, *[part for turn in turns for part in turn]),
+                lambda: _extract_candidate_memories_batch(turns),
+            )
+        attrs["candidates"] = len(candidates)
+    return candidates
+
+
+async def _extract_candidate_memories_batch(turns: list) -> list[str]:
+    exchanges = "\n\n".join(
+        f"[{i}] User: {user_msg}\n    Bot : {bot_resp}" for i, (user_msg, bot_resp) in enumerate(turns, 1)
+    )
+    prompt = f"""
+You are a **Memory Extraction Engine**.
+
+TASK ─ Identify **0-2 NEW** user memories per exchange, found *only* in the consecutive exchanges below (oldest first).
+
+RULES
+• Start each memory with “- ”.  
+• Around **15 words** per memory, third-person, about the *user*.  
+• Include specific nouns, verbs, and context words from user's messages for better retrieval in the future.  
+• If a later exchange updates or repeats an earlier one, output only the latest version once.  
+• Skip if nothing new → output single line: **- None**
+
+CURRENT EXCHANGES (ON WHICH YOU ARE SUPPOSED TO GENERATE MEMORIES ON)
+{exchanges}
+
+EXAMPLE OUTPUT 
+- Memory one.
+- Memory two.
+
+OUTPUT: 
+"""
+
+    resp = await asyncio.to_thread(client.models.generate_content, model="gemini-2.5-flash", contents=prompt)
+    text = resp.text.strip()
+    if text.lower() in ("none", "- none"):
+        return []
+    return [line.strip("- ").strip() for line in text.split("\n") if line.strip() and line.strip("- ").strip().lower() != "none"]
+
 def clean_mem_id(mem_id):
     return mem_id[-36:]
 
 
-async def update_user_memory(redis_manager, candidate: str, user_id: str, user_msg: str, bot_resp: str) -> str:
+def fast_path_decision(sims, add_distance=None, duplicate_distance=None):
     """
-    Decide add/merge/override and update Redis accordingly.
-    All operations happen in Redis during the session.
+    Decide add/override from KNN distances alone when the answer is obvious.
+    `sims` are sorted by cosine distance. Returns (decision, path), or (None, None)
+    when the LLM has to decide.
     """
+    add_distance = MEMORY_FAST_ADD_DISTANCE if add_distance is None else add_distance
+    duplicate_distance = MEMORY_FAST_DUPLICATE_DISTANCE if duplicate_distance is None else duplicate_distance
+    if not sims:
+        return "add", "fast_add_no_neighbors"
+    nearest = sims[0].sim
+    if nearest <= duplicate_distance:
+        return "override:1", "fast_override_duplicate"
+    if nearest >= add_distance:
+        return "add", "fast_add_far"
+    return None, None
+
+
+def log_memory_decision(user_id, candidate, sims, llm_decision, fast_decision):
+    # Append-only JSONL of LLM decisions, replayed offline by replay_memory_decisions
+    if not MEMORY_DECISION_LOG:
+        return
+    record = {
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "user_id": user_id,
+        "candidate": candidate,
+        "neighbors": [{"id": sim.id, "text": sim.text, "sim": sim.sim} for sim in sims],
+        "llm_decision": llm_decision,
+        "fast_decision": fast_decision,
+    }
+    with open(MEMORY_DECISION_LOG, "a") as f:
+        f.write(json.dumps(record) + "\n")
 
-    context_pair = f"User: {user_msg}\nBot: {bot_resp}"
-    now = datetime.now(timezone.utc).isoformat()
-    emb = await get_embedding(candidate)
-    sims = await get_semantically_similar_memories(redis_manager.client, user_id, emb, k=3, bump_metadata=False)
 
-    
-    alias = {str(i+1): sim["id"] for i, sim in enumerate(sims)}
-     
+async def llm_memory_decision(candidate: str, sims: list, context_pair: str) -> str:
     prompt = f"""
 You are a Memory Manager for a chatbot service. Your job is to decide how to integrate a new candidate memory into a chatbot's existing memories. Base your decision solely on the content and meaning of the memories, and on relative semantic similarity scores.
 
@@ -255,7 +561,7 @@ INPUTS:
   "{candidate}"
 
 • Existing semantically similarmemories (up to 5):
-{chr(10).join(f"Index: {i+1} | Text: {sim['text']} | Similarity: {sim['sim']}" for i, sim in enumerate(sims))}
+{chr(10).join(f"Index: {i+1} | Text: {sim.text} | Similarity: {sim.sim}" for i, sim in enumerate(sims))}
 
 DECISION RULES:
 1. OVERRIDE if it fully duplicates or directly contradicts an existing memory.
@@ -277,16 +583,50 @@ override:3
 Do not deviate from this formatting as it will result in your system failing.
 """
 
-    dec = client.models.generate_content(
+    return client.models.generate_content(
         model="gemini-2.5-flash",
         contents=prompt
     ).text.strip().lower()
 
+
+async def update_user_memory(redis_manager, candidate: str, user_id: str, user_msg: str, bot_resp: str) -> str:
+    """
+    Decide add/merge/override and update Redis accordingly.
+    All operations happen in Redis during the session.
+    """
+    # Sharing the whole decide-and-write step (not just the LLM decision) keeps a
+    # duplicated task from applying the same add or merge twice.
+    return await memory_update_flights.do(
+        flight_key(user_id, candidate),
+        lambda: _update_user_memory(redis_manager, candidate, user_id, user_msg, bot_resp),
+    )
+
+
+async def _update_user_memory(redis_manager, candidate: str, user_id: str, user_msg: str, bot_resp: str) -> str:
+
+    context_pair = f"User: {user_msg}\nBot: {bot_resp}"
+    now = datetime.now(timezone.utc).isoformat()
+    with tracing.span("memory.embedding"):
+        emb = await get_embedding(candidate)
+    with tracing.span("memory.decision") as attrs:
+        sims = await get_semantically_similar_memories(redis_manager.for_user(user_id), user_id, emb, k=3, bump_metadata=False, mode="memory_worker")
+
+        alias = {str(i+1): sim.id for i, sim in enumerate(sims)}
+
+        dec, path = fast_path_decision(sims) if MEMORY_FAST_PATHS else (None, None)
+        if dec is None or MEMORY_FAST_PATH_SHADOW:
+            llm_dec = await llm_memory_decision(candidate, sims, context_pair)
+            log_memory_decision(user_id, candidate, sims, llm_dec, dec)
+            if dec is None:
+                dec, path = llm_dec, "llm"
+        attrs.update(decision=dec, path=path)
+    metrics.incr("memory_decision_total", path=path)
+
     if dec == "None":
         return "Redundant, no memory update."
     
     elif dec == "add":
-        magnitude = await get_magnitude_for_query(candidate)
+        magnitude, deferred = await _magnitude_now_or_later(candidate)
         rfm = get_rfm_score(now, frequency=1, magnitude=magnitude)
         emb_bytes = np.array(emb, dtype=np.float32).tobytes()
         mem_id = str(uuid.uuid4())
@@ -302,7 +642,8 @@ Do not deviate from this formatting as it will result in your system failing.
             "created_at": now
         }
 
-        redis_manager.store_memory(user_id, mem_id, memory_dict)
+        with tracing.span("memory.redis_write", action="add"):
+            _write_memory(redis_manager, user_id, memory_dict, deferred)
         return "Memory added."
         
     elif dec.startswith("merge:"):
@@ -311,27 +652,28 @@ Do not deviate from this formatting as it will result in your system failing.
         for idx in idxs:
             mem_id = alias.get(idx)
             
-            current_mem = redis_manager.client.hgetall(f"{mem_id}")
+            current_mem = redis_manager.for_user(user_id).hgetall(f"{mem_id}")
             
             current_text = str(current_mem[b'memory_text'].decode('utf-8'))
             current_freq = int(current_mem[b'frequency'].decode('utf-8'))
             
             merged_text = await llm_consolidate(current_text, candidate)
             emb_new = await get_embedding(merged_text)
-            magnitude = await get_magnitude_for_query(merged_text)
+            magnitude, deferred = await _magnitude_now_or_later(merged_text)
             rfm = get_rfm_score(now, frequency=current_freq + 1, magnitude=magnitude)
             memory_dict = {
                 "id": clean_mem_id(mem_id),
                 "user_id": user_id,
                 "memory_text": merged_text,
-                "embedding": emb,
+                "embedding": emb_new,
                 "magnitude": magnitude,
                 "last_used": now,
                 "frequency": current_freq + 1,
                 "rfm_score": rfm,
             }
             
-            redis_manager.store_memory(user_id, memory_dict["id"], memory_dict)
+            with tracing.span("memory.redis_write", action=dec.split(":")[0]):
+                _write_memory(redis_manager, user_id, memory_dict, deferred)
             merged_log += f"Memory ID {mem_id} {current_text[:15]} modified to {merged_text[:15]}\n"
         return f"Total {len(idxs)} memories merged for {user_id}:\n" + merged_log  
 
@@ -340,11 +682,14 @@ Do not deviate from this formatting as it will result in your system failing.
         override_log = ""
         for idx in idxs:
             mem_id = alias.get(idx)
-            current_mem = redis_manager.client.hgetall(f"{mem_id}")
+            current_mem = redis_manager.for_user(user_id).hgetall(f"{mem_id}")
             current_text = str(current_mem[b'memory_text'].decode('utf-8'))
 
             current_freq = int(current_mem[b'frequency'].decode('utf-8'))
-            magnitude = await get_magnitude_for_query(candidate)
+            # The same fact restated: the existing magnitude stands, only merges are rescored
+            magnitude, deferred = _kept_magnitude(redis_manager, user_id, mem_id, current_mem)
+            if magnitude is None:
+                magnitude, deferred = await _magnitude_now_or_later(candidate)
             rfm = get_rfm_score(now, frequency=current_freq + 1, magnitude=magnitude)
 
             memory_dict = {
@@ -357,7 +702,8 @@ Do not deviate from this formatting as it will result in your system failing.
                 "frequency": current_freq + 1,
                 "rfm_score": rfm,
             }
-            redis_manager.store_memory(user_id, memory_dict["id"], memory_dict)
+            with tracing.span("memory.redis_write", action=dec.split(":")[0]):
+                _write_memory(redis_manager, user_id, memory_dict, deferred)
             override_log += f"Memory ID {mem_id} {current_text[:15]} overriden to {candidate[:15]}\n"
         return f"Total {len(idxs)} overriden for {user_id}:\n" + override_log        
     
@@ -365,6 +711,36 @@ Do not deviate from this formatting as it will result in your system failing.
 
 
 
+async def _magnitude_now_or_later(text):
+    # (magnitude, deferred): provisional while the refiner runs, so the write is not held up
+    if magnitude_refiner.running:
+        return MAGNITUDE_PROVISIONAL, True
+    return await get_magnitude_for_query(text), False
+
+
+def _kept_magnitude(redis_manager, user_id, mem_id, current_mem):
+    # (magnitude, deferred) carried over from the memory being overridden. One still
+    # pending keeps its provisional value and is queued again with the new text.
+    raw = current_mem.get(b'magnitude')
+    if raw is None:
+        return None, False
+    key = memory_key(user_id, clean_mem_id(mem_id))
+    pending = redis_manager.for_user(user_id).zscore(magnitude_pending_key(user_id), key) is not None
+    return float(raw.decode('utf-8')), pending and magnitude_refiner.running
+
+
+def _write_memory(redis_manager, user_id, memory_dict, deferred):
+    if not deferred:
+        redis_manager.store_memory(user_id, memory_dict["id"], memory_dict)
+        return
+    key = memory_key(user_id, memory_dict["id"])
+    pipe = redis_manager.for_user(user_id).pipeline(transaction=False)
+    redis_manager.store_memory(user_id, memory_dict["id"], memory_dict, pipe=pipe)
+    pipe.zadd(magnitude_pending_key(user_id), {key: datetime.now(timezone.utc).timestamp()})
+    pipe.execute()
+    magnitude_refiner.submit(user_id, key, memory_dict["memory_text"])
+
+
 async def llm_consolidate(memory: str, candidate: str) -> str:
     prompt = f"""
         You are a Memory Consolidation Agent. Your task is to merge a related user memory
@@ -386,13 +762,16 @@ Merged memory (must contain all important keywords):
     res = client.models.generate_content(model="gemini-2.5-flash", contents=prompt)
     return res.text.strip()
 
-async def log_message(redis_manager, user_id: str, user_input: str, bot_response: str):
+async def log_message(redis_manager, user_id: str, user_input: str, bot_response: str, message_id=None, produced_at=None):
     """
-    Persist every user-bot exchange chronologically in Redis.
+    Persist every user-bot exchange chronologically in Redis. Returns False if the
+    message id was logged before.
     """
-    # Generate a unique chat ID
-    chat_id = str(uuid.uuid4())
-    timestamp = datetime.now(timezone.utc).isoformat()
+    # Derive the chat ID from the broker message id, so a redelivered turn overwrites
+    # the same record instead of adding a duplicate
+    chat_id = str(uuid.uuid5(CHAT_ID_NAMESPACE, message_id)) if message_id else str(uuid.uuid4())
+    produced = datetime.fromtimestamp(produced_at, timezone.utc) if produced_at else datetime.now(timezone.utc)
+    timestamp = produced.isoformat()
 
     # Build the chat record
     chat_record = {
@@ -403,6 +782,10 @@ async def log_message(redis_manager, user_id: str, user_input: str, bot_response
         "timestamp": timestamp,
     }
 
+    # Rewriting the chat record is harmless; the summary push is skipped for a redelivery
     redis_manager.store_chat(user_id, chat_id, chat_record)
+    return redis_manager.push_summary_turn(
+        user_id, {"user_message": user_input, "bot_response": bot_response}, message_id=message_id
+    )
     
 
@@ -1,5 +1,4 @@
 import os
-import json
 import asyncio
 import aio_pika
 import requests
@@ -13,72 +12,220 @@ RABBITMQ_API_USER = os.getenv("RABBITMQ_API_USER", "guest")
 RABBITMQ_API_PASS = os.getenv("RABBITMQ_API_PASS", "guest")
 POLL_INTERVAL_SEC = 20  # Check for new queues every 20 seconds
 
-from .memory_functions import generate_candidate_memories, update_user_memory
-from .redis_class import RedisManager
+from .memory_functions import generate_candidate_memories_batch, update_user_memory
+from .redis_class import RedisManager, memory_lock_key, MESSAGE_DONE
+from .indexes import ensure_indexes
+from .messages import decode_turn, observe_lag, received_at, MEMORY_TASK_PREFIX
+from .worker_group import WORKER_GROUP, WorkerGroup, user_lock
+from .turn_coalescer import TurnCoalescer, EXTRACT_COALESCE_MAX_TURNS
+from . import metrics
+from . import tracing
+from .profiler import profiler
+from .magnitude_refiner import refiner
 redis_manager = RedisManager()
+coalescer = TurnCoalescer()
+
+FRESHNESS_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+CLAIM_POLL_SEC = 1.0
+NO_UPDATE_RESULTS = ("Redundant, no memory update.", "No memory update.")
 
 def is_memory_queue(queue_name):
-    return queue_name.startswith("memory_tasks_user_")
+    return queue_name.startswith(MEMORY_TASK_PREFIX)
+
+def queue_user_id(queue_name):
+    return queue_name[len(MEMORY_TASK_PREFIX):]
 
 async def on_memory_task(redis_manager, msg: aio_pika.IncomingMessage):
-    async with msg.process():
+    # A failed turn is requeued once; a second failure drops it
+    try:
+        async with msg.process(requeue=not msg.redelivered):
+            await handle_memory_task(redis_manager, msg.body, msg.headers)
+    except Exception:
+        pass  # logged by the handler
+
+async def claim_turn(redis_manager, user_id, message_id):
+    # Token to run the turn with, or None if it was handled already. Waits while another
+    # delivery holds the claim: it either finishes, fails and releases it, or dies and the
+    # claim expires.
+    while True:
+        claim = redis_manager.claim_message(user_id, "memory_task", message_id)
+        if claim == MESSAGE_DONE:
+            return None
+        if claim is not None:
+            return claim
+        await asyncio.sleep(CLAIM_POLL_SEC)
+
+async def handle_memory_task(redis_manager, body, headers):
+    # Shared by the RabbitMQ consumer and the in-process transport
+    try:
+        data = decode_turn(body)
+        observe_lag(data, "memory_task")
+        user_id = data["user_id"]
+        message_id = data["id"]
+
+        if not user_id or not data["user_message"] or not data["bot_response"]:
+            print(f"[MemoryWorker] Skipping: missing required fields in message: {data}")
+            return
+        parent = tracing.parse_traceparent((headers or {}).get("traceparent"))
+        with tracing.span("memory_worker.task", parent=parent, user_id=user_id, message_id=message_id) as attrs:
+            # Redelivered tasks would repeat every LLM call and could merge the same fact twice.
+            # A message id is marked done only once its writes are in; until then it holds a
+            # short claim, released on failure, so a redelivery after a crash runs it again.
+            token = None
+            if message_id:
+                token = await claim_turn(redis_manager, user_id, message_id)
+                if token is None:
+                    metrics.incr("duplicate_delivery_total", consumer="memory_task")
+                    print(f"[MemoryWorker] Skipping already processed task {message_id}")
+                    return
+
+            try:
+                batch, is_leader = await coalescer.join(
+                    user_id, message_id, data["user_message"], data["bot_response"], produced_at=data["ts"]
+                )
+                attrs.update(batch_turns=len(batch.turns), batch_leader=is_leader)
+                if is_leader:
+                    await run_batch(redis_manager, user_id, batch)
+                else:
+                    # The batch leader extracts and applies this turn too; ack once it is done
+                    await asyncio.shield(batch.done)
+                    attrs["batch_trace_id"] = batch.trace_id
+                if batch.failed:
+                    raise RuntimeError(f"memory batch for {user_id} failed")
+            except BaseException:
+                if token:
+                    redis_manager.release_message(user_id, "memory_task", message_id, token)
+                raise
+            if token:
+                redis_manager.finish_message(user_id, "memory_task", message_id)
+
+            # Chat received by the API -> memories from it written and retrievable
+            chat_received = received_at(headers)
+            if batch.written and chat_received is not None:
+                metrics.observe("memory_freshness_lag_seconds", time.time() - chat_received, buckets=FRESHNESS_BUCKETS)
+    except Exception as e:
+        print(f"[MemoryWorker] Fatal error: {e}")
+        raise
+
+async def run_batch(redis_manager, user_id, batch):
+    batch.trace_id = tracing.current_trace_id()
+    # Profiled from here, after the coalescing window, so the window wait is not counted
+    with profiler.profile("memory_task", mode=f"batch{len(batch.turns)}", user_id=user_id):
+        await _run_batch(redis_manager, user_id, batch)
+
+async def _run_batch(redis_manager, user_id, batch):
+    try:
+        # Held in every mode: the compaction job deletes and folds memories under it, and
+        # during a rebalance the old and new owner may both hold messages for this user.
         try:
-            data = json.loads(msg.body)
-            user_id = data.get("user_id")
-            user_msg = data.get("user_message", "")
-            bot_resp = data.get("bot_response", "")
+            async with user_lock(redis_manager.for_user(user_id), memory_lock_key(user_id)):
+                batch.written = await process_batch(redis_manager, user_id, batch.ordered_turns())
+        except BaseException:
+            batch.failed = True  # every turn of the batch releases its claim
+            raise
+    finally:
+        batch.finish()
 
-            if not user_id or not user_msg or not bot_resp:
-                print(f"[MemoryWorker] Skipping: missing required fields in message: {data}")
-                return
+async def process_batch(redis_manager, user_id, turns):
+    # Every turn here was claimed by this worker, so a previous owner cannot also apply it
+    return await process_memory_task(redis_manager, user_id, [(user_msg, bot_resp) for _, user_msg, bot_resp in turns])
 
-            start_time = time.perf_counter()
-            print(f"\n[MemoryWorker] Processing for userID: {user_id}")
+async def process_memory_task(redis_manager, user_id, turns):
+    start_time = time.perf_counter()
+    print(f"\n[MemoryWorker] Processing {len(turns)} turn(s) for userID: {user_id}")
 
+    try:
+        gen_time = time.perf_counter()
+        candidates = await generate_candidate_memories_batch(user_id, turns)
+        gen_time = time.perf_counter() - gen_time
+        print(f"[MemoryWorker] Generated {len(candidates)} memories in {gen_time:.3f}s")
+    except Exception as e:
+        print(f"[MemoryWorker] Error generating candidate memories: {e}")
+        raise
+
+    # Decisions see the latest exchange of the batch as their context
+    user_msg, bot_resp = turns[-1]
+    written = failed = 0
+    if not candidates:
+        print(f"[MemoryWorker] No new candidate memories for user {user_id}.")
+    else:
+        for i, cand in enumerate(candidates):
             try:
-                gen_time = time.perf_counter()
-                candidates = await generate_candidate_memories(user_id, user_msg, bot_resp)
-                gen_time = time.perf_counter() - gen_time
-                print(f"[MemoryWorker] Generated {len(candidates)} memories in {gen_time:.3f}s")
+                upd_time = time.perf_counter()
+                with tracing.span("memory.update"):
+                    result = await update_user_memory(redis_manager, cand, user_id, user_msg, bot_resp)
+                upd_time = time.perf_counter() - upd_time
+                written += result not in NO_UPDATE_RESULTS
+                print(f"[MemoryWorker] {result} ({upd_time:.3f}s)")
             except Exception as e:
-                print(f"[MemoryWorker] Error generating candidate memories: {e}")
-                candidates = []
-
-            if not candidates:
-                print(f"[MemoryWorker] No new candidate memories for user {user_id}.")
-            else:
-                for i, cand in enumerate(candidates):
-                    try:
-                        upd_time = time.perf_counter()
-                        result = await update_user_memory(redis_manager, cand, user_id, user_msg, bot_resp)
-                        upd_time = time.perf_counter() - upd_time
-                        print(f"[MemoryWorker] {result} ({upd_time:.3f}s)")
-                    except Exception as e:
-                        print(f"[MemoryWorker] Error updating memory {i+1}: {e}")
-
-            total = time.perf_counter() - start_time
-            print(f"✅ Memory processing for {user_id} finished in {total:.3f}s.")
-        except Exception as e:
-            print(f"[MemoryWorker] Fatal error: {e}")
+                failed += 1
+                print(f"[MemoryWorker] Error updating memory {i+1}: {e}")
+
+    total = time.perf_counter() - start_time
+    if failed:
+        # The turns are retried; candidates already applied come back as duplicates
+        raise RuntimeError(f"{failed} of {len(candidates)} memory updates failed for {user_id}")
+    print(f"✅ Memory processing for {user_id} finished in {total:.3f}s.")
+    return written
 
 async def monitor_and_consume_queues():
+    refiner.start(redis_manager)
+    # Consuming waits for the indexes; in a thread, so the refiner keeps running meanwhile
+    await asyncio.to_thread(ensure_indexes, redis_manager)
     print("Connecting to RabbitMQ...")
     conn = await aio_pika.connect_robust(RABBIT_URL)
     channel = await conn.channel()
-    await channel.set_qos(prefetch_count=3)
+    # All user queues share this channel. With global_=False RabbitMQ applies the limit to
+    # each consumer, i.e. per user queue, so one user's queue can deliver a whole coalescing
+    # batch however many other users' turns are in flight. With a channel-wide limit
+    # (global_=True) other users' turns could fill the window.
+    await channel.set_qos(prefetch_count=max(3, EXTRACT_COALESCE_MAX_TURNS), global_=False)
 
-    consumers = {}
+    consumers = {}  # queue name -> (queue, consumer tag)
     queue_timeout_ms = 10 * 60 * 1000  # 10 minutes
+    rediscover = asyncio.Event()
+    group = group_task = None
+
+    if WORKER_GROUP:
+        group = WorkerGroup(redis_manager.client)
+        group.heartbeat()
+
+        async def on_membership_change():
+            # Hand over users that moved to another worker, then pick up new ones
+            for q in [q for q in consumers if not group.owns(queue_user_id(q))]:
+                await remove_consumer(q)
+                print(f"[MemoryWorker] Released {q} to another worker")
+            rediscover.set()
+
+        # Kept, so the task is not garbage-collected and its failure is seen by the loop below
+        group_task = asyncio.create_task(group.run(on_membership_change))
+        group_task.add_done_callback(lambda _: rediscover.set())
+        print(f"[MemoryWorker] Joined worker group as {group.worker_id}")
+
+    def owned(queue_name):
+        return group is None or group.owns(queue_user_id(queue_name))
 
     async def add_consumer(queue_name):
         if queue_name in consumers:
             return
         queue = await channel.declare_queue(queue_name, durable=True)
         tag = await queue.consume(lambda msg: on_memory_task(redis_manager, msg))
-        consumers[queue_name] = tag
+        consumers[queue_name] = (queue, tag)
         print(f"[MemoryWorker] Now consuming: {queue_name}")
 
+    async def remove_consumer(queue_name):
+        queue, tag = consumers.pop(queue_name)
+        try:
+            await queue.cancel(tag)
+        except Exception as e:
+            # The queue may already have expired on the broker
+            print(f"[MemoryWorker] Cancel for {queue_name} failed: {e}")
+
     while True:
+        if group_task is not None and group_task.done():
+            # Without heartbeats this worker's users move to others; stop rather than consume them twice
+            group_task.result()
+            raise RuntimeError("Worker group heartbeat loop exited")
         try:
             resp = requests.get(
                 RABBITMQ_API_URL,
@@ -87,22 +234,34 @@ async def monitor_and_consume_queues():
             )
             resp.raise_for_status()
             all_queues = [q['name'] for q in resp.json()]
-            memory_queues = [q for q in all_queues if is_memory_queue(q)]
+            memory_queues = [q for q in all_queues if is_memory_queue(q) and owned(q)]
 
             for q in memory_queues:
                 await add_consumer(q)
 
-            # Remove consumers for queues that have disappeared
+            # Remove consumers for queues that have disappeared or are no longer ours
             active = set(memory_queues)
             stale = [q for q in list(consumers.keys()) if q not in active]
             for q in stale:
-                del consumers[q]
-                print(f"[MemoryWorker] Pruned consumer for expired queue: {q}")
+                await remove_consumer(q)
+                print(f"[MemoryWorker] Pruned consumer for queue: {q}")
 
             print(f"[MemoryWorker] Listening to {len(consumers)} memory task queues...")
+            print(f"[MemoryWorker] Decision paths: {metrics.snapshot('memory_decision')}")
+            print(f"[MemoryWorker] Embedding batches: {metrics.snapshot('embedding_batch')}")
+            print(f"[MemoryWorker] Turn lag: {metrics.snapshot('chat_turn_lag')}")
+            print(f"[MemoryWorker] Duplicate deliveries: {metrics.snapshot('duplicate_delivery')}")
+            print(f"[MemoryWorker] Extraction: {metrics.snapshot('extraction_')}")
+            print(f"[MemoryWorker] Memory freshness: {metrics.snapshot('memory_freshness')}")
+            print(f"[MemoryWorker] Magnitude refiner: {metrics.snapshot('magnitude_')}")
         except Exception as e:
             print(f"[MemoryWorker] Queue discovery error: {e}")
-        await asyncio.sleep(POLL_INTERVAL_SEC)
+        try:
+            await asyncio.wait_for(rediscover.wait(), POLL_INTERVAL_SEC)
+        except asyncio.TimeoutError:
+            pass
+        rediscover.clear()
 
 if __name__ == "__main__":
+    tracing.configure("memory-worker")
     asyncio.run(monitor_and_consume_queues())
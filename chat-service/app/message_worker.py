@@ -1,5 +1,4 @@
 import os
-import json
 import asyncio
 import aio_pika
 import requests
@@ -13,21 +12,51 @@ RABBITMQ_API_USER = os.getenv("RABBITMQ_API_USER", "guest")
 RABBITMQ_API_PASS = os.getenv("RABBITMQ_API_PASS", "guest")
 POLL_INTERVAL_SEC = 20 # Poll RabbitMQ API every 20 seconds
 
-from .memory_functions import log_message
+from .memory_functions import log_message, update_rolling_summary
 from .redis_class import RedisManager
+from .messages import decode_turn, observe_lag, MESSAGE_LOG_PREFIX
+from . import metrics
+from . import tracing
 redis_manager = RedisManager()
 
 def is_message_log_queue(queue_name):
-    return queue_name.startswith("message_logs_user_")
+    return queue_name.startswith(MESSAGE_LOG_PREFIX)
 
 async def on_message_log(redis_manager, msg: aio_pika.IncomingMessage):
-    async with msg.process():
-        try:
-            data = json.loads(msg.body)
-            await log_message(redis_manager, data["user_id"], data["user_message"], data["bot_response"])
-            print(f"[MessageWorker] Logged message for user {data['user_id']}")
-        except Exception as e:
-            print(f"[MessageWorker] Error: {e}")
+    # A failed turn is requeued once; a second failure drops it
+    try:
+        async with msg.process(requeue=not msg.redelivered):
+            await handle_message_log(redis_manager, msg.body, msg.headers)
+    except Exception:
+        pass  # logged by the handler
+
+async def handle_message_log(redis_manager, body, headers):
+    # Shared by the RabbitMQ consumer and the in-process transport
+    try:
+        data = decode_turn(body)
+        observe_lag(data, "message_log")
+        user_id, message_id = data["user_id"], data["id"]
+        parent = tracing.parse_traceparent((headers or {}).get("traceparent"))
+        with tracing.span("message_worker.log", parent=parent, user_id=user_id, message_id=message_id):
+            # Safe to repeat for a redelivery: the chat id derives from the message id, and
+            # the summary push happens once per id
+            with tracing.span("chat.redis_write"):
+                first = await log_message(
+                    redis_manager, user_id, data["user_message"], data["bot_response"],
+                    message_id=message_id, produced_at=data["ts"],
+                )
+            if first:
+                print(f"[MessageWorker] Logged message for user {user_id}")
+            else:
+                metrics.incr("duplicate_delivery_total", consumer="message_log")
+                print(f"[MessageWorker] Re-logged redelivered message {message_id}")
+            with tracing.span("summary.update") as attrs:
+                attrs["folded"] = await update_rolling_summary(redis_manager, user_id)
+            if attrs["folded"]:
+                print(f"[MessageWorker] Rolling summary updated for user {user_id}")
+    except Exception as e:
+        print(f"[MessageWorker] Error: {e}")
+        raise
 
 async def monitor_and_consume_queues():
     print("Connecting to RabbitMQ...")
@@ -66,9 +95,11 @@ async def monitor_and_consume_queues():
                 # No manual cancel needed; just remove from dict
                 del consumers[q]
             print(f"[MessageWorker] Listening to {len(consumers)} message log queues...")
+            print(f"[MessageWorker] Turn lag: {metrics.snapshot('chat_turn_lag')}")
         except Exception as e:
             print(f"[MessageWorker] Queue discovery error: {e}")
         await asyncio.sleep(POLL_INTERVAL_SEC)
 
 if __name__ == "__main__":
+    tracing.configure("message-worker")
     asyncio.run(monitor_and_consume_queues())
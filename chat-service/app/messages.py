@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import uuid
+import aio_pika
+from aio_pika.exceptions import DeliveryError
+from dotenv import load_dotenv
+
+from . import metrics
+
+load_dotenv()
+
+# Every chat turn is published once to a direct exchange with the user id as routing key.
+# Both of the user's queues (message logs and memory tasks) are bound with that key, so one
+# publish reaches both consumers.
+CHAT_TURN_EXCHANGE = os.getenv("CHAT_TURN_EXCHANGE", "chat_turns")
+PAYLOAD_VERSION = 1
+# Queue declares/bindings are redone at most this often per user. Must stay below the
+# cleanup job's QUEUE_IDLE_SEC, so a queue we believe is bound has not been deleted.
+QUEUE_REDECLARE_SEC = float(os.getenv("QUEUE_REDECLARE_SEC", "60"))
+
+MESSAGE_LOG_PREFIX = "message_logs_user_"
+MEMORY_TASK_PREFIX = "memory_tasks_user_"
+
+
+def turn_queues(user_id):
+    return f"{MESSAGE_LOG_PREFIX}{user_id}", f"{MEMORY_TASK_PREFIX}{user_id}"
+
+
+def encode_turn(user_id, user_message, bot_response, message_id=None, produced_at=None):
+    """
+    Compact v1 payload: {"v", "id", "ts", "u", "m", "b"}. Returns (message_id, body).
+    """
+    message_id = message_id or uuid.uuid4().hex
+    payload = {
+        "v": PAYLOAD_VERSION,
+        "id": message_id,
+        "ts": round(produced_at or time.time(), 3),
+        "u": user_id,
+        "m": user_message,
+        "b": bot_response,
+    }
+    return message_id, json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def decode_turn(body):
+    """
+    Decode a chat turn into user_id/user_message/bot_response plus id and ts. Payloads
+    from before versioning have no id or ts; those come back as None.
+    """
+    data = json.loads(body)
+    if data.get("v") == 1:
+        return {
+            "id": data["id"],
+            "ts": data["ts"],
+            "user_id": data["u"],
+            "user_message": data["m"],
+            "bot_response": data["b"],
+        }
+    return {
+        "id": None,
+        "ts": None,
+        "user_id": data.get("user_id"),
+        "user_message": data.get("user_message", ""),
+        "bot_response": data.get("bot_response", ""),
+    }
+
+
+def received_at(headers):
+    # When the API received the chat request, as set by the publisher
+    value = (headers or {}).get("x-chat-received-at")
+    return float(value) if value is not None else None
+
+
+def observe_lag(turn, consumer):
+    # Time from the API publishing the turn to a worker picking it up
+    if turn["ts"] is not None:
+        metrics.observe("chat_turn_lag_seconds", max(0.0, time.time() - turn["ts"]), consumer=consumer)
+
+
+class ChatTurnPublisher:
+    """
+    Long-lived publisher on one robust connection with publisher confirms. Publishes
+    are mandatory: if the exchange cannot route a turn, the user's queues were removed
+    under us, so they are declared again and the turn is republished once.
+    """
+
+    def __init__(self, url=None):
+        self.url = url or os.getenv("RABBITMQ_URL")
+        self._connection = None
+        self._channel = None
+        self._exchange = None
+        self._declared = {}  # user_id -> monotonic time of last declare/bind
+
+    async def _ensure_exchange(self):
+        if self._exchange is None:
+            self._connection = await aio_pika.connect_robust(self.url)
+            self._channel = await self._connection.channel(publisher_confirms=True, on_return_raises=True)
+            self._exchange = await self._channel.declare_exchange(
+                CHAT_TURN_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True
+            )
+        return self._exchange
+
+    async def _ensure_queues(self, user_id, force=False):
+        now = time.monotonic()
+        if not force and now - self._declared.get(user_id, float("-inf")) < QUEUE_REDECLARE_SEC:
+            return
+        for name in turn_queues(user_id):
+            queue = await self._channel.declare_queue(name, durable=True)
+            await queue.bind(self._exchange, routing_key=user_id)
+        self._declared[user_id] = now
+
+    async def publish(self, user_id, user_message, bot_response, headers=None):
+        exchange = await self._ensure_exchange()
+        await self._ensure_queues(user_id)
+        message_id, body = encode_turn(user_id, user_message, bot_response)
+        message = aio_pika.Message(
+            body,
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            message_id=message_id,
+            headers=headers or {},
+        )
+        try:
+            await exchange.publish(message, routing_key=user_id, mandatory=True)
+        except DeliveryError:
+            metrics.incr("chat_turn_redeclare_total")
+            await self._ensure_queues(user_id, force=True)
+            await exchange.publish(message, routing_key=user_id, mandatory=True)
+        metrics.incr("chat_turn_published_total")
+        return message_id
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = self._channel = self._exchange = None
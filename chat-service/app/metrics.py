@@ -0,0 +1,88 @@
+import threading
+from collections import defaultdict
+
+# Minimal in-process counters and histograms. Each process (API, workers) keeps its
+# own; the API exposes them at /metrics and the workers print them periodically.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_histograms = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def incr(name, n=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += n
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = {"buckets": buckets, "counts": [0] * len(buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+                break
+        hist["sum"] += value
+        hist["count"] += 1
+
+
+def get_counter(name, **labels):
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def snapshot(prefix=""):
+    """
+    Plain dict of current values, e.g. for worker log lines.
+    """
+    with _lock:
+        out = {}
+        for (name, labels), value in list(_counters.items()) + list(_gauges.items()):
+            if name.startswith(prefix):
+                out[name + _format_labels(labels)] = value
+        for (name, labels), hist in _histograms.items():
+            if name.startswith(prefix) and hist["count"]:
+                out[name + "_avg" + _format_labels(labels)] = round(hist["sum"] / hist["count"], 4)
+        return out
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render_prometheus():
+    """
+    Render every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    with _lock:
+        for (name, labels), value in sorted(_counters.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), value in sorted(_gauges.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), hist in sorted(_histograms.items()):
+            cumulative = 0
+            for bound, count in zip(hist["buckets"], hist["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {hist['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {hist['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {hist['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,225 @@
+import sys
+import time
+import argparse
+import numpy as np
+from redis.commands.search.query import Query
+from redis.commands.search.index_definition import IndexDefinition, IndexType
+
+from .redis_class import RedisManager, user_tag
+from .records import EMB_DIM, EMB_NATIVE_DIM, embedding_field
+from .indexes import (INDEXES, MEMORY_INDEX, MEMORY_EF_RUNTIME, memory_schema, physical_name,
+                      truncate_embeddings, _index_info, _info_value, _wait_indexed)
+from .bench_index import index_size_mb
+
+# Moves the memory index to another embedding size without taking retrieval down. Each
+# memory hash gets its vector at the new size in a field of its own (embedding_<dim>),
+# either the leading dimensions of the stored vector (--mode truncate, no API calls) or a
+# fresh embedding of memory_text requested at that output dimensionality (--mode reembed).
+# An index over the new field is built next to the live one, and --compare measures both
+# on the stored corpus. The cutover is a restart with EMBEDDING_DIM=<dim>: ensure_indexes
+# fills anything written since, points the alias at the new index and drops the old one.
+# Usage:
+#   python -m app.migrate_embeddings --dim 256 --mode truncate --compare 200
+#   (restart every service with EMBEDDING_DIM=256)
+#   python -m app.migrate_embeddings --dim 256 --cleanup
+MEMORY_PREFIX = INDEXES[MEMORY_INDEX][0]
+REEMBED_BATCH = 100  # texts per embed call
+
+
+def reembed_embeddings(client, dim, batch=REEMBED_BATCH):
+    """
+    Embed memory_text at `dim` for hashes that lack the field. Resumable: a failed run
+    leaves what it wrote, and the next one skips it.
+    """
+    # Needs the Gemini client; truncate mode and --compare do not
+    from .memory_functions import embed_batch
+
+    field = embedding_field(dim)
+    filled = 0
+    keys = []
+
+    def flush():
+        nonlocal filled
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hexists(key, field)
+            pipe.hget(key, "memory_text")
+        replies = pipe.execute()
+        todo = [(key, text.decode()) for key, exists, text in zip(keys, replies[::2], replies[1::2]) if not exists and text]
+        keys.clear()
+        if not todo:
+            return
+        vectors = embed_batch([text for _, text in todo], dim)
+        pipe = client.pipeline(transaction=False)
+        for (key, _), vec in zip(todo, vectors):
+            if len(vec) == dim:
+                pipe.hset(key, field, np.asarray(vec, dtype=np.float32).tobytes())
+                filled += 1
+        pipe.execute()
+
+    for key in client.scan_iter(match=f"{MEMORY_PREFIX}*", count=1000, _type="HASH"):
+        keys.append(key)
+        if len(keys) >= batch:
+            flush()
+            print(f"[Migrate] Re-embedded {filled} memories so far")
+    if keys:
+        flush()
+    return filled
+
+
+def create_index(client, dim):
+    # The new-size index, side by side with the one the alias points at
+    name = physical_name(MEMORY_INDEX, dim=dim)
+    if _index_info(client, name) is None:
+        client.ft(name).create_index(memory_schema(dim=dim),
+                                     definition=IndexDefinition(prefix=[MEMORY_PREFIX], index_type=IndexType.HASH))
+        print(f"[Migrate] Created {name}, indexing...")
+    if not _wait_indexed(client, name):
+        print(f"[Migrate] {name} still indexing; --compare numbers will be low until it finishes")
+    return name
+
+
+def sample_keys(client, n, rng):
+    # Uniform sample of memory keys in one SCAN (reservoir sampling)
+    sample = []
+    for i, key in enumerate(client.scan_iter(match=f"{MEMORY_PREFIX}*", count=1000, _type="HASH")):
+        if len(sample) < n:
+            sample.append(key)
+        else:
+            j = rng.integers(i + 1)
+            if j < n:
+                sample[j] = key
+    return [key.decode() for key in sample]
+
+
+def user_corpus(client, user_id, fields):
+    # One user's keys and their vectors for each of `fields`, as unit-row matrices
+    keys = list(client.scan_iter(match=f"{MEMORY_PREFIX}{user_tag(user_id)}:*", count=1000, _type="HASH"))
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, *fields)
+    rows = [(key.decode(), values) for key, values in zip(keys, pipe.execute()) if all(values)]
+    matrices = []
+    for i in range(len(fields)):
+        m = np.stack([np.frombuffer(values[i], dtype=np.float32) for _, values in rows]) if rows else np.empty((0, 0))
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        matrices.append(m / np.where(norms == 0, 1, norms))
+    return [key for key, _ in rows], matrices
+
+
+def exact_top_k(unit, i, k):
+    # Nearest rows to row i by cosine, itself excluded
+    sims = unit @ unit[i]
+    sims[i] = -np.inf
+    return set(np.argsort(-sims)[:k].tolist())
+
+
+def knn(client, index, user_id, vec, k, ef=MEMORY_EF_RUNTIME):
+    # The production query shape; one extra hit because the query memory finds itself
+    q = (
+        Query(f"@user_id:{{{user_id}}}=>[KNN {k + 1} @embedding $vec EF_RUNTIME $ef AS score]")
+        .return_fields("score").sort_by("score").paging(0, k + 1).dialect(2)
+    )
+    start = time.perf_counter()
+    res = client.ft(index).search(q, query_params={"vec": vec.astype(np.float32).tobytes(), "ef": ef})
+    return [doc.id for doc in res.docs], time.perf_counter() - start
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return p(0.5), p(0.95)
+
+
+def compare(client, old_index, new_index, from_dim, dim, n, k, seed):
+    """
+    Recall@k of both indexes and of exact search at `dim`, against exact search at
+    `from_dim`, with stored memories as the queries.
+    """
+    rng = np.random.default_rng(seed)
+    fields = (embedding_field(from_dim), embedding_field(dim))
+    corpora = {}
+    recalls = {"old": [], "new": [], "exact": []}
+    latencies = {"old": [], "new": []}
+    for key in sample_keys(client, n, rng):
+        user_id = key[key.index("{") + 1:key.index("}")]
+        if user_id not in corpora:
+            corpora[user_id] = user_corpus(client, user_id, fields)
+        keys, (source, target) = corpora[user_id]
+        if key not in keys or len(keys) <= k:
+            continue
+        i = keys.index(key)
+        truth = exact_top_k(source, i, k)
+        truth_keys = {keys[j] for j in truth}
+        recalls["exact"].append(len(exact_top_k(target, i, k) & truth) / k)
+        for name, index, vec in (("old", old_index, source[i]), ("new", new_index, target[i])):
+            if index is None:
+                continue
+            ids, elapsed = knn(client, index, user_id, vec, k)
+            found = [doc_id for doc_id in ids if doc_id != key][:k]
+            recalls[name].append(len(set(found) & truth_keys) / k)
+            latencies[name].append(elapsed)
+
+    queries = len(recalls["exact"])
+    if not queries:
+        print(f"[Migrate] No users with more than {k} memories carrying both fields; nothing to compare")
+        return
+    print(f"\nRecall@{k} against exact {from_dim}-d search, {queries} stored memories as queries ({len(corpora)} users)")
+    print(f"{'':<28}{'recall':>8}{'p50 ms':>9}{'p95 ms':>9}{'index MB':>10}")
+    for name, index in (("old", old_index), ("new", new_index)):
+        if index is None:
+            continue
+        p50, p95 = percentiles(latencies[name])
+        print(f"{index:<28}{np.mean(recalls[name]):>8.3f}{p50:>9.2f}{p95:>9.2f}{index_size_mb(client, index):>10.1f}")
+    print(f"{f'exact {dim}-d':<28}{np.mean(recalls['exact']):>8.3f}")
+
+
+def cleanup(client, dim, from_dim):
+    # Drop the old-size vectors once the alias serves the new index
+    live = _info_value(_index_info(client, MEMORY_INDEX), "index_name")
+    if live != physical_name(MEMORY_INDEX, dim=dim):
+        sys.exit(f"{MEMORY_INDEX} points at {live}; restart with EMBEDDING_DIM={dim} before --cleanup")
+    target, source = embedding_field(dim), embedding_field(from_dim)
+    removed = 0
+    for key in client.scan_iter(match=f"{MEMORY_PREFIX}*", count=1000, _type="HASH"):
+        if client.hexists(key, target):
+            removed += client.hdel(key, source)
+    print(f"[Migrate] Removed {source} from {removed} memories")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate memory embeddings to another size")
+    parser.add_argument("--dim", type=int, required=True, help="target embedding size")
+    parser.add_argument("--from-dim", type=int, default=EMB_NATIVE_DIM, help="size the live index is on")
+    parser.add_argument("--mode", choices=("truncate", "reembed"), default="truncate")
+    parser.add_argument("--compare", type=int, default=0, metavar="N", help="compare the indexes on N stored memories")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cleanup", action="store_true", help="after the cutover, delete the old-size vectors")
+    args = parser.parse_args()
+
+    if args.dim == args.from_dim:
+        sys.exit("--dim is the size the index is already on")
+    if args.mode == "truncate" and args.dim > args.from_dim:
+        sys.exit("truncate can only shrink embeddings; use --mode reembed")
+    if EMB_DIM != args.from_dim and not args.cleanup:
+        print(f"[Migrate] Note: this process has EMBEDDING_DIM={EMB_DIM}, the live index is assumed to be {args.from_dim}-d")
+
+    for client in RedisManager().primaries():
+        if args.cleanup:
+            cleanup(client, args.dim, args.from_dim)
+            continue
+        if args.mode == "truncate":
+            filled = truncate_embeddings(client, MEMORY_PREFIX, args.dim, source_dim=args.from_dim)
+        else:
+            filled = reembed_embeddings(client, args.dim)
+        print(f"[Migrate] Wrote {embedding_field(args.dim)} for {filled} memories ({args.mode})")
+        new_index = create_index(client, args.dim)
+        if args.compare:
+            old_index = _info_value(_index_info(client, MEMORY_INDEX), "index_name")
+            compare(client, old_index if old_index != new_index else None, new_index,
+                    args.from_dim, args.dim, args.compare, args.k, args.seed)
+
+
+if __name__ == "__main__":
+    main()
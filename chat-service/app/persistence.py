@@ -0,0 +1,341 @@
+import os
+import uuid
+import asyncio
+from collections import deque
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from supabase import create_client
+
+from .serialization import serialize_memory, serialize_chat
+from .embedding_codec import to_pgvector_binary, from_pgvector_binary
+from .session_snapshot import SnapshotDir, SESSION_SNAPSHOT_DIR
+from . import metrics
+
+try:
+    import asyncpg
+except ImportError:  # only needed for PERSISTENCE_BACKEND=postgres
+    asyncpg = None
+
+load_dotenv()
+
+# "supabase" (REST, default) or "postgres" (direct asyncpg connection pool via DATABASE_URL)
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND", "supabase")
+DATABASE_URL = os.getenv("DATABASE_URL")
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+
+SUPABASE_PAGE_SIZE = 1000  # PostgREST's default max rows per request
+SUPABASE_BATCH_SIZE = 100
+LOGIN_CHUNK_SIZE = 500
+SUMMARY_SEED_TURNS = 10
+
+MEMORY_COLUMNS = ["id", "user_id", "memory_text", "embedding", "created_at", "last_used", "frequency", "magnitude", "rfm_score"]
+CHAT_COLUMNS = ["id", "user_id", "user_message", "bot_response", "timestamp"]
+# Memories retired by compaction (memory_compaction.py) when MEMORY_COMPACTION_MODE=archive
+ARCHIVE_TABLE = "persona_category_archive"
+# Version stamp of each user's last logout, matched against local session snapshots
+SYNC_STATE_TABLE = "session_sync_state"
+SNAPSHOT_SIZE_BUCKETS = (2**16, 2**18, 2**20, 2**22, 2**24, 2**26, 2**28)
+
+
+class SupabaseStore:
+    """
+    Session sync over the Supabase REST API.
+    """
+
+    def __init__(self, client=None):
+        self.client = client or create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+
+    def _fetch_page(self, table, user_id, start, order):
+        query = self.client.table(table).select("*").eq("user_id", user_id)
+        # Offset paging is only stable under a total order, hence the unique key last
+        for column in order:
+            query = query.order(column)
+        return query.range(start, start + SUPABASE_PAGE_SIZE - 1).execute().data or []
+
+    async def _stream(self, table, user_id, order=("id",)):
+        start = 0
+        while True:
+            rows = await asyncio.to_thread(self._fetch_page, table, user_id, start, order)
+            if rows:
+                yield rows
+            if len(rows) < SUPABASE_PAGE_SIZE:
+                return
+            start += SUPABASE_PAGE_SIZE
+
+    async def load_user(self, redis_manager, user_id):
+        n_memories = n_chats = 0
+        async for rows in self._stream("persona_category", user_id):
+            redis_manager.load_memories(user_id, rows)
+            n_memories += len(rows)
+        recent = deque(maxlen=SUMMARY_SEED_TURNS)
+        async for rows in self._stream("chat_message_logs", user_id, order=("timestamp", "id")):
+            redis_manager.load_chats(user_id, rows)
+            recent.extend(rows)
+            n_chats += len(rows)
+        redis_manager.seed_summary(user_id, list(recent))
+        return n_memories, n_chats
+
+    def _batch_upsert(self, table_name, data):
+        for i in range(0, len(data), SUPABASE_BATCH_SIZE):
+            batch = data[i:i+SUPABASE_BATCH_SIZE]
+            self.client.table(table_name).upsert(batch).execute()
+
+    async def save_user(self, user_id, memories, chats, snapshot_version=None):
+        serialized_memories = [serialize_memory(raw) for raw in memories]
+        serialized_chats = [serialize_chat(raw) for raw in chats]
+        if serialized_memories:
+            await asyncio.to_thread(self._batch_upsert, "persona_category", serialized_memories)
+        if serialized_chats:
+            await asyncio.to_thread(self._batch_upsert, "chat_message_logs", serialized_chats)
+        if snapshot_version:
+            # Stamped only once the data is in
+            await asyncio.to_thread(self._batch_upsert, SYNC_STATE_TABLE, [{
+                "user_id": user_id, "snapshot_version": snapshot_version, "synced_at": datetime.now(timezone.utc).isoformat(),
+            }])
+
+    async def get_snapshot_version(self, user_id):
+        rows = await asyncio.to_thread(
+            lambda: self.client.table(SYNC_STATE_TABLE).select("snapshot_version").eq("user_id", user_id).execute().data
+        )
+        return rows[0]["snapshot_version"] if rows else None
+
+    async def clear_snapshot_version(self, user_id):
+        await asyncio.to_thread(lambda: self.client.table(SYNC_STATE_TABLE).delete().eq("user_id", user_id).execute())
+
+    async def retire_memories(self, user_id, memories, archive=True):
+        # Compaction: optionally copy to the archive table, then remove from the live one
+        if archive:
+            await asyncio.to_thread(self._batch_upsert, ARCHIVE_TABLE, [serialize_memory(m) for m in memories])
+        ids = [m.id for m in memories]
+        for i in range(0, len(ids), SUPABASE_BATCH_SIZE):
+            batch = ids[i:i+SUPABASE_BATCH_SIZE]
+            await asyncio.to_thread(
+                lambda: self.client.table("persona_category").delete().eq("user_id", user_id).in_("id", batch).execute()
+            )
+
+    async def delete_user(self, user_id):
+        for table in ("persona_category", "chat_message_logs"):
+            await asyncio.to_thread(lambda: self.client.table(table).delete().eq("user_id", user_id).execute())
+
+
+def _parse_ts(value):
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return value
+
+
+def _memory_record(mem):
+    # Memory record -> COPY tuple in MEMORY_COLUMNS order
+    return (
+        mem.id, mem.user_id, mem.memory_text, mem.embedding,
+        _parse_ts(mem.created_at), _parse_ts(mem.last_used),
+        mem.frequency, mem.magnitude, mem.rfm_score,
+    )
+
+
+def _chat_record(chat):
+    return (chat.id, chat.user_id, chat.user_message, chat.bot_response, _parse_ts(chat.timestamp))
+
+
+def _row_to_redis(row):
+    # asyncpg rows -> the same string/bytes shape the Supabase path stores
+    out = {}
+    for k, v in row.items():
+        if v is None:
+            continue
+        if isinstance(v, datetime):
+            out[k] = v.isoformat()
+        elif k == "embedding":
+            out[k] = v
+        else:
+            out[k] = str(v)
+    return out
+
+
+class PostgresStore:
+    """
+    Session sync straight to Postgres over an asyncpg pool. Logins stream through a
+    server-side cursor into Redis pipelines; logouts COPY into a temp staging table
+    and upsert from there in one statement. Embeddings use pgvector's binary format.
+    """
+
+    def __init__(self, dsn=None, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX):
+        if asyncpg is None:
+            raise RuntimeError("PERSISTENCE_BACKEND=postgres requires asyncpg (pip install asyncpg)")
+        self.dsn = dsn or DATABASE_URL
+        if not self.dsn:
+            raise RuntimeError("PERSISTENCE_BACKEND=postgres requires DATABASE_URL")
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+    @staticmethod
+    async def _init_connection(conn):
+        await conn.set_type_codec(
+            "vector", schema="public", encoder=to_pgvector_binary, decoder=from_pgvector_binary, format="binary"
+        )
+
+    async def pool(self):
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                self.dsn, min_size=self.min_size, max_size=self.max_size, init=self._init_connection
+            )
+        return self._pool
+
+    async def load_user(self, redis_manager, user_id):
+        pool = await self.pool()
+        n_memories = n_chats = 0
+        recent = deque(maxlen=SUMMARY_SEED_TURNS)
+        async with pool.acquire() as conn:
+            # Server-side cursors only live inside a transaction
+            async with conn.transaction(readonly=True):
+                cur = await conn.cursor(
+                    f"SELECT {', '.join(MEMORY_COLUMNS)} FROM public.persona_category WHERE user_id = $1", user_id
+                )
+                while rows := await cur.fetch(LOGIN_CHUNK_SIZE):
+                    redis_manager.load_memories(user_id, [_row_to_redis(r) for r in rows])
+                    n_memories += len(rows)
+
+                cur = await conn.cursor(
+                    f'SELECT {", ".join(CHAT_COLUMNS)} FROM public.chat_message_logs WHERE user_id = $1 ORDER BY "timestamp"',
+                    user_id,
+                )
+                while rows := await cur.fetch(LOGIN_CHUNK_SIZE):
+                    chats = [_row_to_redis(r) for r in rows]
+                    redis_manager.load_chats(user_id, chats)
+                    recent.extend(chats)
+                    n_chats += len(rows)
+        redis_manager.seed_summary(user_id, list(recent))
+        return n_memories, n_chats
+
+    @staticmethod
+    async def _copy_upsert(conn, table, columns, records, update_columns):
+        stage = f"{table}_stage"
+        cols = ", ".join(f'"{c}"' for c in columns)
+        updates = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in update_columns)
+        await conn.execute(
+            f"CREATE TEMP TABLE {stage} (LIKE public.{table} INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        await conn.copy_records_to_table(stage, records=records, columns=columns)
+        await conn.execute(
+            f"INSERT INTO public.{table} ({cols}) SELECT {cols} FROM {stage} "
+            f"ON CONFLICT (id) DO UPDATE SET {updates}"
+        )
+
+    async def save_user(self, user_id, memories, chats, snapshot_version=None):
+        pool = await self.pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if snapshot_version:
+                    await conn.execute(
+                        f"INSERT INTO public.{SYNC_STATE_TABLE} (user_id, snapshot_version, synced_at) VALUES ($1, $2, now()) "
+                        "ON CONFLICT (user_id) DO UPDATE SET snapshot_version = EXCLUDED.snapshot_version, synced_at = now()",
+                        user_id, snapshot_version,
+                    )
+                if memories:
+                    await self._copy_upsert(
+                        conn, "persona_category", MEMORY_COLUMNS, [_memory_record(m) for m in memories],
+                        [c for c in MEMORY_COLUMNS if c not in ("id", "user_id", "created_at")],
+                    )
+                if chats:
+                    await self._copy_upsert(
+                        conn, "chat_message_logs", CHAT_COLUMNS, [_chat_record(c) for c in chats],
+                        ["user_message", "bot_response", "timestamp"],
+                    )
+
+    async def retire_memories(self, user_id, memories, archive=True):
+        pool = await self.pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                if archive:
+                    await self._copy_upsert(
+                        conn, ARCHIVE_TABLE, MEMORY_COLUMNS, [_memory_record(m) for m in memories],
+                        [c for c in MEMORY_COLUMNS if c != "id"],
+                    )
+                await conn.execute(
+                    "DELETE FROM public.persona_category WHERE user_id = $1 AND id = ANY($2::uuid[])",
+                    user_id, [m.id for m in memories],
+                )
+
+    async def delete_user(self, user_id):
+        pool = await self.pool()
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM public.persona_category WHERE user_id = $1", user_id)
+            await conn.execute("DELETE FROM public.chat_message_logs WHERE user_id = $1", user_id)
+
+    async def get_snapshot_version(self, user_id):
+        pool = await self.pool()
+        return await pool.fetchval(f"SELECT snapshot_version FROM public.{SYNC_STATE_TABLE} WHERE user_id = $1", user_id)
+
+    async def clear_snapshot_version(self, user_id):
+        pool = await self.pool()
+        await pool.execute(f"DELETE FROM public.{SYNC_STATE_TABLE} WHERE user_id = $1", user_id)
+
+
+class SnapshotStore:
+    """
+    Wraps a store with local session snapshots. Logout saves to the database with a new
+    version stamp, then writes the snapshot under the same stamp. Login bulk-loads Redis
+    from the snapshot when its stamp matches the database's, and from the database
+    otherwise. Compaction and deletes clear the stamp, so older snapshots stop matching.
+    """
+
+    def __init__(self, store, snapshots):
+        self.store = store
+        self.snapshots = snapshots
+
+    async def load_user(self, redis_manager, user_id):
+        snap = await asyncio.to_thread(self.snapshots.open, user_id)
+        result = "absent"
+        if snap is not None:
+            result = "stale"
+            try:
+                if snap.version == await self.store.get_snapshot_version(user_id):
+                    counts = await asyncio.to_thread(self._load_snapshot, redis_manager, user_id, snap)
+                    metrics.incr("session_snapshot_login_total", result="hit")
+                    return counts
+            except Exception as e:
+                # Anything the snapshot wrote is overwritten by the database load
+                result = "error"
+                print(f"[Snapshot] Load for {user_id} failed, falling back to the database: {e}")
+        metrics.incr("session_snapshot_login_total", result=result)
+        return await self.store.load_user(redis_manager, user_id)
+
+    @staticmethod
+    def _load_snapshot(redis_manager, user_id, snap):
+        n_memories = len(snap.matrix)
+        for start in range(0, n_memories, LOGIN_CHUNK_SIZE):
+            redis_manager.load_memories(user_id, list(snap.memory_rows(start, start + LOGIN_CHUNK_SIZE)))
+        chats = list(snap.chat_rows())
+        for start in range(0, len(chats), LOGIN_CHUNK_SIZE):
+            redis_manager.load_chats(user_id, chats[start:start + LOGIN_CHUNK_SIZE])
+        redis_manager.seed_summary(user_id, chats)
+        return n_memories, len(chats)
+
+    async def save_user(self, user_id, memories, chats):
+        version = uuid.uuid4().hex
+        await self.store.save_user(user_id, memories, chats, snapshot_version=version)
+        try:
+            size = await asyncio.to_thread(self.snapshots.write, user_id, version, memories, chats)
+            metrics.observe("session_snapshot_bytes", size, buckets=SNAPSHOT_SIZE_BUCKETS)
+        except Exception as e:
+            # The database holds the data; the next login just reads it from there
+            print(f"[Snapshot] Write for {user_id} failed: {e}")
+
+    async def retire_memories(self, user_id, memories, archive=True):
+        await self.store.clear_snapshot_version(user_id)
+        await self.store.retire_memories(user_id, memories, archive=archive)
+
+    async def delete_user(self, user_id):
+        await self.store.clear_snapshot_version(user_id)
+        await self.store.delete_user(user_id)
+        self.snapshots.remove(user_id)
+
+
+def get_store(backend=None, snapshot_dir=SESSION_SNAPSHOT_DIR):
+    backend = backend or PERSISTENCE_BACKEND
+    store = PostgresStore() if backend == "postgres" else SupabaseStore()
+    if snapshot_dir:
+        return SnapshotStore(store, SnapshotDir(snapshot_dir))
+    return store
@@ -0,0 +1,233 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+from . import metrics
+
+load_dotenv()
+
+# Opt-in sampling profiler. While a profiled chat request or memory task runs, a background
+# thread samples the event-loop thread's stack every PROFILE_INTERVAL_MS and keeps the
+# samples whose await chain passes through that request. Profiles of requests slower
+# than PROFILE_SLOW_MS (plus a PROFILE_SAMPLE_RATE share of all others) are written as
+# collapsed stacks, readable by flamegraph.pl or speedscope. Work the request hands to
+# the default executor (asyncio.to_thread: Redis searches, Gemini calls) is sampled on
+# its worker thread too, under a "[thread]" root.
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "0") == "1"
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "2000"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+MAX_STACK_DEPTH = 128
+THREAD_ROOT = "[thread]"
+
+# The session of the request running in the current context
+_current_session = contextvars.ContextVar("profile_session", default=None)
+
+
+def _label(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}:{code.co_name}"
+
+
+class ProfileSession:
+    def __init__(self, profiler, kind, tags):
+        self.profiler = profiler
+        self.kind = kind
+        self.tags = tags
+        self.stacks = Counter()
+        self.anchor = None
+        self.thread_id = None
+        self.threads = {}  # executor thread id -> anchor frame, while it runs work for us
+        self.started = None
+        self._token = None
+
+    def __enter__(self):
+        # The caller's frame (the handler coroutine) anchors the samples we keep
+        self.anchor = sys._getframe(1)
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self._token = _current_session.set(self)
+        self.profiler._start(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._stop(self)
+        _current_session.reset(self._token)
+        self.profiler._finish(self, (time.perf_counter() - self.started) * 1000)
+        self.anchor = None
+        return False
+
+    def run_in_thread(self, fn, args, kwargs):
+        # Runs on an executor thread; its stack is sampled for this session meanwhile
+        ident = threading.get_ident()
+        with self.profiler._lock:
+            self.threads[ident] = sys._getframe()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.profiler._lock:
+                self.threads.pop(ident, None)
+
+    def sample(self, frame, anchor=None, root=None):
+        # The leaf keeps its line number, so time in C calls (json, numpy, redis
+        # parsing) shows which Python line made them
+        anchor = anchor or self.anchor
+        labels = [f"{_label(frame)}:{frame.f_lineno}"]
+        depth = 0
+        while frame is not None and depth < MAX_STACK_DEPTH:
+            if frame is anchor and root:
+                # The thread's own wrapper frame stands for the request
+                labels.append(root)
+            elif depth:
+                labels.append(_label(frame))
+            if frame is anchor:
+                self.stacks[";".join(reversed(labels))] += 1
+                return
+            frame = frame.f_back
+            depth += 1
+
+
+class _AttributingExecutor(ThreadPoolExecutor):
+    """
+    Default executor that tags each job with the profile session it was submitted from.
+    submit() runs on the event loop inside the request's context, so the session is
+    known there even though the job runs elsewhere.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        session = _current_session.get()
+        if session is None:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(session.run_in_thread, fn, args, kwargs)
+
+
+class _NullSession:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class Profiler:
+    def __init__(self, enabled=PROFILE_ENABLED, interval_ms=PROFILE_INTERVAL_MS, slow_ms=PROFILE_SLOW_MS,
+                 sample_rate=PROFILE_SAMPLE_RATE, out_dir=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.enabled = enabled
+        self.interval = interval_ms / 1000
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.out_dir = out_dir
+        self.recent = deque(maxlen=keep)
+        self._sessions = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._executor_loops = set()
+
+    def profile(self, kind, **tags):
+        """
+        `with profiler.profile("chat", mode=..., user_id=...):` around the code to profile.
+        """
+        if not self.enabled:
+            return _NullSession()
+        return ProfileSession(self, kind, tags)
+
+    def _install_executor(self):
+        # Once per event loop, on first use
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if id(loop) not in self._executor_loops:
+            self._executor_loops.add(id(loop))
+            loop.set_default_executor(_AttributingExecutor(thread_name_prefix="profiled"))
+
+    def _start(self, session):
+        self._install_executor()
+        with self._lock:
+            self._sessions.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _stop(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def _run(self):
+        while True:
+            # Sampling under the lock means a session is never sampled after _stop returns
+            with self._lock:
+                active = bool(self._sessions)
+                if active:
+                    frames = sys._current_frames()
+                    for session in self._sessions:
+                        frame = frames.get(session.thread_id)
+                        if frame is not None:
+                            session.sample(frame)
+                        for ident, anchor in session.threads.items():
+                            frame = frames.get(ident)
+                            if frame is not None:
+                                session.sample(frame, anchor, THREAD_ROOT)
+                    del frames
+            if not active:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            time.sleep(self.interval)
+
+    def _finish(self, session, duration_ms):
+        slow = duration_ms >= self.slow_ms
+        if not (slow or random.random() < self.sample_rate) or not session.stacks:
+            return
+        metrics.incr("profiles_captured_total", kind=session.kind, slow=str(slow).lower())
+        created = datetime.now(timezone.utc)
+        tag_part = "_".join(f"{v}" for v in session.tags.values() if v)
+        profile_id = f"{created.strftime('%Y%m%dT%H%M%S%f')}_{session.kind}" + (f"_{tag_part}" if tag_part else "")
+        profile_id = "".join(c if c.isalnum() or c in "-_." else "-" for c in profile_id)
+        collapsed = "\n".join(f"{stack} {count}" for stack, count in session.stacks.most_common())
+
+        path = None
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            path = os.path.join(self.out_dir, f"{profile_id}.collapsed")
+            with open(path, "w") as f:
+                f.write(collapsed + "\n")
+        except OSError as e:
+            print(f"[Profiler] Could not write {profile_id}: {e}")
+
+        self.recent.append({
+            "id": profile_id,
+            "kind": session.kind,
+            **session.tags,
+            "duration_ms": round(duration_ms, 1),
+            "samples": sum(session.stacks.values()),
+            "slow": slow,
+            "created_at": created.isoformat(),
+            "path": path,
+            "collapsed": collapsed,
+        })
+
+    def list_recent(self):
+        return [{k: v for k, v in p.items() if k != "collapsed"} for p in reversed(self.recent)]
+
+    def get(self, profile_id):
+        for p in self.recent:
+            if p["id"] == profile_id:
+                return p
+        return None
+
+
+profiler = Profiler()
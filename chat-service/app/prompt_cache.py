@@ -0,0 +1,150 @@
+import os
+import time
+import asyncio
+from dataclasses import dataclass
+from dotenv import load_dotenv
+from google.genai import types
+
+from . import metrics
+from .llm_policy import LLM_PRIMARY_MODEL
+from .memory_functions import get_highest_rfm_memories
+
+load_dotenv()
+
+# Chat prompts are split into a stable prefix (the mode's instructions plus the user's top
+# memories by RFM) and a per-turn suffix (history, retrieved memories, input). The prefix
+# comes first, so Gemini's implicit prefix caching can apply. Prefixes large enough for an
+# explicit cache are also stored with the cached-content API for the rest of the session.
+# Persona memories are only included when they make the prefix large enough for one;
+# otherwise the prefix is just the instructions.
+CONTEXT_CACHE = os.getenv("CONTEXT_CACHE", "1") == "1"
+CONTEXT_CACHE_TTL_SEC = int(os.getenv("CONTEXT_CACHE_TTL_SEC", "1800"))
+# Gemini rejects explicit caches below a model-specific size (1024 tokens on 2.5 Flash)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "1024"))
+CONTEXT_PERSONA_MEMORIES = int(os.getenv("CONTEXT_PERSONA_MEMORIES", "30"))
+# How often a session re-reads its top memories, and how many of them may be missing
+# from the prefix before it is rebuilt
+CONTEXT_CACHE_CHECK_SEC = float(os.getenv("CONTEXT_CACHE_CHECK_SEC", "60"))
+CONTEXT_CACHE_MAX_STALE = int(os.getenv("CONTEXT_CACHE_MAX_STALE", "2"))
+CONTEXT_CACHE_MAX_ENTRIES = 10000
+EXPIRY_MARGIN_SEC = 60
+CHARS_PER_TOKEN = 4  # rough, only used to skip caches that would be too small
+
+
+@dataclass
+class PromptPrefix:
+    text: str
+    model: str
+    memories: frozenset  # (memory key, text) rendered into the prefix
+    checked_at: float
+    cache_name: str = None
+    expires_at: float = 0.0
+    failed: bool = False  # set by LLMPolicy when a call using the cache is rejected
+
+    def cached(self, now=None):
+        return bool(self.cache_name) and not self.failed and (now or time.time()) < self.expires_at - EXPIRY_MARGIN_SEC
+
+
+def render_prefix(instructions, memories):
+    if not memories:
+        return instructions
+    known = "\n".join(f"- {mem.text}" for mem in memories)
+    return f"{instructions}\n\n**What you know about the user (most important first):**\n{known}"
+
+
+class PromptCache:
+    """
+    Per-process registry of each session's prompt prefixes, one per chat mode. A cache is
+    created in the background on first use, so that turn goes out with the prefix inline,
+    and is replaced once more than CONTEXT_CACHE_MAX_STALE of the user's top memories
+    have changed. end_session deletes the user's caches on logout.
+    """
+
+    def __init__(self, client, model=LLM_PRIMARY_MODEL, enabled=CONTEXT_CACHE, ttl=CONTEXT_CACHE_TTL_SEC,
+                 min_tokens=CONTEXT_CACHE_MIN_TOKENS, persona_memories=CONTEXT_PERSONA_MEMORIES):
+        self.client = client
+        self.model = model
+        self.enabled = enabled
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.persona_memories = persona_memories
+        self._entries = {}  # (user_id, mode) -> PromptPrefix
+        self._tasks = set()
+
+    async def prefix(self, redis_client, user_id, mode, instructions):
+        key = (user_id, mode)
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None and now - entry.checked_at < CONTEXT_CACHE_CHECK_SEC and not self._expired(entry, now):
+            metrics.incr("prompt_cache_requests_total", mode=mode, result="hit" if entry.cached(now) else "inline")
+            return entry
+
+        memories = []
+        if self.enabled and self.persona_memories:
+            memories = await get_highest_rfm_memories(redis_client, user_id, k=self.persona_memories, mode=f"prefix:{mode}")
+            if len(render_prefix(instructions, memories)) / CHARS_PER_TOKEN < self.min_tokens:
+                # No explicit cache for a prefix this small, so inline persona memories would be
+                # paid for on every turn (and /chat-rfm already has the top ones in its suffix)
+                memories = []
+        current = frozenset((mem.id, mem.text) for mem in memories)
+        if entry is not None and not self._expired(entry, now) and len(current - entry.memories) <= CONTEXT_CACHE_MAX_STALE:
+            entry.checked_at = now
+            metrics.incr("prompt_cache_requests_total", mode=mode, result="hit" if entry.cached(now) else "inline")
+            return entry
+
+        new = PromptPrefix(render_prefix(instructions, memories), self.model, current, checked_at=now)
+        if entry is not None and entry.cache_name:
+            self._spawn(self._delete(entry.cache_name))
+        if len(self._entries) >= CONTEXT_CACHE_MAX_ENTRIES:
+            self._sweep(now)
+        self._entries[key] = new
+        if self.enabled and len(new.text) / CHARS_PER_TOKEN >= self.min_tokens:
+            self._spawn(self._create(new, user_id, mode))
+        metrics.incr("prompt_cache_requests_total", mode=mode, result="refresh" if entry is not None else "miss")
+        return new
+
+    def _expired(self, entry, now):
+        # A cache that failed, or is about to expire, has to be rebuilt
+        return bool(entry.cache_name) and not entry.cached(now)
+
+    async def _create(self, entry, user_id, mode):
+        try:
+            cache = await self.client.aio.caches.create(
+                model=entry.model,
+                config=types.CreateCachedContentConfig(
+                    contents=[entry.text], ttl=f"{self.ttl}s", display_name=f"chat:{mode}:{user_id}"[:128],
+                ),
+            )
+        except Exception as e:
+            metrics.incr("prompt_cache_create_failed_total", mode=mode)
+            print(f"[PromptCache] Create failed for {user_id}/{mode}: {e}")
+            return
+        entry.cache_name = cache.name
+        entry.expires_at = time.time() + self.ttl
+        metrics.incr("prompt_cache_created_total", mode=mode)
+        if self._entries.get((user_id, mode)) is not entry:
+            # Replaced or ended while the create was in flight
+            await self._delete(cache.name)
+
+    async def _delete(self, name):
+        try:
+            await self.client.aio.caches.delete(name=name)
+        except Exception as e:
+            print(f"[PromptCache] Delete of {name} failed: {e}")
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _sweep(self, now):
+        # Drop sessions idle for a whole TTL; their caches have expired server-side
+        for key, entry in list(self._entries.items()):
+            if now - entry.checked_at > self.ttl:
+                del self._entries[key]
+
+    async def end_session(self, user_id):
+        for key in [k for k in self._entries if k[0] == user_id]:
+            entry = self._entries.pop(key)
+            if entry.cache_name:
+                await self._delete(entry.cache_name)
@@ -1,6 +1,7 @@
 import requests
 import time
 import os
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,9 +10,25 @@ RABBITMQ_API_URL = os.getenv("RABBITMQ_API_URL", "http://localhost:15672/api/que
 RABBITMQ_API_USER = os.getenv("RABBITMQ_API_USER", "guest")
 RABBITMQ_API_PASS = os.getenv("RABBITMQ_API_PASS", "guest")
 CLEANUP_INTERVAL_SEC = int(os.getenv("CLEANUP_INTERVAL_SEC", "60"))
+# Only delete queues idle this long. The API caches queue bindings for QUEUE_REDECLARE_SEC,
+# which must stay below this, so it never publishes to a queue that was just deleted.
+QUEUE_IDLE_SEC = int(os.getenv("QUEUE_IDLE_SEC", "300"))
 
 auth = (RABBITMQ_API_USER, RABBITMQ_API_PASS)
 
+def idle_seconds(queue):
+    # idle_since is absent while the queue is in use; formats differ across RabbitMQ versions
+    since = queue.get('idle_since')
+    if not since:
+        return 0.0
+    try:
+        ts = datetime.fromisoformat(since.replace(' ', 'T'))
+    except ValueError:
+        return 0.0
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - ts).total_seconds()
+
 def cleanup_empty_queues():
     try:
         resp = requests.get(RABBITMQ_API_URL, auth=auth, timeout=10)
@@ -19,7 +36,7 @@ def cleanup_empty_queues():
         for queue in resp.json():
             name = queue['name']
             if name.startswith("message_logs_user_") or name.startswith("memory_tasks_user_"):
-                if queue['messages'] == 0:
+                if queue['messages'] == 0 and idle_seconds(queue) >= QUEUE_IDLE_SEC:
                     vhost = queue['vhost'].replace('/', '%2F')
                     del_url = f"{RABBITMQ_API_URL.rsplit('/api/queues', 1)[0]}/api/queues/{vhost}/{name}"
                     r = requests.delete(del_url, auth=auth, timeout=10)
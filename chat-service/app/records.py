@@ -0,0 +1,164 @@
+import os
+from dataclasses import dataclass
+import numpy as np
+from dotenv import load_dotenv
+
+from .embedding_codec import stack_embeddings
+
+load_dotenv()
+
+# Typed records for memories and chats read back from Redis, and for retrieval results.
+# Numeric fields are parsed once, when the hash is read. A MemoryBatch keeps all of its
+# embeddings in one contiguous float32 matrix; each Memory holds a row view into it.
+
+# Embedding size, passed to the embedding model as its output dimensionality. Sizes other
+# than the model's native 768 live in their own hash field (embedding_<dim>), so indexes of
+# two sizes can exist side by side during a migration (migrate_embeddings.py).
+EMB_NATIVE_DIM = 768
+EMB_DIM = int(os.getenv("EMBEDDING_DIM", str(EMB_NATIVE_DIM)))
+EMB_BYTES = EMB_DIM * 4
+
+
+def embedding_field(dim=EMB_DIM):
+    return "embedding" if dim == EMB_NATIVE_DIM else f"embedding_{dim}"
+
+
+EMB_FIELD = embedding_field()
+_EMB_KEY = EMB_FIELD.encode()
+
+REQUIRED_MEMORY_FIELDS = [
+    "id", "user_id", "memory_text", "embedding", "magnitude",
+    "last_used", "frequency", "rfm_score", "created_at"
+]
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _required_text(fields, name):
+    # `name` is the bytes field name, as HGETALL replies are keyed
+    value = fields.get(name)
+    if not value or value.isspace():
+        raise ValueError(f"missing {name.decode()}")
+    return _text(value)
+
+
+@dataclass(slots=True)
+class Memory:
+    id: str
+    user_id: str
+    memory_text: str
+    embedding: np.ndarray  # float32 (EMB_DIM,) view
+    created_at: str
+    last_used: str
+    frequency: int
+    magnitude: float
+    rfm_score: float
+    redis_key: str = None
+
+    @classmethod
+    def from_redis(cls, key, fields, row=None):
+        """
+        Parse an HGETALL reply (bytes keys and values). The embedding is a zero-copy view
+        of the reply's bytes, or `row` when the caller copies the vector there itself.
+        Raises ValueError for a hash that cannot be persisted.
+        """
+        emb = fields.get(_EMB_KEY)
+        if emb is None or len(emb) != EMB_BYTES:
+            raise ValueError("bad embedding")
+        return cls(
+            id=_required_text(fields, b"id"),
+            user_id=_required_text(fields, b"user_id"),
+            memory_text=_required_text(fields, b"memory_text"),
+            embedding=np.frombuffer(emb, dtype=np.float32) if row is None else row,
+            created_at=_required_text(fields, b"created_at"),
+            last_used=_required_text(fields, b"last_used"),
+            frequency=int(_required_text(fields, b"frequency")),
+            magnitude=float(_required_text(fields, b"magnitude")),
+            rfm_score=float(_required_text(fields, b"rfm_score")),
+            redis_key=_text(key),
+        )
+
+
+class MemoryBatch:
+    """
+    A user's memories with their embeddings in one (n, EMB_DIM) float32 matrix; each
+    record's embedding is a row view. `skipped` counts hashes that could not be parsed.
+    """
+
+    __slots__ = ("records", "matrix", "skipped")
+
+    def __init__(self, records, matrix=None, skipped=0):
+        if matrix is None:
+            matrix = stack_embeddings([m.embedding for m in records], EMB_DIM)
+            for mem, row in zip(records, matrix):
+                mem.embedding = row
+        self.records = records
+        self.matrix = matrix
+        self.skipped = skipped
+
+    @classmethod
+    def from_redis(cls, keys, hashes):
+        """
+        Parse HGETALL replies in key order. `hashes` may be a generator: each embedding
+        is copied into its matrix row as it is parsed, so the reply can be freed right away.
+        """
+        matrix = np.empty((len(keys), EMB_DIM), dtype=np.float32)
+        flat = memoryview(matrix).cast("B")
+        records, skipped = [], 0
+        for key, fields in zip(keys, hashes):
+            n = len(records)
+            try:
+                mem = Memory.from_redis(key, fields, row=matrix[n])
+            except (TypeError, ValueError):
+                skipped += 1
+                continue
+            # A byte copy into the row; viewing the reply as an array first costs more
+            flat[n * EMB_BYTES:(n + 1) * EMB_BYTES] = fields[_EMB_KEY]
+            records.append(mem)
+        return cls(records, matrix[:len(records)], skipped)
+
+    def select(self, mask):
+        if mask.all():
+            return self
+        return MemoryBatch([m for m, ok in zip(self.records, mask) if ok], skipped=self.skipped)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+@dataclass(slots=True)
+class ChatRecord:
+    id: str
+    user_id: str
+    user_message: str = None
+    bot_response: str = None
+    timestamp: str = None
+    redis_key: str = None
+
+    @classmethod
+    def from_redis(cls, key, fields):
+        return cls(
+            id=_required_text(fields, b"id"),
+            user_id=_required_text(fields, b"user_id"),
+            user_message=_text(fields.get(b"user_message")),
+            bot_response=_text(fields.get(b"bot_response")),
+            timestamp=_text(fields.get(b"timestamp")),
+            redis_key=_text(key),
+        )
+
+
+@dataclass(slots=True)
+class MemoryHit:
+    # One retrieved memory; `id` is the full Redis key and `sim` the cosine distance
+    id: str
+    text: str
+    sim: float = None
+    rfm_score: float = None
+    score: float = None
+    created_at: str = None
+    last_used: str = None
@@ -1,90 +1,296 @@
 import redis
-import numpy as np
+from redis.cluster import RedisCluster, ClusterNode
 from datetime import datetime, timezone
 import json
+import uuid
 from dotenv import load_dotenv
 import os
 
+from .embedding_codec import from_pgvector_text
+from .records import MemoryBatch, ChatRecord, EMB_FIELD, EMB_BYTES
+
 load_dotenv()
 #docker exec -it redis-stack redis-cli
 
+# Cluster mode: REDIS_CLUSTER=1 and REDIS_CLUSTER_NODES=host:port,host:port,...
+REDIS_CLUSTER = os.environ.get('REDIS_CLUSTER', '0') == '1'
+REDIS_CLUSTER_NODES = os.environ.get('REDIS_CLUSTER_NODES', '')
+# How long consumers remember processed message ids, to skip broker redeliveries
+PROCESSED_TTL_SEC = int(os.environ.get('PROCESSED_TTL_SEC', '86400'))
+# In-progress claim on a message id. A worker that dies mid-task leaves it to expire after
+# this, and the redelivery then runs the task again.
+CLAIM_TTL_SEC = int(os.environ.get('CLAIM_TTL_SEC', '300'))
+MESSAGE_DONE = "done"
+
+# Delete a key only while it still holds the caller's token
+DELETE_IF_EQUAL_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# Queue a turn for the summary once per message id: the done marker and the push are one step
+PUSH_SUMMARY_ONCE_SCRIPT = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[2], ARGV[3])
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[4]), -1)
+return 1
+"""
+# Hashes fetched per pipeline when reading a whole session back (logout)
+HGETALL_CHUNK_SIZE = 500
+
+
+def epoch_seconds(iso):
+    # ISO-8601 timestamp -> epoch seconds for the NUMERIC *_ts index fields
+    if not iso:
+        return None
+    try:
+        ts = datetime.fromisoformat(iso.replace('Z', '+00:00'))
+    except (TypeError, ValueError):
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return round(ts.timestamp(), 3)
+
+# ISO field -> NUMERIC epoch copy kept next to it in the hash, for range filters and sorting
+MEMORY_EPOCH_FIELDS = {"created_at": "created_ts", "last_used": "last_used_ts"}
+CHAT_EPOCH_FIELDS = {"timestamp": "timestamp_ts"}
+
+
+# Every per-user key carries the user id as a hash tag, so all of a user's memories,
+# chats and summary state hash to one cluster slot and live on one node.
+def user_tag(user_id):
+    return f"{{{user_id}}}"
+
+def memory_key(user_id, mem_id):
+    return f"memories:{user_tag(user_id)}:{mem_id}"
+
+def chat_key(user_id, chat_id):
+    return f"chat:{user_tag(user_id)}:{chat_id}"
+
+def summary_key(user_id):
+    return f"summary:{user_tag(user_id)}"
+
+def summary_pending_key(user_id):
+    return f"summary_pending:{user_tag(user_id)}"
+
+def summary_lock_key(user_id):
+    return f"summary_lock:{user_tag(user_id)}"
+
+def memory_lock_key(user_id):
+    return f"memory_lock:{user_tag(user_id)}"
+
+def processed_key(user_id, consumer, message_id):
+    return f"processed:{user_tag(user_id)}:{consumer}:{message_id}"
+
+def magnitude_pending_key(user_id):
+    return f"magnitude_pending:{user_tag(user_id)}"
+
+def memory_version_key(user_id):
+    return f"memory_version:{user_tag(user_id)}"
+
+
+# Per-user memory version counters, in one hash: "content" is bumped by every memory
+# write or delete, "stats" by every access-stat update (frequency, last_used, rfm_score).
+# Retrieval caches key on them. Always bumped after the write it covers, and never reset.
+def bump_memory_version(client, user_id, field="content"):
+    client.hincrby(memory_version_key(user_id), field, 1)
+
+def read_memory_version(client, user_id):
+    content, stats = client.hmget(memory_version_key(user_id), "content", "stats")
+    return int(content or 0), int(stats or 0)
+
+
 class RedisManager:
     def __init__(self, host=None, port=None, db=0):
         host = host or os.environ.get('REDIS_HOST', 'localhost')
         port = port or int(os.environ.get('REDIS_PORT', 6379))
         db = db or int(os.environ.get('REDIS_DB', 0))
-        self.client = redis.Redis(host=host, port=port, db=db)
-        self.client = redis.Redis(host=host, port=port, db=db)
+        self.cluster = REDIS_CLUSTER
+        if self.cluster:
+            nodes = [n.rsplit(':', 1) for n in REDIS_CLUSTER_NODES.split(',') if n] or [(host, port)]
+            self.client = RedisCluster(startup_nodes=[ClusterNode(h, int(p)) for h, p in nodes])
+        else:
+            self.client = redis.Redis(host=host, port=port, db=db)
+
+    def for_user(self, user_id):
+        """
+        Client for everything touching one user's keys, searches included. In cluster
+        mode this is a direct connection to the primary owning the user's slot: each
+        node indexes only its own keys, so FT.SEARCH must run there.
+        """
+        if not self.cluster:
+            return self.client
+        node = self.client.get_node_from_key(memory_key(user_id, ""))
+        return self.client.get_redis_connection(node)
 
-    def store_memory(self, user_id, mem_id, memory_dict):
-        key = f"memories:{user_id}:{mem_id}"
+    def primaries(self):
+        # One plain client per primary (just the single client outside cluster mode)
+        if not self.cluster:
+            return [self.client]
+        return [self.client.get_redis_connection(n) for n in self.client.get_primaries()]
+
+    def store_memory(self, user_id, mem_id, memory_dict, pipe=None, bump_version=True):
+        key = memory_key(user_id, mem_id)
         mapping = {}
         for k, v in memory_dict.items():
             if k == 'embedding':
                 # If it's already bytes, use as-is; if it's a string, convert from JSON
-                if isinstance(v, bytes):
-                    mapping[k] = v
-                elif isinstance(v,list):
-                    mapping[k] = np.array(v, dtype=np.float32).tobytes()
-                else:
-                    mapping[k] = np.array(json.loads(v), dtype=np.float32).tobytes()
+                if not isinstance(v, bytes):
+                    # pgvector text from Supabase, or a list of floats
+                    v = from_pgvector_text(v)
+                if len(v) < EMB_BYTES:
+                    raise ValueError(f"memory {mem_id}: embedding has {len(v) // 4} dimensions, expected {EMB_BYTES // 4}")
+                # Rows saved before a switch to a smaller EMBEDDING_DIM are truncated to its
+                # leading dimensions, which the embedding model's reduced outputs match
+                mapping[EMB_FIELD] = v[:EMB_BYTES]
             else:
                 mapping[k] = str(v) if not isinstance(v, str) else v
-        self.client.hset(key, mapping=mapping)
+                if k in MEMORY_EPOCH_FIELDS:
+                    ts = epoch_seconds(mapping[k])
+                    if ts is not None:
+                        mapping[MEMORY_EPOCH_FIELDS[k]] = ts
+        client = pipe or self.for_user(user_id)
+        client.hset(key, mapping=mapping)
+        if bump_version:
+            bump_memory_version(client, user_id)
 
-    def store_chat(self, user_id, chat_id, chat_dict):
-        key = f"chat:{user_id}:{chat_id}"
-        self.client.hset(key, mapping=chat_dict)
+    def store_chat(self, user_id, chat_id, chat_dict, pipe=None):
+        key = chat_key(user_id, chat_id)
+        mapping = dict(chat_dict)
+        for iso_field, epoch_field in CHAT_EPOCH_FIELDS.items():
+            ts = epoch_seconds(mapping.get(iso_field))
+            if ts is not None:
+                mapping[epoch_field] = ts
+        (pipe or self.for_user(user_id)).hset(key, mapping=mapping)
 
-    def load_user_data(self, user_id, memories, chats):
+    def push_summary_turn(self, user_id, turn_dict, max_pending=50, message_id=None):
+        """
+        Queue an exchange for folding into the rolling conversation summary. With a
+        message id, a redelivered turn is not queued twice. Returns False if it was skipped.
+        """
+        key = summary_pending_key(user_id)
+        if message_id:
+            return bool(self.for_user(user_id).eval(
+                PUSH_SUMMARY_ONCE_SCRIPT, 2, processed_key(user_id, "message_log", message_id), key,
+                MESSAGE_DONE, PROCESSED_TTL_SEC, json.dumps(turn_dict), max_pending,
+            ))
+        pipe = self.for_user(user_id).pipeline()
+        pipe.rpush(key, json.dumps(turn_dict))
+        pipe.ltrim(key, -max_pending, -1)
+        pipe.execute()
+        return True
+
+    def claim_message(self, user_id, consumer, message_id):
+        """
+        Claim a message id before handling it. Returns a token if this delivery should
+        run it, MESSAGE_DONE if it was handled already, or None while another delivery
+        holds the claim. One key per message, so each id is forgotten on its own schedule.
+        """
+        client = self.for_user(user_id)
+        key = processed_key(user_id, consumer, message_id)
+        token = uuid.uuid4().hex
+        if client.set(key, token, nx=True, ex=CLAIM_TTL_SEC):
+            return token
+        return MESSAGE_DONE if client.get(key) == MESSAGE_DONE.encode() else None
+
+    def finish_message(self, user_id, consumer, message_id):
+        # Its writes are in: remember the id for PROCESSED_TTL_SEC
+        self.for_user(user_id).set(processed_key(user_id, consumer, message_id), MESSAGE_DONE, ex=PROCESSED_TTL_SEC)
+
+    def release_message(self, user_id, consumer, message_id, token):
+        # Handling failed: drop our claim so a redelivery runs the message again
+        self.for_user(user_id).eval(DELETE_IF_EQUAL_SCRIPT, 1, processed_key(user_id, consumer, message_id), token)
+
+    def get_summary_context(self, user_id):
+        # Returns (summary_text, number of turns not yet folded into it)
+        pipe = self.for_user(user_id).pipeline()
+        pipe.get(summary_key(user_id))
+        pipe.llen(summary_pending_key(user_id))
+        summary, pending = pipe.execute()
+        return (summary.decode() if summary else ""), pending
+
+    def get_summary_turns(self, user_id, n):
+        raw = self.for_user(user_id).lrange(summary_pending_key(user_id), 0, n - 1)
+        return [json.loads(r) for r in raw]
+
+    def set_summary(self, user_id, summary_text, folded_turns):
+        # Store the new summary and drop the turns it now covers in one round-trip
+        pipe = self.for_user(user_id).pipeline()
+        pipe.set(summary_key(user_id), summary_text)
+        pipe.ltrim(summary_pending_key(user_id), folded_turns, -1)
+        pipe.execute()
+
+    def load_memories(self, user_id, memories):
+        # One pipelined round-trip per batch of memories
+        pipe = self.for_user(user_id).pipeline(transaction=False)
         for mem in memories:
-            mem_id = mem['id']
-            self.store_memory(user_id, mem_id, mem)
+            try:
+                self.store_memory(user_id, mem['id'], mem, pipe=pipe, bump_version=False)
+            except ValueError as e:
+                # A malformed stored embedding loses that memory, not the whole login
+                print(f"[Redis] Skipping memory on load: {e}")
+        bump_memory_version(pipe, user_id)
+        pipe.execute()
+
+    def load_chats(self, user_id, chats):
+        pipe = self.for_user(user_id).pipeline(transaction=False)
         for chat in chats:
-            chat_id = chat['id']
-            self.store_chat(user_id, chat_id, chat)
+            self.store_chat(user_id, chat['id'], chat, pipe=pipe)
+        pipe.execute()
+
+    def seed_summary(self, user_id, chats):
+        # Seed the rolling summary with the most recent persisted turns
+        recent = sorted(chats, key=lambda c: c.get('timestamp') or "")[-10:]
+        for chat in recent:
+            self.push_summary_turn(user_id, {
+                "user_message": chat.get("user_message"),
+                "bot_response": chat.get("bot_response"),
+            })
+
+    def load_user_data(self, user_id, memories, chats):
+        self.load_memories(user_id, memories)
+        self.load_chats(user_id, chats)
+        self.seed_summary(user_id, chats)
     
+    def _user_keys(self, user_id, prefix):
+        client = self.for_user(user_id)
+        return list(client.scan_iter(match=f"{prefix}:{user_tag(user_id)}:*", count=1000))
+
+    def _hgetall_many(self, user_id, keys, chunk=HGETALL_CHUNK_SIZE):
+        # One pipeline per chunk, so only one chunk of raw replies is alive at a time
+        client = self.for_user(user_id)
+        for i in range(0, len(keys), chunk):
+            pipe = client.pipeline(transaction=False)
+            for key in keys[i:i + chunk]:
+                pipe.hgetall(key)
+            yield from pipe.execute()
+
     def get_user_memories(self, user_id):
-        pattern = f"memories:{user_id}:*"
-        keys = self.client.keys(pattern)
-        memories = []
-        for key in keys:
-            mem = self.client.hgetall(key)
-            decoded_mem = {}
-            for k, v in mem.items():
-                k = k.decode() if isinstance(k, bytes) else k
-                if k == "embedding":
-                    decoded_mem[k] = np.frombuffer(v, dtype=np.float32)
-                else:
-                    decoded_mem[k] = v.decode() if isinstance(v, bytes) else v
-            decoded_mem["__redis_key__"] = key.decode() if isinstance(key, bytes) else key
-            memories.append(decoded_mem)
-        return memories
+        # MemoryBatch: parsed records over one contiguous embedding matrix
+        keys = self._user_keys(user_id, "memories")
+        return MemoryBatch.from_redis(keys, self._hgetall_many(user_id, keys))
 
     def get_user_chats(self, user_id):
-        pattern = f"chat:{user_id}:*"
-        keys = self.client.keys(pattern)
+        keys = self._user_keys(user_id, "chat")
         chats = []
-        for key in keys:
-            chat = self.client.hgetall(key)
-            decoded_chat = {}
-            for k, v in chat.items():
-                k = k.decode() if isinstance(k, bytes) else k
-                decoded_chat[k] = v.decode() if isinstance(v, bytes) else v
-            decoded_chat["__redis_key__"] = key.decode() if isinstance(key, bytes) else key
-            chats.append(decoded_chat)
+        for key, chat in zip(keys, self._hgetall_many(user_id, keys)):
+            try:
+                chats.append(ChatRecord.from_redis(key, chat))
+            except ValueError:
+                continue
         return chats
     
     def clear_user_data(self, user_id):
         # Remove all memory and chat keys for this user
-        mem_keys = self.client.keys(f"memories:{user_id}:*")
-        chat_keys = self.client.keys(f"chat:{user_id}:*")
+        mem_keys = self._user_keys(user_id, "memories")
+        chat_keys = self._user_keys(user_id, "chat")
         total_keys = mem_keys + chat_keys 
         decoded_keys = [key.decode('utf-8') for key in total_keys]
+        decoded_keys += [summary_key(user_id), summary_pending_key(user_id), magnitude_pending_key(user_id)]
         if decoded_keys:
-          self.client.delete(*decoded_keys)
+          self.for_user(user_id).delete(*decoded_keys)
+        bump_memory_version(self.for_user(user_id), user_id)
         return len(total_keys) 
-          
-            
-
-    
\ No newline at end of file
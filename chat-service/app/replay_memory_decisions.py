@@ -0,0 +1,77 @@
+import sys
+import json
+import argparse
+from collections import Counter
+
+from .memory_functions import fast_path_decision, MEMORY_FAST_ADD_DISTANCE, MEMORY_FAST_DUPLICATE_DISTANCE
+from .records import MemoryHit
+
+# Replays logged LLM memory decisions (MEMORY_DECISION_LOG, ideally captured with
+# MEMORY_FAST_PATH_SHADOW=1) through the fast-path thresholds and reports how often
+# each path would fire and how often it agrees with the LLM.
+# Usage: python -m app.replay_memory_decisions decisions.jsonl --add 0.4 0.45 0.5 --dup 0.03 0.05
+
+
+def agrees(path, llm_decision):
+    if path == "fast_override_duplicate":
+        # A near-exact duplicate is handled correctly by either reinforcing or skipping it
+        return llm_decision in ("override:1", "none")
+    return llm_decision == "add"
+
+
+def replay(records, add_distance, duplicate_distance):
+    fired = Counter()
+    agreed = Counter()
+    for rec in records:
+        dec, path = fast_path_decision(rec["neighbors"], add_distance, duplicate_distance)
+        if dec is None:
+            fired["llm"] += 1
+            continue
+        fired[path] += 1
+        if agrees(path, rec["llm_decision"]):
+            agreed[path] += 1
+    return fired, agreed
+
+
+def load_records(path):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rec = json.loads(line)
+                if rec.get("llm_decision"):
+                    rec["neighbors"] = [MemoryHit(**n) for n in rec["neighbors"]]
+                    records.append(rec)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay memory decisions against fast-path thresholds")
+    parser.add_argument("log", help="JSONL file written via MEMORY_DECISION_LOG")
+    parser.add_argument("--add", type=float, nargs="+", default=[MEMORY_FAST_ADD_DISTANCE])
+    parser.add_argument("--dup", type=float, nargs="+", default=[MEMORY_FAST_DUPLICATE_DISTANCE])
+    args = parser.parse_args()
+
+    records = load_records(args.log)
+    if not records:
+        print("No LLM decisions found in log.")
+        sys.exit(1)
+    print(f"Replaying {len(records)} logged decisions "
+          f"(LLM mix: {dict(Counter(r['llm_decision'].split(':')[0] for r in records))})\n")
+
+    paths = ["fast_add_no_neighbors", "fast_add_far", "fast_override_duplicate"]
+    print(f"{'add':>6}{'dup':>6}{'LLM calls saved':>17}" + "".join(f"{p:>26}" for p in paths))
+    for add_distance in args.add:
+        for duplicate_distance in args.dup:
+            fired, agreed = replay(records, add_distance, duplicate_distance)
+            saved = len(records) - fired["llm"]
+            cells = "".join(
+                f"{fired[p]:>12} ({agreed[p] / fired[p]:>6.1%} agree)" if fired[p] else f"{'-':>26}"
+                for p in paths
+            )
+            print(f"{add_distance:>6.2f}{duplicate_distance:>6.2f}{saved / len(records):>17.1%}{cells}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from . import metrics
+from .redis_class import read_memory_version
+
+load_dotenv()
+
+# Per-process cache of retrieval results (RFM top-k and KNN lookups), keyed by the user's
+# memory version counters from Redis. Any memory write or access-stat update bumps a
+# counter, so stale entries are never served; they just age out of the LRU. Checking the
+# version is one HMGET instead of an FT.SEARCH.
+RETRIEVAL_CACHE = os.getenv("RETRIEVAL_CACHE", "1") == "1"
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", "2048"))
+
+
+def embedding_digest(vec):
+    # float32 query vector -> short stable key
+    return hashlib.blake2b(vec.tobytes(), digest_size=16).digest()
+
+
+class RetrievalCache:
+    def __init__(self, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, enabled=RETRIEVAL_CACHE):
+        self.max_entries = max_entries
+        self.enabled = enabled and max_entries > 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def version(self, redis_client, user_id):
+        # (content, stats) counters, or None when caching is off
+        if not self.enabled:
+            return None
+        return read_memory_version(redis_client, user_id)
+
+    def get(self, key, kind, mode):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+        metrics.incr("retrieval_cache_requests_total", kind=kind, mode=mode, result="miss" if value is None else "hit")
+        return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+retrieval_cache = RetrievalCache()
@@ -1,46 +1,42 @@
 import numpy as np
-import re
 
-REQUIRED_MEMORY_FIELDS = [
-    "id", "user_id", "memory_text", "embedding", "magnitude",
-    "last_used", "frequency", "rfm_score", "created_at"
-]
+from .embedding_codec import to_pgvector_text
 
-EMB_DIM = 768
+# Rows carry only the table columns; Redis-only fields (the NUMERIC epoch copies
+# for the indexes) are never read into the records.
 
 def serialize_memory(mem):
-    # Converts a memory dict for safe Supabase upsert
-    serialized = {}
-    for k, v in mem.items():
-        if k == "embedding":
-            if isinstance(v, np.ndarray):
-                serialized[k] = v.tolist()
-            else:
-                serialized[k] = v  # Already a list or None
-        elif k != "__redis_key__":
-            serialized[k] = v
-    return serialized
+    # Converts a Memory record for safe Supabase upsert
+    return {
+        "id": mem.id,
+        "user_id": mem.user_id,
+        "memory_text": mem.memory_text,
+        # Straight from the float32 row to a pgvector text literal
+        "embedding": to_pgvector_text(mem.embedding),
+        "magnitude": mem.magnitude,
+        "last_used": mem.last_used,
+        "frequency": mem.frequency,
+        "rfm_score": mem.rfm_score,
+        "created_at": mem.created_at,
+    }
 
 def serialize_chat(chat):
-    # Converts a chat dict for safe Supabase upsert
-    return {k: v for k, v in chat.items() if k != "__redis_key__"}
+    # Converts a ChatRecord for safe Supabase upsert
+    return {
+        "id": chat.id,
+        "user_id": chat.user_id,
+        "user_message": chat.user_message,
+        "bot_response": chat.bot_response,
+        "timestamp": chat.timestamp,
+    }
 
-import numpy as np
- 
 
-def is_valid_memory(mem):
-    # Check for presence of all required fields
-    for field in REQUIRED_MEMORY_FIELDS:
-        if field not in mem or mem[field] is None or (isinstance(mem[field], str) and not mem[field].strip()):
-            return False
-    # Check embedding shape
-    emb = mem["embedding"]
-    if not isinstance(emb, np.ndarray) or emb.size != EMB_DIM:
-        return False
-    # Check numeric fields
-    try:
-        float(mem["magnitude"])
-        int(mem["frequency"])
-    except (TypeError, ValueError):
-        return False
-    return True
+def filter_valid_memories(batch):
+    """
+    Return the part of a MemoryBatch that can be upserted. Required fields and numbers
+    were checked when the hashes were parsed; embeddings are checked here in one pass
+    over the stacked matrix.
+    """
+    if not len(batch):
+        return batch
+    return batch.select(np.isfinite(batch.matrix).all(axis=1))
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import struct
+import hashlib
+import numpy as np
+from dotenv import load_dotenv
+
+from .records import EMB_DIM
+
+load_dotenv()
+
+# Local snapshots of a logged-out session, so a quick re-login is read from disk instead
+# of the database. Layout of one file:
+#   magic (8 bytes) | header length (uint64 LE) | JSON header | padding | float32 matrix
+# The header carries the version stamp, the memory and chat metadata as columns, and the
+# offset of the (n, dim) embedding matrix, which is aligned so it can be memory-mapped.
+SESSION_SNAPSHOT_DIR = os.getenv("SESSION_SNAPSHOT_DIR", "")  # empty disables snapshots
+SESSION_SNAPSHOT_MAX_AGE_SEC = int(os.getenv("SESSION_SNAPSHOT_MAX_AGE_SEC", str(7 * 86400)))
+MAGIC = b"CHATSNP1"
+ALIGN = 64
+
+MEMORY_META = ["id", "user_id", "memory_text", "created_at", "last_used", "frequency", "magnitude", "rfm_score"]
+CHAT_META = ["id", "user_id", "user_message", "bot_response", "timestamp"]
+
+
+class Snapshot:
+    """
+    An open snapshot. `matrix` is a read-only memmap: embeddings are paged in from disk
+    as rows are read.
+    """
+
+    def __init__(self, path, header, matrix):
+        self.path = path
+        self.version = header["version"]
+        self.user_id = header["user_id"]
+        self.written_at = header["written_at"]
+        self.memories = header["memories"]
+        self.chats = header["chats"]
+        self.matrix = matrix
+
+    def memory_rows(self, start, stop):
+        # Rows in the shape load_memories takes, embeddings as float32 bytes
+        cols = self.memories
+        for i in range(start, min(stop, len(self.matrix))):
+            row = {name: cols[name][i] for name in MEMORY_META}
+            row["embedding"] = self.matrix[i].tobytes()
+            yield row
+
+    def chat_rows(self):
+        cols = self.chats
+        for i in range(len(cols["id"])):
+            # Absent fields stay absent, as in the Redis hash they came from
+            yield {name: cols[name][i] for name in CHAT_META if cols[name][i] is not None}
+
+
+def _columns(records, names):
+    return {name: [getattr(r, name) for r in records] for name in names}
+
+
+def write_snapshot(path, user_id, version, memories, chats):
+    """
+    Write a MemoryBatch and ChatRecords atomically (temp file, then rename).
+    """
+    matrix = np.ascontiguousarray(memories.matrix, dtype=np.float32)
+    chats = sorted(chats, key=lambda c: c.timestamp or "")  # oldest first, like the database load
+    header = {
+        "version": version,
+        "user_id": user_id,
+        "written_at": time.time(),
+        "dim": EMB_DIM,
+        "count": len(memories),
+        "memories": _columns(memories.records, MEMORY_META),
+        "chats": _columns(chats, CHAT_META),
+    }
+    body = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    head = len(MAGIC) + 8 + len(body)
+    padding = b"\0" * (-head % ALIGN)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(body) + len(padding)))
+        f.write(body)
+        f.write(padding)
+        f.write(matrix.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return head + len(padding) + matrix.nbytes
+
+
+def read_snapshot(path):
+    """
+    Open a snapshot, or return None if it is missing or not in the current format.
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            (length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(length).rstrip(b"\0"))
+    except (OSError, ValueError, struct.error):
+        return None
+    if header.get("dim") != EMB_DIM:
+        return None
+    n = header["count"]
+    offset = len(MAGIC) + 8 + length
+    if n:
+        try:
+            matrix = np.memmap(path, dtype=np.float32, mode="r", offset=offset, shape=(n, EMB_DIM))
+        except ValueError:  # truncated
+            return None
+    else:
+        matrix = np.empty((0, EMB_DIM), dtype=np.float32)
+    return Snapshot(path, header, matrix)
+
+
+class SnapshotDir:
+    def __init__(self, root=SESSION_SNAPSHOT_DIR, max_age=SESSION_SNAPSHOT_MAX_AGE_SEC):
+        self.root = root
+        self.max_age = max_age
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, user_id):
+        # User ids are not filename-safe
+        return os.path.join(self.root, hashlib.sha1(user_id.encode("utf-8")).hexdigest() + ".snap")
+
+    def write(self, user_id, version, memories, chats):
+        return write_snapshot(self.path(user_id), user_id, version, memories, chats)
+
+    def open(self, user_id):
+        snap = read_snapshot(self.path(user_id))
+        if snap is None or snap.user_id != user_id:
+            return None
+        if time.time() - snap.written_at > self.max_age:
+            self.remove(user_id)
+            return None
+        return snap
+
+    def remove(self, user_id):
+        try:
+            os.remove(self.path(user_id))
+        except FileNotFoundError:
+            pass
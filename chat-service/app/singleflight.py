@@ -0,0 +1,42 @@
+import asyncio
+import hashlib
+
+from . import metrics
+
+
+def flight_key(*parts) -> str:
+    """
+    Stable key for a call from its identifying parts (user id, mode, input text...).
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+class SingleFlight:
+    """
+    Collapses identical concurrent calls into one: the first caller for a key runs the
+    coroutine, later callers with the same key await the same result (or exception).
+    The shared call is shielded, so one caller going away does not cancel it for the rest.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is not None:
+            metrics.incr("singleflight_shared_total", group=self.name)
+            return await asyncio.shield(task)
+
+        metrics.incr("singleflight_leader_total", group=self.name)
+        task = asyncio.ensure_future(fn())
+        self._calls[key] = task
+        task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+    def in_flight(self):
+        return len(self._calls)
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import queue
+import threading
+import contextvars
+from collections import namedtuple
+from contextlib import contextmanager
+import requests
+from dotenv import load_dotenv
+
+from . import metrics
+
+load_dotenv()
+
+# Minimal tracing across the API and the workers. Trace context travels between processes
+# as a W3C `traceparent` header on the queue messages. Finished spans go to a JSONL file
+# or to an OTLP/HTTP collector (JSON encoding), from a background thread.
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "")  # "" (off), "file" or "otlp"
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_FLUSH_SEC = 1.0
+TRACE_BATCH_MAX = 512
+TRACE_QUEUE_MAX = 10000
+
+SpanContext = namedtuple("SpanContext", "trace_id span_id")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+_service = {"name": os.getenv("TRACE_SERVICE_NAME", "chat-service")}
+
+
+def configure(service_name):
+    _service["name"] = service_name
+
+
+def parse_traceparent(value):
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "ignore")
+    if not value:
+        return None
+    parts = value.split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return SpanContext(parts[1], parts[2])
+
+
+def current_traceparent():
+    ctx = _current.get()
+    return f"00-{ctx.trace_id}-{ctx.span_id}-01" if ctx else None
+
+
+def current_trace_id():
+    ctx = _current.get()
+    return ctx.trace_id if ctx else None
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Record a span around the block; yields its attribute dict so callers can add
+    results. Without an explicit `parent` it nests under the current span, or starts
+    a new trace.
+    """
+    parent = parent or _current.get()
+    ctx = SpanContext(parent.trace_id if parent else os.urandom(16).hex(), os.urandom(8).hex())
+    token = _current.set(ctx)
+    record = {
+        "trace_id": ctx.trace_id,
+        "span_id": ctx.span_id,
+        "parent_span_id": parent.span_id if parent else None,
+        "name": name,
+        "attributes": attributes,
+        "start_ns": time.time_ns(),
+        "error": None,
+    }
+    try:
+        yield attributes
+    except BaseException as e:
+        record["error"] = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        record["end_ns"] = time.time_ns()
+        _exporter.export(record)
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(records, service_name):
+    spans = []
+    for r in records:
+        otlp = {
+            "traceId": r["trace_id"],
+            "spanId": r["span_id"],
+            "name": r["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(r["start_ns"]),
+            "endTimeUnixNano": str(r["end_ns"]),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in r["attributes"].items() if v is not None],
+            "status": {"code": 2, "message": r["error"]} if r["error"] else {"code": 1},
+        }
+        if r["parent_span_id"]:
+            otlp["parentSpanId"] = r["parent_span_id"]
+        spans.append(otlp)
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service_name}}]},
+        "scopeSpans": [{"scope": {"name": "chat-service"}, "spans": spans}],
+    }]}
+
+
+class SpanExporter:
+    """
+    Buffers finished spans and writes them in batches from a daemon thread, so request
+    paths never wait on disk or network. Spans are dropped when the buffer is full.
+    """
+
+    def __init__(self, kind=TRACE_EXPORTER):
+        self.kind = kind
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_MAX)
+        self._thread = None
+
+    def export(self, record):
+        if not self.kind:
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("trace_spans_dropped_total")
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + TRACE_FLUSH_SEC
+            while len(batch) < TRACE_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                metrics.incr("trace_spans_dropped_total", len(batch))
+                print(f"[Tracing] Export failed: {e}")
+
+    def _write(self, batch):
+        service_name = _service["name"]
+        if self.kind == "file":
+            with open(TRACE_FILE, "a") as f:
+                for r in batch:
+                    f.write(json.dumps(dict(r, service=service_name), default=str) + "\n")
+        elif self.kind == "otlp":
+            resp = requests.post(OTLP_TRACES_ENDPOINT, json=to_otlp(batch, service_name), timeout=5)
+            resp.raise_for_status()
+
+
+_exporter = SpanExporter()
@@ -0,0 +1,229 @@
+import os
+import json
+import asyncio
+import requests
+from dotenv import load_dotenv
+
+from . import metrics
+from .messages import ChatTurnPublisher, encode_turn, MEMORY_TASK_PREFIX
+from .turn_coalescer import EXTRACT_COALESCE_MAX_TURNS
+
+load_dotenv()
+
+# How chat turns get from the API to the message-log and memory-task consumers.
+# "rabbitmq" (default) publishes to the broker for the separate worker processes.
+# "local" runs both consumers inside the API process on bounded asyncio queues, with an
+# append-only log so turns not yet handled are replayed after a crash or restart.
+TASK_TRANSPORT = os.getenv("TASK_TRANSPORT", "rabbitmq")
+LOCAL_QUEUE_MAX = int(os.getenv("LOCAL_QUEUE_MAX", "1000"))  # per consumer; publishes wait when full
+LOCAL_TASK_LOG = os.getenv("LOCAL_TASK_LOG", "task_log.jsonl")
+LOCAL_TASK_LOG_FSYNC = os.getenv("LOCAL_TASK_LOG_FSYNC", "0") == "1"
+# The log is rewritten with only pending turns once it grows past this
+LOCAL_TASK_LOG_COMPACT_BYTES = int(os.getenv("LOCAL_TASK_LOG_COMPACT_BYTES", str(16 * 2**20)))
+# Concurrent handlers per consumer. Unlike the memory worker's per-queue prefetch, this
+# pool is shared by all users: with many users active at once, turns from others can hold
+# every handler and a user's coalescing window closes early. Raise it for busy nodes.
+LOCAL_MESSAGE_CONSUMERS = int(os.getenv("LOCAL_MESSAGE_CONSUMERS", "10"))
+LOCAL_MEMORY_CONSUMERS = int(os.getenv("LOCAL_MEMORY_CONSUMERS", str(max(3, EXTRACT_COALESCE_MAX_TURNS))))
+
+RABBITMQ_API_URL = os.getenv("RABBITMQ_API_URL", "http://localhost:15672/api/queues")
+RABBITMQ_API_AUTH = (os.getenv("RABBITMQ_API_USER", "guest"), os.getenv("RABBITMQ_API_PASS", "guest"))
+
+CONSUMERS = ("message_log", "memory_task")
+
+
+class RabbitMQTransport:
+    """
+    The broker path: one publish per turn to the chat_turns exchange, consumed by
+    message_worker.py and memory_worker.py.
+    """
+
+    def __init__(self, url=None):
+        self.publisher = ChatTurnPublisher(url)
+
+    async def start(self):
+        pass
+
+    async def publish(self, user_id, user_message, bot_response, headers=None):
+        return await self.publisher.publish(user_id, user_message, bot_response, headers=headers)
+
+    def _fetch_memory_backlog(self):
+        resp = requests.get(RABBITMQ_API_URL, auth=RABBITMQ_API_AUTH, timeout=2)
+        resp.raise_for_status()
+        return sum(q.get("messages", 0) for q in resp.json() if q["name"].startswith(MEMORY_TASK_PREFIX))
+
+    async def memory_backlog(self):
+        # Messages waiting in all memory task queues, from the management API
+        return await asyncio.to_thread(self._fetch_memory_backlog)
+
+    async def drain(self):
+        # No-op: the consumers run in other processes, so there is nothing here to wait
+        # for. Runs that need every turn handled first use the local transport.
+        return
+
+    async def close(self):
+        await self.publisher.close()
+
+
+class LocalTransport:
+    """
+    In-process consumers for single-node deployments, tests and benchmarks. Each turn
+    goes to one bounded queue per consumer and is handled by the workers' own handler
+    functions. The log holds a "pub" record per turn and an "ack" record per consumer
+    once handled; on start, turns missing an ack are queued again. The handlers skip
+    message ids they have already processed, so a replay is safe.
+    """
+
+    def __init__(self, redis_manager, log_path=LOCAL_TASK_LOG, maxsize=LOCAL_QUEUE_MAX,
+                 concurrency=None, handlers=None):
+        self.redis_manager = redis_manager
+        self.log_path = log_path
+        self.maxsize = maxsize
+        self.queues = {}
+        self.concurrency = concurrency or {"message_log": LOCAL_MESSAGE_CONSUMERS, "memory_task": LOCAL_MEMORY_CONSUMERS}
+        self.handlers = handlers
+        self._pending = {}  # message id -> [body, headers, consumers not yet acked]
+        self._retried = set()  # (message id, consumer) requeued after a handler error
+        self._tasks = []
+        self._log = None
+        self._compact_at = LOCAL_TASK_LOG_COMPACT_BYTES
+        self._refiner = None
+
+    async def start(self):
+        if self.handlers is None:
+            # Imported here so the RabbitMQ setup never loads the worker modules
+            from .message_worker import handle_message_log
+            from .memory_worker import handle_memory_task
+            from .magnitude_refiner import refiner
+            self.handlers = {"message_log": handle_message_log, "memory_task": handle_memory_task}
+            self._refiner = refiner
+            refiner.start(self.redis_manager)
+        if self.log_path:
+            self._pending = self._replay()
+            self._compact()
+        # Room for the whole replayed backlog: it was accepted before the crash
+        self.queues = {c: asyncio.Queue(max(self.maxsize, len(self._pending))) for c in CONSUMERS}
+        for message_id, (body, headers, consumers) in self._pending.items():
+            for consumer in consumers:
+                self.queues[consumer].put_nowait((message_id, body, headers))
+        if self._pending:
+            print(f"[Transport] Replaying {len(self._pending)} unfinished turns from {self.log_path}")
+        for consumer, n in self.concurrency.items():
+            self._tasks += [asyncio.create_task(self._consume(consumer)) for _ in range(n)]
+
+    def _replay(self):
+        pending = {}
+        if not os.path.exists(self.log_path):
+            return pending
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    break  # torn last write
+                if rec["op"] == "pub":
+                    pending[rec["id"]] = [rec["body"].encode("utf-8"), rec["headers"], set(rec["c"])]
+                elif rec["id"] in pending:
+                    entry = pending[rec["id"]]
+                    entry[2].discard(rec["c"])
+                    if not entry[2]:
+                        del pending[rec["id"]]
+        return pending
+
+    def _compact(self):
+        # Rewrite the log with only the pending turns, then swap it in
+        if self._log is not None:
+            self._log.close()
+        tmp = f"{self.log_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for message_id, (body, headers, consumers) in self._pending.items():
+                f.write(self._pub_record(message_id, body, headers, consumers))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.log_path)
+        self._log = open(self.log_path, "a", encoding="utf-8")
+        # A large pending backlog must not trigger a rewrite on every ack
+        self._compact_at = max(LOCAL_TASK_LOG_COMPACT_BYTES, 2 * self._log.tell())
+
+    @staticmethod
+    def _pub_record(message_id, body, headers, consumers):
+        rec = {"op": "pub", "id": message_id, "body": body.decode("utf-8"), "headers": headers, "c": sorted(consumers)}
+        return json.dumps(rec, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+    def _append(self, line):
+        if self._log is None:
+            return
+        self._log.write(line)
+        self._log.flush()
+        if LOCAL_TASK_LOG_FSYNC:
+            os.fsync(self._log.fileno())
+
+    async def publish(self, user_id, user_message, bot_response, headers=None):
+        message_id, body = encode_turn(user_id, user_message, bot_response)
+        headers = headers or {}
+        self._pending[message_id] = [body, headers, set(CONSUMERS)]
+        self._append(self._pub_record(message_id, body, headers, CONSUMERS))
+        for consumer in CONSUMERS:
+            await self.queues[consumer].put((message_id, body, headers))
+        metrics.incr("chat_turn_published_total")
+        return message_id
+
+    async def _consume(self, consumer):
+        queue, handler = self.queues[consumer], self.handlers[consumer]
+        while True:
+            message_id, body, headers = await queue.get()
+            try:
+                await handler(self.redis_manager, body, headers)
+            except asyncio.CancelledError:
+                raise  # shutting down mid-task: left unacked, so it is replayed on the next start
+            except Exception as e:
+                print(f"[Transport] {consumer} handler error for {message_id}: {e}")
+                # Retried once, like a RabbitMQ requeue; a second failure is acked and dropped
+                if (message_id, consumer) not in self._retried:
+                    try:
+                        queue.put_nowait((message_id, body, headers))
+                        self._retried.add((message_id, consumer))
+                        queue.task_done()
+                        continue
+                    except asyncio.QueueFull:
+                        pass
+            self._retried.discard((message_id, consumer))
+            self._ack(message_id, consumer)
+            queue.task_done()
+
+    def _ack(self, message_id, consumer):
+        self._append(json.dumps({"op": "ack", "id": message_id, "c": consumer}, separators=(",", ":")) + "\n")
+        entry = self._pending.get(message_id)
+        if entry is not None:
+            entry[2].discard(consumer)
+            if not entry[2]:
+                del self._pending[message_id]
+        if self._log is not None and self._log.tell() > self._compact_at:
+            self._compact()
+
+    async def memory_backlog(self):
+        queue = self.queues.get("memory_task")
+        return queue.qsize() if queue is not None else 0
+
+    async def drain(self):
+        # Wait until every published turn has been handled by both consumers
+        for queue in self.queues.values():
+            await queue.join()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._refiner is not None:
+            await self._refiner.stop()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def get_transport(redis_manager, backend=None):
+    backend = backend or TASK_TRANSPORT
+    if backend == "local":
+        return LocalTransport(redis_manager)
+    return RabbitMQTransport()
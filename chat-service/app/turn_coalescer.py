@@ -0,0 +1,75 @@
+import os
+import asyncio
+from dotenv import load_dotenv
+
+from . import metrics
+
+load_dotenv()
+
+# A user's memory tasks arriving within EXTRACT_COALESCE_SEC of the first one, up to
+# EXTRACT_COALESCE_MAX_TURNS, are extracted together in one LLM call. 0 disables it.
+EXTRACT_COALESCE_SEC = float(os.getenv("EXTRACT_COALESCE_SEC", "2"))
+EXTRACT_COALESCE_MAX_TURNS = int(os.getenv("EXTRACT_COALESCE_MAX_TURNS", "5"))
+
+BATCH_TURN_BUCKETS = (1, 2, 3, 4, 5, 8, 10)
+
+
+class TurnBatch:
+    def __init__(self, loop):
+        self.turns = []  # (produced_at, arrival, message_id, user_msg, bot_resp)
+        self.closed = loop.create_future()
+        self.done = loop.create_future()
+        self.timer = None
+        self.written = 0  # memories written by the leader for the whole batch
+        self.failed = False  # set by the leader; every turn's claim is then released for a retry
+        self.trace_id = None
+
+    def ordered_turns(self):
+        # Oldest first by produced-at time; arrival order breaks ties and covers legacy payloads
+        return [turn[2:] for turn in sorted(self.turns, key=lambda t: (t[0] or 0.0, t[1]))]
+
+    def finish(self):
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+class TurnCoalescer:
+    """
+    Groups one user's chat turns into batches. The first turn of a batch is its leader:
+    it gets the whole batch back to extract and apply, and must call `batch.finish()`.
+    The other turns just wait for the leader, so their messages are acked only after
+    their content has been processed.
+    """
+
+    def __init__(self, window_sec=EXTRACT_COALESCE_SEC, max_turns=EXTRACT_COALESCE_MAX_TURNS):
+        self.window = window_sec
+        self.max_turns = max(1, max_turns)
+        self._open = {}  # user_id -> TurnBatch still accepting turns
+
+    async def join(self, user_id, message_id, user_msg, bot_resp, produced_at=None):
+        """
+        Returns (batch, is_leader) once the batch is closed.
+        """
+        loop = asyncio.get_running_loop()
+        batch = self._open.get(user_id)
+        is_leader = batch is None
+        if is_leader:
+            batch = TurnBatch(loop)
+            self._open[user_id] = batch
+            if self.window > 0:
+                batch.timer = loop.call_later(self.window, self._close, user_id, batch)
+        batch.turns.append((produced_at, len(batch.turns), message_id, user_msg, bot_resp))
+        if self.window <= 0 or len(batch.turns) >= self.max_turns:
+            self._close(user_id, batch)
+        await asyncio.shield(batch.closed)
+        return batch, is_leader
+
+    def _close(self, user_id, batch):
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        if self._open.get(user_id) is batch:
+            del self._open[user_id]
+        if not batch.closed.done():
+            batch.closed.set_result(None)
+            metrics.observe("extraction_batch_turns", len(batch.turns), buckets=BATCH_TURN_BUCKETS)
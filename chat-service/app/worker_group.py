@@ -0,0 +1,151 @@
+import os
+import time
+import uuid
+import socket
+import bisect
+import hashlib
+import asyncio
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Worker-group mode: memory workers register in Redis with heartbeats and split users
+# between them with a consistent-hash ring, so each user's queue has exactly one owner.
+WORKER_GROUP = os.getenv("WORKER_GROUP", "0") == "1"
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_HEARTBEAT_SEC = float(os.getenv("WORKER_HEARTBEAT_SEC", "5"))
+WORKER_TTL_SEC = float(os.getenv("WORKER_TTL_SEC", "15"))
+RING_VNODES = 64
+# How long a per-user processing lock outlives a holder that stopped renewing it. Holders
+# extend it every third of that, so a batch of slow LLM calls keeps it for as long as it runs.
+USER_LOCK_TTL_SEC = int(os.getenv("USER_LOCK_TTL_SEC", "30"))
+# Delete the lock only if it still holds our token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# Extend the lock only if it still holds our token
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _hash(value: str) -> int:
+    return int(hashlib.md5(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent-hash ring with virtual nodes: adding or removing a worker only moves
+    the users adjacent to its points, roughly 1/N of them.
+    """
+
+    def __init__(self, members, vnodes=RING_VNODES):
+        points = sorted((_hash(f"{m}#{i}"), m) for m in members for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._members = [m for _, m in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._members[i]
+
+
+class WorkerGroup:
+    """
+    Membership is a sorted set of worker id -> last heartbeat time; members that stop
+    heartbeating for WORKER_TTL_SEC are dropped and their users rebalance to the rest.
+    """
+
+    def __init__(self, redis_client, group="memory", worker_id=WORKER_ID):
+        self.redis = redis_client
+        self.key = f"workers:{group}"
+        self.worker_id = worker_id
+        self.members = ()
+        self.ring = HashRing([])
+
+    def heartbeat(self):
+        """
+        Refresh our membership and the ring. Returns True when membership changed.
+        """
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.key, {self.worker_id: now})
+        pipe.zremrangebyscore(self.key, 0, now - WORKER_TTL_SEC)
+        pipe.zrange(self.key, 0, -1)
+        members = tuple(sorted(m.decode() for m in pipe.execute()[-1]))
+        if members == self.members:
+            return False
+        self.members = members
+        self.ring = HashRing(members)
+        return True
+
+    def owns(self, user_id):
+        return self.ring.owner(user_id) == self.worker_id
+
+    def leave(self):
+        self.redis.zrem(self.key, self.worker_id)
+
+    async def run(self, on_change):
+        # Heartbeat loop; `on_change` is awaited after every membership change
+        try:
+            while True:
+                try:
+                    if self.heartbeat():
+                        print(f"[WorkerGroup] {self.worker_id}: members now {list(self.members)}")
+                        await on_change()
+                except Exception as e:
+                    print(f"[WorkerGroup] Heartbeat error: {e}")
+                await asyncio.sleep(WORKER_HEARTBEAT_SEC)
+        finally:
+            self.leave()
+
+
+async def acquire_user_lock(redis_client, key, poll_sec=0.5):
+    """
+    Serialize processing of one user. Returns the token to release with: unique per
+    acquisition, so two tasks in one process cannot release each other's lock.
+    """
+    token = uuid.uuid4().hex
+    while not redis_client.set(key, token, nx=True, ex=USER_LOCK_TTL_SEC):
+        await asyncio.sleep(poll_sec)
+    return token
+
+
+def release_user_lock(redis_client, key, token):
+    redis_client.eval(RELEASE_LOCK_SCRIPT, 1, key, token)
+
+
+async def _renew_user_lock(redis_client, key, token):
+    while True:
+        await asyncio.sleep(USER_LOCK_TTL_SEC / 3)
+        try:
+            renewed = redis_client.eval(RENEW_LOCK_SCRIPT, 1, key, token, int(USER_LOCK_TTL_SEC * 1000))
+        except Exception as e:
+            print(f"[WorkerGroup] Renewing {key} failed, retrying: {e}")
+            continue
+        if not renewed:
+            print(f"[WorkerGroup] Lost {key} while holding it; another holder may be writing")
+            return
+
+
+@asynccontextmanager
+async def user_lock(redis_client, key):
+    """
+    `async with user_lock(client, memory_lock_key(user_id)):` holds the user's lock,
+    renewing it in the background until the block exits.
+    """
+    token = await acquire_user_lock(redis_client, key)
+    renewer = asyncio.create_task(_renew_user_lock(redis_client, key, token))
+    try:
+        yield token
+    finally:
+        renewer.cancel()
+        release_user_lock(redis_client, key, token)